@@ -23,5 +23,6 @@
 # Created:     19/03/2024
 # -------------------------------------------------------------------------------
 from .main import main
-from .module_commands import fetch_var_planetary, fetch_var_copernicus, fetch_var_smhi, list_repo_vars
-from .module_config import PlanetaryConfig
\ No newline at end of file
+from .module_commands import fetch_var_planetary, fetch_var_planetary_async, fetch_var_copernicus, submit_var_copernicus, reattach_var_copernicus, poll_var_copernicus, fetch_var_smhi, fetch_var_smhi_batch, list_repo_vars
+from .module_config import PlanetaryConfig
+from .module_planner import SourceRequest, fetch_all
\ No newline at end of file
@@ -249,7 +249,6 @@ def md5sum(filename):
             d.update(buf)
         f.close()
         res = d.hexdigest()
-        print(res)
         return res
     else:
         return ""
@@ -26,16 +26,34 @@ def preprocess_json(json_str):
 @click.command()
 @click.option("--varname", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_VARNAME, help="The variable name to fetch. Example: precipitation_amount_1hour_Accumulation")
 @click.option("--models", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_MODELS, help="The models to fetch from. Example: GFDL-ESM4")
-@click.option("--factor", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_FACTOR, help="The factor to multiply the variable by. Example: 1000")
+@click.option("--factor", type=click.FLOAT, required=False, default=PlanetaryConfig.DEFAULT_FACTOR, help="The factor to multiply the variable by. Example: 1000")
 @click.option("--bbox", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_BBOX, help="The bounding box to fetch with format min_lon,min_lat,max_lon,max_lat. Example: 6.75,36.75,18.28,47.00")
 @click.option("--start_date", type=click.STRING, required=False, default=PlanetaryConfig.DEFALUT_START_DATE, help="The start date to fetch with format dd-mm-yyyy. Example: 01-01-2020")
 @click.option("--end_date", type=click.STRING, required=False, default=PlanetaryConfig.DEFALUT_END_DATE, help="The end date to fetch with format dd-mm-yyyy. Example: 01-01-2021")
 @click.option("--repository", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_REPOSITORY, help="The repository to fetch from: Example https://planetarycomputer.microsoft.com/api/stac/v1/")
 @click.option("--collections", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_COLLECTIONS, help="The collections of the repository to fetch from. Example: era5-pds")
 @click.option("--query", type=click.STRING, required=False, default="", help="The query to fetch from the repository")
-@click.option("--fileout", type=click.STRING, required=False, default="", help="The file to save the output to, must have extension .csv or .nc. Example: output.nc or out.csv")
+@click.option("--fileout", type=click.STRING, required=False, default="", help="The file to save the output to, must have extension .csv, .nc or .zarr. Example: output.nc or out.csv")
+@click.option("--max_workers", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_MAX_WORKERS, help="The maximum number of items downloaded concurrently. Example: 8")
+@click.option("--max_per_host", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_MAX_PER_HOST, help="The maximum number of concurrent downloads against the same host, 0 for as many as the workers. Example: 4")
+@click.option("--cache_dir", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_CACHE_DIR, help="The folder of the on-disk tile cache. Example: ./cache")
+@click.option("--cache_size", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_CACHE_SIZE, help="The maximum size in bytes of the tile cache. Example: 10737418240")
+@click.option("--checkpoint_dir", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_CHECKPOINT_DIR, help="The folder of the job checkpoints, a rerun with the same arguments resumes the download. Example: ./checkpoints")
+@click.option("--max_attempts", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_MAX_ATTEMPTS, help="The number of attempts to download each item. Example: 5")
+@click.option("--item_timeout", type=click.FLOAT, required=False, default=PlanetaryConfig.DEFAULT_ITEM_TIMEOUT, help="The timeout in seconds of the connections and reads of an item, a stalled attempt fails and is retried, 0 waits indefinitely. Example: 300")
+@click.option("--engine", type=click.Choice(["threads", "async"]), required=False, default=PlanetaryConfig.DEFAULT_ENGINE, help="Fetch the items on a thread pool or on an asyncio event loop. Example: async")
+@click.option("--max_concurrency", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY, help="The maximum number of items read concurrently by the async engine. Example: 64")
+@click.option("--points", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_POINTS, help="Extract the time series at these points only, with format lon,lat;lon,lat or as JSON. Example: 9.19,45.46;12.49,41.90")
+@click.option("--point_method", type=click.Choice(["nearest", "linear"]), required=False, default=PlanetaryConfig.DEFAULT_POINT_METHOD, help="Read the nearest grid cell of each point or interpolate it bilinearly. Example: linear")
+@click.option("--geometry", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_GEOMETRY, help="Fetch only the cells inside the polygons of a GeoJSON file or string. Example: catchment.geojson")
+@click.option("--aggregate", is_flag=True, required=False, default=PlanetaryConfig.DEFAULT_AGGREGATE, help="Average the data over --geometry, weighted by the area of the cells.")
+@click.option("--resample", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_RESAMPLE, help="Reduce each item as soon as it is fetched, with format freq:statistic (mean, sum, max, min, count, median, q90). Example: 1D:max")
+@click.option("--ensemble_stats", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_ENSEMBLE_STATS, help="Reduce the models of a CMIP6 ensemble to these statistics as they arrive (mean, std, var, min, max, count, median, q90). Example: mean,std,q10,q90")
+@click.option("--target_grid", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_TARGET_GRID, help="Interpolate each item on this grid: a resolution, min_lon,min_lat,max_lon,max_lat,res or a .nc/.zarr file. Example: 0.25")
+@click.option("--transform", type=click.STRING, required=False, default=PlanetaryConfig.DEFAULT_TRANSFORM, help="The pipeline applied to each item after --factor, | separated steps scale:a, offset:b, units:K:degC, clip:min:max, deaccumulate, or JSON by variable. Example: units:K:degC")
 @click.option("--version", is_flag=True, required=False, default=False, help="Print version and exit.")
 @click.option("--list_vars", is_flag=True, required=False, default=False, help="List available variables in the repository. Requires --repository and --collections.")
+@click.option("--list_vars_sample", type=click.INT, required=False, default=PlanetaryConfig.DEFAULT_LIST_VARS_SAMPLE, help="The number of items sampled by --list_vars, 0 reads the collection item_assets instead. Example: 1")
 @click.option("--list_repos", is_flag=True, required=False, default=False, help="List available repositories. Requires --repository and --collections.")
 def main(varname=PlanetaryConfig.DEFAULT_VARNAME, 
          models=PlanetaryConfig.DEFAULT_MODELS,
@@ -47,8 +65,26 @@ def main(varname=PlanetaryConfig.DEFAULT_VARNAME,
          collections=PlanetaryConfig.DEFAULT_COLLECTIONS, 
          query=PlanetaryConfig.DEFAULT_QUERY, 
          fileout=PlanetaryConfig.DEFAULT_FILEOUT, 
+         max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS,
+         max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST,
+         cache_dir=PlanetaryConfig.DEFAULT_CACHE_DIR,
+         cache_size=PlanetaryConfig.DEFAULT_CACHE_SIZE,
+         checkpoint_dir=PlanetaryConfig.DEFAULT_CHECKPOINT_DIR,
+         max_attempts=PlanetaryConfig.DEFAULT_MAX_ATTEMPTS,
+         item_timeout=PlanetaryConfig.DEFAULT_ITEM_TIMEOUT,
+         engine=PlanetaryConfig.DEFAULT_ENGINE,
+         max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY,
+         points=PlanetaryConfig.DEFAULT_POINTS,
+         point_method=PlanetaryConfig.DEFAULT_POINT_METHOD,
+         geometry=PlanetaryConfig.DEFAULT_GEOMETRY,
+         aggregate=PlanetaryConfig.DEFAULT_AGGREGATE,
+         resample=PlanetaryConfig.DEFAULT_RESAMPLE,
+         ensemble_stats=PlanetaryConfig.DEFAULT_ENSEMBLE_STATS,
+         target_grid=PlanetaryConfig.DEFAULT_TARGET_GRID,
+         transform=PlanetaryConfig.DEFAULT_TRANSFORM,
          version=PlanetaryConfig.DEFAULT_VERSION, 
          list_vars=PlanetaryConfig.DEFAULT_LIST_VARS, 
+         list_vars_sample=PlanetaryConfig.DEFAULT_LIST_VARS_SAMPLE,
          list_repos=PlanetaryConfig.DEFAULT_LIST_REPOS):
 
     if version:
@@ -56,7 +92,7 @@ def main(varname=PlanetaryConfig.DEFAULT_VARNAME,
         return 0
     
     if list_vars:
-        repo_vars = list_repo_vars(repository, collections)
+        repo_vars = list_repo_vars(repository, collections, list_vars_sample)
         click.echo("Available variables: ")
         click.echo(repo_vars)
         return 0
@@ -70,7 +106,25 @@ def main(varname=PlanetaryConfig.DEFAULT_VARNAME,
         end_date=end_date, 
         repository=repository, 
         collections=collections,
-        query=query
+        query=query,
+        max_workers=max_workers,
+        max_per_host=max_per_host,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        fileout=fileout,
+        checkpoint_dir=checkpoint_dir,
+        max_attempts=max_attempts,
+        item_timeout=item_timeout,
+        engine=engine,
+        max_concurrency=max_concurrency,
+        points=points,
+        point_method=point_method,
+        geometry=geometry,
+        aggregate=aggregate,
+        resample=resample,
+        ensemble_stats=ensemble_stats,
+        target_grid=target_grid,
+        transform=transform
     )
     
     return df
@@ -0,0 +1,138 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from climate_eed.module_cache import STAC_CACHE
+from climate_eed.module_config import PlanetaryConfig
+from climate_eed.module_planetary_operations import EnsembleCollector, ItemsCollector, ModelsCollector, filter_models, item_start
+from climate_eed.module_threads import bbox_chunks, get_item_host, get_planetary_item_thr, get_planetary_model_thr
+from climate_eed.module_writer import get_writer
+
+
+def run_or_defer(coroutine):
+    """
+    Runs the coroutine to completion on a new event loop, or returns it to be awaited
+    when called from code that already runs an event loop (notebooks, async services).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    return coroutine
+
+
+def split_datetime(start_date, end_date, freq="YS"):
+    """
+    Splits [start_date, end_date] in consecutive windows, searched concurrently.
+    """
+    if not start_date or not end_date:
+        return [None]
+    bounds = [pd.Timestamp(start_date)] + [t for t in pd.date_range(start_date, end_date, freq=freq) if t > pd.Timestamp(start_date)] + [pd.Timestamp(end_date)]
+    return [[bounds[i].isoformat(), bounds[i + 1].isoformat()] for i in range(len(bounds) - 1)] or [[start_date, end_date]]
+
+
+async def search_async(repository, collections, datetime=None, query=None):
+    """
+    Runs the STAC searches of every collection and time window concurrently, the items found twice are returned once.
+    """
+    windows = split_datetime(*datetime) if datetime else [None]
+    searches = [asyncio.to_thread(STAC_CACHE.search, repository, [collection], datetime=window, query=query) for collection in collections for window in windows]
+    items = {}
+    for found in await asyncio.gather(*searches):
+        for item in found:
+            items.setdefault((item.collection_id, item.id), item)
+    return list(items.values())
+
+
+async def run_threads_async(threads, max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY, max_per_host=None):
+    """
+    Runs the ThreadReturn tasks on the event loop, at most max_concurrency (and max_per_host against
+    the same host) at a time, and yields them as soon as they complete.
+    Args:
+        - threads (dict): The tasks to run, mapped to the host they read from.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # the blocking xarray opens run on a private pool as large as the semaphore, the loop of the caller is left untouched
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    host_semaphores = {host: asyncio.Semaphore(max_per_host) for host in set(threads.values()) if host and max_per_host}
+
+    async def run(thrd, host):
+        host_semaphore = host_semaphores.get(host)
+        async with semaphore:
+            if host_semaphore is not None:
+                await host_semaphore.acquire()
+            try:
+                await loop.run_in_executor(executor, thrd.run)
+            except Exception as e:
+                # the failure is reported by the caller, from thrd.failure()
+                thrd.error = e
+            finally:
+                if host_semaphore is not None:
+                    host_semaphore.release()
+        return thrd
+
+    try:
+        for task in asyncio.as_completed([run(thrd, host) for thrd, host in threads.items()]):
+            yield await task
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def get_data_from_items_async(items, varname, factor, bbox, *, max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, writer=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, regrid=None, transform=None):
+    collector = ItemsCollector(sorted(items, key=item_start), writer, manifest, resample)
+    position = {}
+    threads = {}
+    for i, item in collector.pending_items():
+        thrd = get_planetary_item_thr(item=item, varname=varname, bbox=bbox, factor=factor, lazy=lazy, cache=cache, retry=retry, timeout=timeout, points=points, geometry=geometry, resample=resample, regrid=regrid, transform=transform)
+        threads[thrd] = get_item_host(item, varname)
+        position[thrd] = i
+    async for thrd in run_threads_async(threads, max_concurrency, max_per_host):
+        collector.add(position[thrd], thrd.get_return_value(), thrd.failure())
+    return collector.result()
+
+
+async def get_data_from_models_async(ensemble, varname, factor, bbox, *, start_date=None, end_date=None, max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, writer=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, ensemble_stats=None, regrid=None, transform=None):
+    if ensemble_stats:
+        collector = EnsembleCollector(ensemble, ensemble_stats, writer, manifest)
+    else:
+        collector = ModelsCollector(ensemble, writer, manifest)
+    position = {}
+    threads = {}
+    for item in collector.pending_items():
+        thrd = get_planetary_model_thr(item=item, varname=varname, bbox=bbox, factor=factor, start_date=start_date, end_date=end_date, lazy=lazy, cache=cache, retry=retry, timeout=timeout, points=points, geometry=geometry, resample=resample, regrid=regrid, transform=transform)
+        threads[thrd] = get_item_host(item, varname)
+        position[thrd] = item
+    async for thrd in run_threads_async(threads, max_concurrency, max_per_host):
+        collector.add(position[thrd], thrd.get_return_value(), thrd.failure())
+    return collector.result()
+
+
+async def planetary_data_request_async(varname, models, factor, bbox, start_date, end_date, repository, collections, query, *, max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, fileout=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, ensemble_stats=None, regrid=None, transform=None):
+    """
+    Fetches data from a STAC repository on an asyncio event loop and returns it as an xarray dataset.
+    The STAC searches run concurrently (one per collection and year), the items are signed, opened
+    and read concurrently, at most max_concurrency at a time.
+    Args:
+        - max_concurrency (int): The maximum number of items read concurrently. Example: 64.
+        - the other arguments are the ones of planetary_data_request.
+    Returns:
+        - xr.Dataset: The data fetched from the STAC repository.
+    """
+
+    output_ds = None
+    # the options shared by the items and the models of the ensemble
+    options = {"max_per_host": max_per_host, "lazy": lazy, "cache": cache, "manifest": manifest, "retry": retry, "timeout": timeout, "points": points, "geometry": geometry, "resample": resample, "regrid": regrid, "transform": transform}
+
+    if "cil-gdpcir-cc0" in collections or "cil-gdpcir-cc-by" in collections:
+        ensemble = await search_async(repository, collections, query=query)
+        ensemble = filter_models(ensemble, models)
+        writer = get_writer(fileout, append_dim="statistic" if ensemble_stats else "model")
+        output_ds = await get_data_from_models_async(ensemble, varname, factor, bbox, start_date=start_date, end_date=end_date, max_concurrency=max_concurrency, writer=writer, ensemble_stats=ensemble_stats, **options)
+        if lazy and output_ds is not None:
+            output_ds = output_ds.chunk(bbox_chunks(output_ds))
+    else:
+        items = await search_async(repository, collections, datetime=[start_date, end_date], query=query)
+        writer = get_writer(fileout, append_dim="time")
+        output_ds = await get_data_from_items_async(items, varname, factor, bbox, max_concurrency=max_concurrency, writer=writer, **options)
+
+    return output_ds
@@ -0,0 +1,403 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import planetary_computer
+import pystac
+import pystac_client
+import xarray as xr
+from planetary_computer.sas import TOKEN_CACHE, SASToken
+
+from climate_eed.filesystem import md5text, mkdirs, remove
+from climate_eed.module_config import CopernicusConfig, PlanetaryConfig
+
+
+def subset_bbox(ds, bbox):
+    """
+    Selects the bbox from the data whatever the orientation of the lat axis.
+    Args:
+        - ds (xr.DataArray): The data to subset, with lat and lon (or latitude and longitude) coordinates.
+        - bbox (list): The bounding box with format [min_lon, min_lat, max_lon, max_lat].
+    Returns:
+        - xr.DataArray: The data inside the bounding box.
+    """
+    if not bbox:
+        return ds
+    lat_name, lon_name = ("lat", "lon") if "lat" in ds.coords else ("latitude", "longitude")
+    lat = ds[lat_name].values
+    if lat.size > 1 and lat[0] > lat[-1]:
+        lat_slice = slice(bbox[3], bbox[1])
+    else:
+        lat_slice = slice(bbox[1], bbox[3])
+    return ds.sel({lat_name: lat_slice, lon_name: slice(bbox[0], bbox[2])})
+
+
+def bbox_contains(outer, inner):
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def time_contains(outer, inner):
+    if outer[0] is not None and (inner[0] is None or inner[0] < outer[0]):
+        return False
+    if outer[1] is not None and (inner[1] is None or inner[1] > outer[1]):
+        return False
+    return True
+
+
+class TileCache:
+    def __init__(self, cache_dir=PlanetaryConfig.DEFAULT_CACHE_DIR, max_size=PlanetaryConfig.DEFAULT_CACHE_SIZE):
+        """
+        TileCache - content addressed on-disk cache of the subsets fetched from the STAC items.
+        Each tile is keyed by collection, item id, variable, bbox and time slice, stored as NetCDF
+        and evicted in least recently used order once the cache exceeds max_size bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        mkdirs(cache_dir)
+        self.index = self.read_index()
+
+    def read_index(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as stream:
+                index = json.load(stream)
+        except (OSError, ValueError):
+            index = {}
+        return {key: entry for key, entry in index.items() if os.path.isfile(entry["file"])}
+
+    def write_index(self):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as stream:
+            json.dump(self.index, stream)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def tile_key(collection, item_id, varname, bbox=None, start_date=None, end_date=None):
+        return md5text(json.dumps([collection, item_id, varname, bbox, start_date, end_date]))
+
+    def find(self, collection, item_id, varname, bbox=None, start_date=None, end_date=None):
+        """
+        find - returns the key of the tile matching the request, or of the smallest cached tile that contains it
+        """
+        key = self.tile_key(collection, item_id, varname, bbox, start_date, end_date)
+        if key in self.index:
+            return key
+        candidates = [
+            (entry["size"], candidate_key) for candidate_key, entry in self.index.items()
+            if (entry["collection"], entry["item_id"], entry["varname"]) == (collection, item_id, varname)
+            and bbox_contains(entry["bbox"], bbox)
+            and time_contains((entry["start_date"], entry["end_date"]), (start_date, end_date))
+        ]
+        return min(candidates)[1] if candidates else None
+
+    def get(self, collection, item_id, varname, bbox=None, start_date=None, end_date=None, lazy=False):
+        """
+        get - returns the cached subset, None on cache miss
+        """
+        with self.lock:
+            key = self.find(collection, item_id, varname, bbox, start_date, end_date)
+            if key is None:
+                return None
+            entry = self.index[key]
+            entry["atime"] = time.time()
+            self.write_index()
+        da = xr.open_dataarray(entry["file"], chunks={} if lazy else None)
+        if not lazy:
+            da = da.load()
+            da.close()
+        if key != self.tile_key(collection, item_id, varname, bbox, start_date, end_date):
+            da = subset_bbox(da, bbox)
+            if start_date or end_date:
+                da = da.sel(time=slice(start_date, end_date))
+        return da
+
+    def put(self, collection, item_id, varname, da, bbox=None, start_date=None, end_date=None):
+        """
+        put - stores the subset, reading it if it is still lazy, and evicts the least recently used tiles
+        """
+        key = self.tile_key(collection, item_id, varname, bbox, start_date, end_date)
+        filename = os.path.join(self.cache_dir, f"{key}.nc")
+        tmp_file = f"{filename}.{threading.get_ident()}.tmp"
+        da.drop_encoding().to_netcdf(tmp_file)
+        os.replace(tmp_file, filename)
+        with self.lock:
+            self.index[key] = {
+                "collection": collection,
+                "item_id": item_id,
+                "varname": varname,
+                "bbox": bbox,
+                "start_date": start_date,
+                "end_date": end_date,
+                "file": filename,
+                "size": os.path.getsize(filename),
+                "atime": time.time(),
+            }
+            self.evict(keep=key)
+            self.write_index()
+        return filename
+
+    def evict(self, keep=None):
+        total_size = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda kv: kv[1]["atime"]):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            remove(entry["file"])
+            total_size -= entry["size"]
+            del self.index[key]
+
+    def size(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+
+def canonical_query(query):
+    """
+    Returns the CDS query with sorted keys and every value as a sorted list of strings,
+    so that queries asking for the same data have the same key whatever their spelling.
+    """
+    canonical = {}
+    for key, value in query.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if key == "area":
+            canonical[key] = [float(x) for x in values]
+        else:
+            canonical[key] = sorted(str(x) for x in values)
+    return dict(sorted(canonical.items()))
+
+
+def area_to_bbox(area):
+    """
+    Converts a CDS area [north, west, south, east] to a bbox [min_lon, min_lat, max_lon, max_lat].
+    """
+    return [area[1], area[2], area[3], area[0]] if area else None
+
+
+class CDSCache:
+    def __init__(self, cache_dir=CopernicusConfig.DEFAULT_CACHE_DIR, max_size=CopernicusConfig.DEFAULT_CACHE_SIZE):
+        """
+        CDSCache - on-disk cache of the files retrieved from the CDS, keyed by dataset and canonical query.
+        The requests for a smaller area of a cached NetCDF are served by subsetting it,
+        the files are evicted in least recently used order once the cache exceeds max_size bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        mkdirs(cache_dir)
+        self.index = self.read_index()
+
+    def read_index(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as stream:
+                index = json.load(stream)
+        except (OSError, ValueError):
+            index = {}
+        return {key: entry for key, entry in index.items() if os.path.isfile(entry["file"])}
+
+    def write_index(self):
+        tmp_file = f"{self.index_file}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as stream:
+            json.dump(self.index, stream)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def query_key(dataset, query):
+        return md5text(json.dumps([dataset, canonical_query(query)]))
+
+    def find(self, dataset, query):
+        """
+        find - returns the key of the file of the query, or of the smallest cached NetCDF of a larger area
+        """
+        key = self.query_key(dataset, query)
+        if key in self.index:
+            return key
+        query = canonical_query(query)
+        if query.get("format", query.get("data_format")) != ["netcdf"]:
+            return None
+        others = {k: v for k, v in query.items() if k != "area"}
+        candidates = [
+            (entry["size"], candidate_key) for candidate_key, entry in self.index.items()
+            if entry["dataset"] == dataset
+            and {k: v for k, v in entry["query"].items() if k != "area"} == others
+            and bbox_contains(area_to_bbox(entry["query"].get("area")), area_to_bbox(query.get("area")))
+        ]
+        return min(candidates)[1] if candidates else None
+
+    def get(self, dataset, query, fileout):
+        """
+        get - copies the cached file of the query to fileout, returns False on cache miss
+        """
+        with self.lock:
+            key = self.find(dataset, query)
+            if key is None:
+                return False
+            entry = self.index[key]
+            entry["atime"] = time.time()
+            self.write_index()
+        mkdirs(os.path.dirname(os.path.abspath(fileout)))
+        tmp_file = f"{fileout}.{threading.get_ident()}.tmp"
+        if key == self.query_key(dataset, query):
+            shutil.copyfile(entry["file"], tmp_file)
+        else:
+            with xr.open_dataset(entry["file"], chunks={}) as ds:
+                subset_bbox(ds, area_to_bbox(canonical_query(query).get("area"))).to_netcdf(tmp_file)
+        os.replace(tmp_file, fileout)
+        return True
+
+    def put(self, dataset, query, filename):
+        """
+        put - stores a copy of the file retrieved for the query and evicts the least recently used files
+        """
+        key = self.query_key(dataset, query)
+        cached_file = os.path.join(self.cache_dir, key)
+        tmp_file = f"{cached_file}.{threading.get_ident()}.tmp"
+        shutil.copyfile(filename, tmp_file)
+        os.replace(tmp_file, cached_file)
+        with self.lock:
+            self.index[key] = {
+                "dataset": dataset,
+                "query": canonical_query(query),
+                "file": cached_file,
+                "size": os.path.getsize(cached_file),
+                "atime": time.time(),
+            }
+            self.evict(keep=key)
+            self.write_index()
+        return cached_file
+
+    def evict(self, keep=None):
+        total_size = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda kv: kv[1]["atime"]):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            remove(entry["file"])
+            total_size -= entry["size"]
+            del self.index[key]
+
+
+class StacCache:
+    def __init__(self, cache_dir=PlanetaryConfig.DEFAULT_STAC_CACHE_DIR, ttl=PlanetaryConfig.DEFAULT_STAC_CACHE_TTL):
+        """
+        StacCache - in-process and on-disk cache of the STAC catalog handles, of the search results
+        (keyed by repository, collections, datetime and query) and of the SAS tokens used to sign the items.
+        Search results older than ttl seconds are searched again, tokens are kept until they expire.
+        The tokens are credentials: cache_dir is private to the user (mode 0700) and tokens.json readable only by them (mode 0600).
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.catalogs = {}
+        self.searches = {}
+        self.tokens_file = os.path.join(cache_dir, "tokens.json") if cache_dir else None
+        self.tokens_loaded = False
+
+    def open_catalog(self, repository):
+        with self.lock:
+            if repository not in self.catalogs:
+                self.catalogs[repository] = pystac_client.Client.open(repository)
+            return self.catalogs[repository]
+
+    def item_assets(self, repository, collection):
+        """
+        item_assets - returns the item_assets declared in the collection metadata, without searching any item
+        """
+        key = (repository, collection)
+        with self.lock:
+            if key in self.searches:
+                return self.searches[key]
+        item_assets = self.open_catalog(repository).get_collection(collection).extra_fields.get("item_assets", {})
+        with self.lock:
+            self.searches[key] = item_assets
+        return item_assets
+
+    @staticmethod
+    def search_key(repository, collections, datetime=None, query=None, max_items=None):
+        return md5text(json.dumps([repository, collections, datetime, query, max_items], sort_keys=True))
+
+    def search(self, repository, collections, datetime=None, query=None, max_items=None):
+        """
+        search - returns the (unsigned) items of the search, from the cache when they are younger than ttl
+        """
+        key = self.search_key(repository, collections, datetime, query, max_items)
+        filename = os.path.join(self.cache_dir, f"search_{key}.json") if self.cache_dir else None
+        with self.lock:
+            cached = self.searches.get(key)
+        if cached is None and filename and os.path.isfile(filename):
+            try:
+                with open(filename, "r", encoding="utf-8") as stream:
+                    cached = json.load(stream)
+            except (OSError, ValueError):
+                cached = None
+        if cached is not None and time.time() - cached["timestamp"] < self.ttl:
+            return [pystac.Item.from_dict(item) for item in cached["items"]]
+
+        catalog = self.open_catalog(repository)
+        search_kwargs = {"collections": collections, "query": query, "max_items": max_items}
+        if datetime:
+            search_kwargs["datetime"] = datetime
+        items = list(catalog.search(**search_kwargs).items())
+        cached = {"timestamp": time.time(), "items": [item.to_dict() for item in items]}
+        with self.lock:
+            self.searches[key] = cached
+        if filename and self.ttl > 0:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            tmp_file = f"{filename}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as stream:
+                json.dump(cached, stream)
+            os.replace(tmp_file, filename)
+        return items
+
+    def load_tokens(self):
+        if self.tokens_loaded or not self.tokens_file:
+            return
+        self.tokens_loaded = True
+        try:
+            with open(self.tokens_file, "r", encoding="utf-8") as stream:
+                tokens = json.load(stream)
+        except (OSError, ValueError):
+            return
+        for url, token in tokens.items():
+            token = SASToken(**token)
+            if url not in TOKEN_CACHE and token.ttl() > 60:
+                TOKEN_CACHE[url] = token
+
+    def save_tokens(self):
+        if not self.tokens_file:
+            return
+        # the expired tokens are dropped, the file is deleted once none is left
+        tokens = {url: token.model_dump(by_alias=True, mode="json") for url, token in TOKEN_CACHE.items() if token.ttl() > 60}
+        if not tokens:
+            remove(self.tokens_file)
+            return
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        tmp_file = f"{self.tokens_file}.{threading.get_ident()}.tmp"
+        remove(tmp_file)
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w", encoding="utf-8") as stream:
+            json.dump(tokens, stream)
+        os.replace(tmp_file, self.tokens_file)
+
+    def sign(self, item):
+        """
+        sign - signs the item, reusing the SAS tokens still valid from this or a previous process
+        """
+        with self.lock:
+            self.load_tokens()
+            known_tokens = {url: token.token for url, token in TOKEN_CACHE.items()}
+        signed_item = planetary_computer.sign(item)
+        with self.lock:
+            if {url: token.token for url, token in TOKEN_CACHE.items()} != known_tokens:
+                self.save_tokens()
+        return signed_item
+
+
+STAC_CACHE = StacCache()
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+
+import xarray as xr
+
+from climate_eed.filesystem import md5text, mkdirs
+
+
+class JobManifest:
+    def __init__(self, checkpoint_dir, job_args, lazy=False):
+        """
+        JobManifest - records which STAC items (or model slices) of a fetch have been completed to
+        local storage, so that a rerun with the same arguments only fetches the missing pieces.
+        The pieces are read back dask-backed with lazy=True, else in memory
+        """
+        self.lazy = lazy
+        self.job_id = md5text(json.dumps(job_args, sort_keys=True, default=str))
+        self.job_dir = os.path.join(checkpoint_dir, self.job_id)
+        self.manifest_file = os.path.join(self.job_dir, "manifest.json")
+        self.lock = threading.Lock()
+        mkdirs(self.job_dir)
+        self.manifest = self.read_manifest()
+        self.manifest["args"] = job_args
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as stream:
+                manifest = json.load(stream)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest.setdefault("completed", {})
+        manifest.setdefault("failed", {})
+        manifest["completed"] = {key: filename for key, filename in manifest["completed"].items() if os.path.isfile(filename)}
+        return manifest
+
+    def write_manifest(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as stream:
+            json.dump(self.manifest, stream, indent=2, default=str)
+        os.replace(tmp_file, self.manifest_file)
+
+    def is_done(self, key):
+        return key in self.manifest["completed"]
+
+    def load(self, key):
+        """
+        load - opens the completed piece from local storage, lazily or read in memory (and the file closed)
+        """
+        da = xr.open_dataarray(self.manifest["completed"][key], chunks={} if self.lazy else None)
+        if not self.lazy:
+            da = da.load()
+            da.close()
+        return da
+
+    def save(self, key, da):
+        filename = os.path.join(self.job_dir, f"{md5text(key)}.nc")
+        tmp_file = f"{filename}.tmp"
+        da.drop_encoding().to_netcdf(tmp_file)
+        os.replace(tmp_file, filename)
+        with self.lock:
+            self.manifest["completed"][key] = filename
+            self.manifest["failed"].pop(key, None)
+            self.write_manifest()
+        return filename
+
+    def fail(self, key, error=None):
+        with self.lock:
+            if isinstance(error, dict):
+                self.manifest["failed"][key] = error
+            else:
+                self.manifest["failed"][key] = str(error) if error else "no data returned"
+            self.write_manifest()
+
+    def update(self, key, da, error=None):
+        """
+        update - checkpoints the result of a worker, returns it reopened from local storage or None if it failed
+        """
+        if da is None:
+            self.fail(key, error)
+            return None
+        self.save(key, da)
+        return self.load(key)
+
+    def report(self):
+        failed = self.manifest["failed"]
+        if failed:
+            print(f"{len(failed)} pieces failed, rerun with the same arguments to fetch them: {self.job_dir}")
+            for key, error in failed.items():
+                print(f"  {key}: {error}")
+        return failed
@@ -1,37 +1,111 @@
 import os
 from dask.diagnostics import ProgressBar
-from climate_eed.module_config import CopernicusConfig, SMHIConfig, PlanetaryConfig, SMHIConfig, parse_bbox, parse_collections, parse_dates, parse_query, parse_repository
-from climate_eed.module_copernicus_operations import cds_data_request
-from climate_eed.module_smhi_operations import smhi_data_request
+import xarray as xr
+from climate_eed.module_config import CopernicusConfig, SMHIConfig, PlanetaryConfig, SMHIConfig, parse_bbox, parse_collections, parse_dates, parse_issue_dates, parse_living_labs, parse_models, parse_points, parse_query, parse_repository
+from climate_eed.module_async_operations import planetary_data_request_async, run_or_defer
+from climate_eed.module_cache import CDSCache, TileCache
+from climate_eed.module_ensemble import parse_ensemble_stats
+from climate_eed.module_checkpoint import JobManifest
+from climate_eed.module_geometry import parse_geometry
+from climate_eed.module_regrid import parse_target_grid
+from climate_eed.module_resample import parse_resample
+from climate_eed.module_transform import parse_transform
+from climate_eed.module_copernicus_operations import as_completed_cds_jobs, cds_data_request, load_cds_jobs, submit_cds_job
+from climate_eed.module_smhi_operations import smhi_batch_request, smhi_data_request
 from climate_eed.module_planetary_operations import planetary_data_request, var_list_request
+from climate_eed.module_threads import RetryPolicy
 
 
-def list_repo_vars(repository, collections):
+def list_repo_vars(repository, collections, sample=PlanetaryConfig.DEFAULT_LIST_VARS_SAMPLE):
+    """
+    Lists the variables available in a STAC repository.
+    Args:
+        - repository (str): The STAC repository to list the variables from. Example: "planetary".
+        - collections (str): The collections to list the variables from. Example: "era5-pds".
+        - sample (int): The number of items sampled, the union of their assets is returned. 0 reads the item_assets of the collections instead. Example: 1.
+    Returns:
+        - list: The list of variables available in the STAC repository.
+    """
 
     repository = parse_repository(repository)
     collections = parse_collections(collections)
 
-    var_list = var_list_request(repository, collections)
+    var_list = var_list_request(repository, collections, sample)
     
     return var_list
 
 
-def fetch_var_copernicus(dataset, query, fileout, engine='netcdf4'):
+def fetch_var_copernicus(dataset, query, fileout, engine='netcdf4', split_by=CopernicusConfig.DEFAULT_SPLIT_BY, split_size=CopernicusConfig.DEFAULT_SPLIT_SIZE, max_requests=CopernicusConfig.DEFAULT_MAX_REQUESTS, max_attempts=CopernicusConfig.DEFAULT_MAX_ATTEMPTS, cache_dir=CopernicusConfig.DEFAULT_CACHE_DIR, cache_size=CopernicusConfig.DEFAULT_CACHE_SIZE, chunks=CopernicusConfig.DEFAULT_CHUNKS, zarr_sidecar=CopernicusConfig.DEFAULT_ZARR_SIDECAR, target_grid=None, transform=None):
     """
     Fetches data from the Copernicus Climate Data Store API and returns it as an xarray dataset.
     Args:
         - dataset (str): The dataset to fetch the data from. Example: "seasonal-monthly-single-levels".
         - query (dict): The query to filter the data by. Example: {'format': 'grib','originating_centre': 'ecmwf','system': '5','variable': varname,'product_type': 'monthly_mean','year': years,'month': month,'leadtime_month': leadtime_month}
         - fileout (str): The file to output the data to. Example: "*.grib".
+        - engine (str): The xarray engine used to open fileout. Example: "cfgrib".
+        - split_by (str): If set, the query is split along year, month, leadtime_hour or leadtime_month in sub-requests submitted concurrently. Example: "year".
+        - split_size (int): The number of values of split_by in each sub-request. Example: 1.
+        - max_requests (int): The number of sub-requests queued at the CDS at the same time. Example: 4.
+        - max_attempts (int): The number of times a failed sub-request is submitted again. Example: 3.
+        - cache_dir (str): The directory of the cache of the CDS retrievals, the same query is retrieved only once. Empty (the default) disables the cache. Example: "./cds_cache".
+        - cache_size (int): The maximum size of the cache in bytes, the least recently used files are evicted past it. Example: 21474836480.
+        - chunks (dict): The dask chunks the data is opened with, {} for the chunks of the file, None to open it without dask. Example: {"step": 10}.
+        - zarr_sidecar (bool): If True, fileout is converted once to a chunked <fileout>.zarr store, the next opens read the store.
+        - target_grid (str|list|dict): If set, the data is interpolated bilinearly on this grid, see fetch_var_planetary. Example: "0.25".
+        - transform (str|list|dict): The pipeline applied lazily to the variables, see fetch_var_planetary. Example: {"tp": "deaccumulate|units:m:mm", "t2m": "units:degC"}.
     Returns:
         - xr.Dataset: The data fetched from the Copernicus Climate Data Store API.
     """
-    output_ds = cds_data_request(dataset, query, fileout, engine)
+    cache = CDSCache(cache_dir, cache_size) if cache_dir else None
+    regrid = parse_target_grid(target_grid)
+    transform = parse_transform(transform)
+    output_ds = cds_data_request(dataset, query, fileout, engine, split_by, split_size, max_requests, max_attempts, cache, chunks, zarr_sidecar)
+    if transform is not None and output_ds is not None:
+        output_ds = transform.apply(output_ds)
+    if regrid is not None and output_ds is not None:
+        output_ds = regrid.regrid(output_ds)
     
     return output_ds
 
 
-def fetch_var_smhi(living_lab, data_dir, issue_date, ftp_config=None):
+def submit_var_copernicus(dataset, query, fileout, engine='netcdf4', jobs_dir=CopernicusConfig.DEFAULT_JOBS_DIR, cache_dir=CopernicusConfig.DEFAULT_CACHE_DIR, cache_size=CopernicusConfig.DEFAULT_CACHE_SIZE):
+    """
+    Submits a request to the Copernicus Climate Data Store API without waiting for it.
+    Args:
+        - dataset (str): The dataset to fetch the data from. Example: "seasonal-monthly-single-levels".
+        - query (dict): The query to filter the data by.
+        - fileout (str): The file the data is downloaded to once the request is completed. Example: "*.grib".
+        - engine (str): The xarray engine used to open fileout. Example: "cfgrib".
+        - jobs_dir (str): The directory where the submitted jobs are saved, to reattach to them after a restart.
+        - cache_dir (str): The directory of the cache of the CDS retrievals. Empty (the default) disables the cache.
+        - cache_size (int): The maximum size of the cache in bytes.
+    Returns:
+        - CDSJob: The handle of the job, job.poll() updates its state, job.wait() waits for it and returns the dataset.
+    """
+    cache = CDSCache(cache_dir, cache_size) if cache_dir else None
+    return submit_cds_job(dataset, query, fileout, engine, jobs_dir, cache)
+
+
+def reattach_var_copernicus(jobs_dir=CopernicusConfig.DEFAULT_JOBS_DIR, cache_dir=CopernicusConfig.DEFAULT_CACHE_DIR, cache_size=CopernicusConfig.DEFAULT_CACHE_SIZE):
+    """
+    Returns the CDSJob of the requests submitted (by this or a previous process) and not downloaded yet.
+    """
+    cache = CDSCache(cache_dir, cache_size) if cache_dir else None
+    return load_cds_jobs(jobs_dir, cache)
+
+
+def poll_var_copernicus(jobs, poll_interval=CopernicusConfig.DEFAULT_POLL_INTERVAL, max_workers=CopernicusConfig.DEFAULT_MAX_REQUESTS):
+    """
+    Polls the CDS jobs and yields each of them as soon as it is downloaded (or failed), job.result() opens its data.
+    Args:
+        - jobs (list): The CDSJob to poll, from submit_var_copernicus or reattach_var_copernicus.
+        - poll_interval (int): The seconds between two polls of the pending jobs. Example: 30.
+        - max_workers (int): The number of jobs polled and downloaded at the same time. Example: 4.
+    """
+    return as_completed_cds_jobs(jobs, poll_interval, max_workers)
+
+
+def fetch_var_smhi(living_lab, data_dir, issue_date, ftp_config=None, max_workers=SMHIConfig.DEFAULT_FTP_POOL_SIZE, sync=False, chunks=SMHIConfig.DEFAULT_CHUNKS, target_grid=None, transform=None):
     """
     Fetches data from ftp server and returns it as an xarray dataset.
     Args:
@@ -39,14 +113,62 @@ def fetch_var_smhi(living_lab, data_dir, issue_date, ftp_config=None):
         - data_dir (str): The data directory to fetch the data from. Example: "seasonal_forecast".
         - issue_date (str): The issue date of the data to fetch. Example: "202404".
         - ftp_config (dict): The configuration of the FTP server. Example: {"url": "ftp.smhi.se", "folder": "/climate_data", "user": "user", "passwd": "passwd"}.
+        - max_workers (int): The number of ensemble members downloaded in parallel. Example: 4.
+        - sync (bool): If True, only new or changed members are downloaded (remote size and modification time), partial downloads are resumed and the local files are verified with their md5.
+        - chunks (dict): The dask chunks of each member, the members are opened lazily. Example: {"time": 100}.
+        - target_grid (str|list|dict): If set, the gridded variables are interpolated bilinearly on this grid, see fetch_var_planetary. Example: "0.25".
+        - transform (str|list|dict): The pipeline applied lazily to the variables, see fetch_var_planetary. Example: {"COUT": "scale:86400"}.
     Returns:
-        - xr.Dataset: The data fetched from the FTP server.
+        - xr.Dataset: The data fetched from the FTP server, with a model dimension.
     """
-    output_ds = smhi_data_request(living_lab=living_lab, data_dir=data_dir, issue_date=issue_date, ftp_config=ftp_config)
+    regrid = parse_target_grid(target_grid)
+    transform = parse_transform(transform)
+    output_ds = smhi_data_request(living_lab=living_lab, data_dir=data_dir, issue_date=issue_date, ftp_config=ftp_config, max_workers=max_workers, sync=sync, chunks=chunks)
+    if transform is not None and output_ds is not None:
+        output_ds = transform.apply(output_ds)
+    if regrid is not None and output_ds is not None:
+        output_ds = regrid.regrid(output_ds)
     
     return output_ds
 
 
+def fetch_var_smhi_batch(living_labs, issue_dates, data_dir="seasonal_forecast", ftp_config=None, max_workers=SMHIConfig.DEFAULT_FTP_POOL_SIZE, max_requests=SMHIConfig.DEFAULT_MAX_REQUESTS, sync=False, chunks=SMHIConfig.DEFAULT_CHUNKS, fileout=None, target_grid=None, transform=None):
+    """
+    Fetches data from ftp server for several living labs and issue dates concurrently.
+    Args:
+        - living_labs (list|str): The living labs to fetch the data from. Example: ["georgia", "rhine"] or "georgia,rhine".
+        - issue_dates (list|str): The issue dates of the data to fetch, a list or a range. Example: ["202401", "202402"] or "202401:202412".
+        - data_dir (str): The data directory to fetch the data from. Example: "seasonal_forecast".
+        - ftp_config (dict): The configuration of the FTP server. Example: {"url": "ftp.smhi.se", "folder": "/climate_data", "user": "user", "passwd": "passwd"}.
+        - max_workers (int): The number of FTP sessions shared by all the downloads. Example: 4.
+        - max_requests (int): The number of living labs and issue dates fetched concurrently. Example: 4.
+        - sync (bool): If True, only new or changed members are downloaded.
+        - chunks (dict): The dask chunks of each member. Example: {"time": 100}.
+        - fileout (str): If set, the data is streamed to fileout (.nc or .zarr, one group per living lab and issue date, or .csv). Example: "hindcast.zarr".
+        - target_grid (str|list|dict): If set, the gridded variables are interpolated bilinearly on this grid, see fetch_var_planetary. Example: "0.25".
+        - transform (str|list|dict): The pipeline applied lazily to the variables, see fetch_var_planetary. Example: {"COUT": "scale:86400"}.
+    Returns:
+        - xr.Dataset: The data with living_lab, issue_date and model dimensions, or the content of fileout.
+    """
+    living_labs = parse_living_labs(living_labs)
+    issue_dates = parse_issue_dates(issue_dates)
+    regrid = parse_target_grid(target_grid)
+    transform = parse_transform(transform)
+    output_ds = smhi_batch_request(living_labs=living_labs, issue_dates=issue_dates, data_dir=data_dir, ftp_config=ftp_config, max_workers=max_workers, max_requests=max_requests, sync=sync, chunks=chunks, fileout=fileout)
+    if isinstance(output_ds, xr.DataTree):
+        if transform is not None:
+            output_ds = output_ds.map_over_datasets(transform.apply)
+        if regrid is not None:
+            output_ds = output_ds.map_over_datasets(regrid.regrid)
+    elif isinstance(output_ds, (xr.Dataset, xr.DataArray)):
+        if transform is not None:
+            output_ds = transform.apply(output_ds)
+        if regrid is not None:
+            output_ds = regrid.regrid(output_ds)
+
+    return output_ds
+
+
 def fetch_var_planetary(varname=PlanetaryConfig.DEFAULT_VARNAME, 
          models=PlanetaryConfig.DEFAULT_MODELS,
          factor=PlanetaryConfig.DEFAULT_FACTOR, 
@@ -55,7 +177,27 @@ def fetch_var_planetary(varname=PlanetaryConfig.DEFAULT_VARNAME,
          end_date=PlanetaryConfig.DEFALUT_END_DATE, 
          repository=PlanetaryConfig.DEFAULT_REPOSITORY, 
          collections=PlanetaryConfig.DEFAULT_COLLECTIONS, 
-         query=PlanetaryConfig.DEFAULT_QUERY):
+         query=PlanetaryConfig.DEFAULT_QUERY,
+         max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS,
+         max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST,
+         lazy=PlanetaryConfig.DEFAULT_LAZY,
+         cache_dir=PlanetaryConfig.DEFAULT_CACHE_DIR,
+         cache_size=PlanetaryConfig.DEFAULT_CACHE_SIZE,
+         fileout=PlanetaryConfig.DEFAULT_FILEOUT,
+         checkpoint_dir=PlanetaryConfig.DEFAULT_CHECKPOINT_DIR,
+         max_attempts=PlanetaryConfig.DEFAULT_MAX_ATTEMPTS,
+         backoff=PlanetaryConfig.DEFAULT_BACKOFF,
+         item_timeout=PlanetaryConfig.DEFAULT_ITEM_TIMEOUT,
+         engine=PlanetaryConfig.DEFAULT_ENGINE,
+         max_concurrency=PlanetaryConfig.DEFAULT_MAX_CONCURRENCY,
+         points=PlanetaryConfig.DEFAULT_POINTS,
+         point_method=PlanetaryConfig.DEFAULT_POINT_METHOD,
+         geometry=PlanetaryConfig.DEFAULT_GEOMETRY,
+         aggregate=PlanetaryConfig.DEFAULT_AGGREGATE,
+         resample=PlanetaryConfig.DEFAULT_RESAMPLE,
+         ensemble_stats=PlanetaryConfig.DEFAULT_ENSEMBLE_STATS,
+         target_grid=PlanetaryConfig.DEFAULT_TARGET_GRID,
+         transform=PlanetaryConfig.DEFAULT_TRANSFORM):
     
     """
     Fetches data from a STAC repository and returns it as a pandas dataframe or xarray dataset.
@@ -69,7 +211,31 @@ def fetch_var_planetary(varname=PlanetaryConfig.DEFAULT_VARNAME,
         - repository (str): The STAC repository to fetch the data from. Example: "planetary".
         - collections (str): The collections to fetch the data from. Example: "era5-pds".
         - query (str): The query to filter the data by. Example: {"era5:kind": {"eq": "fc"}}.
-        - fileout (str): The file to output the data to. Example: "*.csv" or "*.nc".
+        - max_workers (int): The maximum number of items downloaded concurrently. Example: 8.
+        - max_per_host (int): The maximum number of concurrent downloads against the same host, 0 for as many as the workers. Example: 4.
+        - lazy (bool): If True, the assets are opened with dask chunks and the result is a dask-backed xr.DataArray, nothing is read until .compute() or .load().
+        - cache_dir (str): The folder of the on-disk tile cache, repeated and overlapping requests are served from it. Example: "./cache". Empty disables the cache.
+        - cache_size (int): The maximum size in bytes of the tile cache, the least recently used tiles are evicted. Example: 10737418240.
+        - fileout (str): The file to output the data to, each item is appended as soon as it is fetched. Example: "*.csv", "*.nc" or "*.zarr".
+        - checkpoint_dir (str): The folder of the job checkpoints, a rerun with the same arguments only fetches the items missing from the previous run. Example: "./checkpoints". Empty disables checkpointing.
+        - max_attempts (int): The number of attempts to download each item, transient network and throttling errors are retried. Example: 5.
+        - backoff (float): The initial delay in seconds between two attempts, doubled at each retry and jittered. Example: 1.0.
+        - item_timeout (float): The timeout in seconds of the connections and reads of an item, a stalled attempt fails and is retried. Example: 300. 0 waits indefinitely.
+        - engine (str): "threads" to fetch the items on a pool of max_workers threads, "async" to fetch them on an asyncio event loop, at most max_concurrency at a time.
+          With engine="async" and an event loop already running the coroutine is returned and must be awaited, see fetch_var_planetary_async.
+        - max_concurrency (int): The maximum number of items read concurrently by the async engine. Example: 64.
+        - points (str|list|dict): If set, only the time series at the points are extracted (bbox is ignored), as a (station, time) array. A list of [lon, lat], a dict {station: [lon, lat]} or "lon,lat;lon,lat". Example: "9.19,45.46;12.49,41.90".
+        - point_method (str): "nearest" reads the grid cell of each point, "linear" interpolates its bilinear neighbourhood. Example: "nearest".
+        - geometry (str|dict): If set, only the bbox of the GeoJSON polygons is read and the cells outside of them are masked (bbox is ignored). A GeoJSON object, its JSON or a .geojson file. Example: "catchment.geojson".
+        - aggregate (bool): If True, the data is averaged over the geometry, weighted by the area of the cells, and returned as a time series.
+        - resample (str): If set, each item is reduced as soon as it is fetched, before the concat, with format <freq>:<statistic>.
+          The statistic is one of mean, sum, max, min, count, median or a percentile like q90. Example: "1D:max" or "MS:mean".
+        - ensemble_stats (str|list): If set, the models of a CMIP6 ensemble are folded into these statistics as they arrive, the result has a statistic dimension in place of model.
+          The statistics are mean, std, var, min, max, count, median or percentiles like q90, the quantiles are approximate. Example: "mean,std,q10,q90".
+        - target_grid (str|list|dict): If set, each item is interpolated bilinearly on this grid as soon as it is fetched, the weights are computed once per grid and cached on disk (ignored with points).
+          A resolution in degrees, min_lon,min_lat,max_lon,max_lat,res, a dict {"lat": [...], "lon": [...]} or a .nc/.zarr file with the grid. Example: "0.25" or "6,36,19,47,0.1".
+        - transform (str|list|dict): The pipeline applied lazily to each item after factor: "|" separated steps scale:<a>, offset:<b>, units:[<from>:]<to>, clip:<min>:<max> and deaccumulate[:<dim>],
+          or a dict (or its JSON) of pipelines by variable name. The elementwise steps run fused in one pass per chunk. The items are de-accumulated along step only, not along time. Example: "units:K:degC" or "deaccumulate|scale:1000|clip:0:".
     Returns:
         - pd.DataFrame or xr.Dataset: The data fetched from the STAC repository."""
 
@@ -78,8 +244,38 @@ def fetch_var_planetary(varname=PlanetaryConfig.DEFAULT_VARNAME,
         start_date, end_date = parse_dates(start_date, end_date)
     collections = parse_collections(collections)
     bbox = parse_bbox(bbox)
+    models = parse_models(models)
+    points = parse_points(points, point_method)
+    geometry = parse_geometry(geometry, aggregate)
+    resample = parse_resample(resample)
+    ensemble_stats = parse_ensemble_stats(ensemble_stats)
+    regrid = parse_target_grid(target_grid) if not points else None
+    transform = parse_transform(transform, factor)
     repository = parse_repository(repository)
+    cache = TileCache(cache_dir, cache_size) if cache_dir else None
+    retry = RetryPolicy(max_attempts=max_attempts, backoff=backoff)
+    manifest = None
+    if checkpoint_dir:
+        job_args = {"varname": varname, "models": models, "factor": factor, "bbox": bbox, "start_date": start_date, "end_date": end_date, "repository": repository, "collections": collections, "query": query, "points": points, "geometry": geometry["key"] if geometry else None, "aggregate": aggregate, "resample": str(resample) if resample else None, "target_grid": str(regrid) if regrid else None, "transform": str(transform) if transform else None}
+        manifest = JobManifest(checkpoint_dir, job_args, lazy)
+
+    # the options shared by the threads and the async engines
+    options = {"max_per_host": max_per_host, "lazy": lazy, "cache": cache, "fileout": fileout, "manifest": manifest, "retry": retry, "timeout": item_timeout, "points": points, "geometry": geometry, "resample": resample, "ensemble_stats": ensemble_stats, "regrid": regrid, "transform": transform}
+    if engine == "async":
+        return run_or_defer(planetary_data_request_async(varname, models, factor, bbox, start_date, end_date, repository, collections, query, max_concurrency=max_concurrency, **options))
 
-    output_ds = planetary_data_request(varname, models, factor, bbox, start_date, end_date, repository, collections, query)
+    output_ds = planetary_data_request(varname, models, factor, bbox, start_date, end_date, repository, collections, query, max_workers=max_workers, **options)
             
-    return output_ds
\ No newline at end of file
+    return output_ds
+
+
+async def fetch_var_planetary_async(**kwargs):
+    """
+    Fetches data from a STAC repository on the running asyncio event loop. Example: data = await fetch_var_planetary_async(varname="tasmax", ...).
+    Args:
+        - the arguments of fetch_var_planetary, engine is always "async".
+    Returns:
+        - xr.DataArray: The data fetched from the STAC repository.
+    """
+    kwargs["engine"] = "async"
+    return await fetch_var_planetary(**kwargs)
\ No newline at end of file
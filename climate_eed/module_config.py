@@ -3,10 +3,15 @@ from datetime import datetime
 import json
 import os
 
+import pandas as pd
+
 from dotenv import find_dotenv, load_dotenv
 
 load_dotenv(find_dotenv())
 
+# per user, the shared temporary folder can be created (and written) by any other user
+USER_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "climate_eed")
+
 class PlanetaryConfig:
     DEFAULT_VARNAME = ""
     DEFAULT_MODELS = ""
@@ -21,6 +26,35 @@ class PlanetaryConfig:
     DEFAULT_VERSION = False
     DEFAULT_LIST_VARS = False
     DEFAULT_LIST_REPOS = False
+    DEFAULT_LIST_VARS_SAMPLE = 1
+    DEFAULT_MAX_WORKERS = 8
+    # 0 lets every worker read from the same host
+    DEFAULT_MAX_PER_HOST = 0
+    DEFAULT_MAX_CONCURRENCY = 64
+    DEFAULT_ENGINE = "threads"
+    DEFAULT_LAZY = False
+    DEFAULT_MAX_ATTEMPTS = 5
+    DEFAULT_BACKOFF = 1.0
+    DEFAULT_MAX_BACKOFF = 60
+    DEFAULT_JITTER = 0.5
+    DEFAULT_ITEM_TIMEOUT = 0
+    DEFAULT_CACHE_DIR = ""
+    DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+    DEFAULT_CHECKPOINT_DIR = ""
+    # per user, the SAS tokens kept there are credentials
+    DEFAULT_STAC_CACHE_DIR = os.path.join(USER_CACHE_DIR, "stac")
+    DEFAULT_STAC_CACHE_TTL = 3600
+    DEFAULT_POINTS = ""
+    DEFAULT_POINT_METHOD = "nearest"
+    DEFAULT_GEOMETRY = ""
+    DEFAULT_AGGREGATE = False
+    DEFAULT_RESAMPLE = ""
+    DEFAULT_ENSEMBLE_STATS = ""
+    DEFAULT_ENSEMBLE_BLOCK_SIZE = 1048576
+    DEFAULT_TARGET_GRID = ""
+    DEFAULT_TRANSFORM = ""
+    # per user, the weights are read back as they are
+    DEFAULT_REGRID_DIR = os.path.join(USER_CACHE_DIR, "regrid")
 
 class CopernicusConfig:
     DEFAULT_VARNAME = ""
@@ -32,6 +66,20 @@ class CopernicusConfig:
     DEFAULT_LEADTIME_MONTH = ""
     DEFAULT_FILE_GRIB = "data.grib"
     DEFAULT_VERSION = False
+    DEFAULT_SPLIT_BY = ""
+    DEFAULT_SPLIT_SIZE = 1
+    DEFAULT_MAX_REQUESTS = 4
+    DEFAULT_MAX_ATTEMPTS = 3
+    DEFAULT_BACKOFF = 10
+    # the cache is opt-in, like the tile cache: set a cache_dir, it holds at most cache_size bytes
+    DEFAULT_CACHE_DIR = ""
+    DEFAULT_CACHE_SIZE = 20 * 1024 ** 3
+    # per user, a reattach downloads every pending job of the folder
+    DEFAULT_JOBS_DIR = os.path.join(USER_CACHE_DIR, "cds_jobs")
+    DEFAULT_POLL_INTERVAL = 30
+    DEFAULT_CHUNKS = {}
+    DEFAULT_ZARR_SIDECAR = False
+    DEFAULT_INDEX_DIR = os.path.join(USER_CACHE_DIR, "cfgrib")
 
 
 class SMHIConfig:
@@ -40,6 +88,12 @@ class SMHIConfig:
     FTP_USER = os.environ.get("FTP_USER")
     FTP_PASS = os.environ.get("FTP_PASS")
     FTP_DIR = os.environ.get("FTP_DIR")
+    DEFAULT_FTP_POOL_SIZE = 4
+    DEFAULT_FTP_POOL_TIMEOUT = 300
+    DEFAULT_FTP_READ_TIMEOUT = 60
+    DEFAULT_MAX_ATTEMPTS = 3
+    DEFAULT_CHUNKS = {}
+    DEFAULT_MAX_REQUESTS = 4
 
 def parse_query(query):
     if isinstance(query, str):
@@ -82,6 +136,61 @@ def parse_bbox(bbox):
         bbox = [float(x) for x in bbox.split(",")]
     return bbox
 
+def parse_models(models):
+    if not models:
+        models = None
+    elif isinstance(models, str):
+        models = [str(x).strip() for x in models.split(",")]
+    else:
+        models = [str(x) for x in models]
+    return models
+
+def parse_living_labs(living_labs):
+    if isinstance(living_labs, str):
+        living_labs = [str(x).strip() for x in living_labs.split(",")]
+    else:
+        living_labs = [str(x) for x in living_labs]
+    return living_labs
+
+def parse_issue_dates(issue_dates):
+    """
+    Returns the issue dates (YYYYMM) of a list, of a comma separated string or of a range "202401:202406".
+    """
+    if isinstance(issue_dates, str):
+        if ":" in issue_dates:
+            start, end = issue_dates.split(":")
+            periods = pd.period_range(pd.Period(start.strip(), freq="M"), pd.Period(end.strip(), freq="M"), freq="M")
+            return [period.strftime("%Y%m") for period in periods]
+        issue_dates = issue_dates.split(",")
+    return [str(x).strip() for x in issue_dates]
+
+def parse_points(points, method=PlanetaryConfig.DEFAULT_POINT_METHOD):
+    """
+    Returns the stations and coordinates of the points, None if there are no points.
+    The points are a list of [lon, lat], a dict {station: [lon, lat]}, their JSON
+    or a string "lon,lat;lon,lat". Example: "9.19,45.46;12.49,41.90".
+    """
+    if not points:
+        return None
+    if isinstance(points, str):
+        try:
+            points = json.loads(points)
+        except json.JSONDecodeError:
+            points = [point.split(",") for point in points.split(";") if point.strip()]
+    if isinstance(points, dict):
+        stations = [str(station) for station in points]
+        points = list(points.values())
+    else:
+        stations = list(range(len(points)))
+    if method not in ("nearest", "linear"):
+        raise ValueError(f"Unsupported point method: {method}, must be nearest or linear")
+    return {
+        "station": stations,
+        "lon": [float(point[0]) for point in points],
+        "lat": [float(point[1]) for point in points],
+        "method": method,
+    }
+
 def parse_collections(collections):
     if isinstance(collections, list):
         collections = [str(x) for x in collections]
@@ -1,13 +1,162 @@
 import cdsapi
+import json
 import os
+import shutil
+import time
 from dotenv import load_dotenv, find_dotenv
 import xarray as xr
 
+from climate_eed.filesystem import justext, justpath, juststem, md5text, mkdirs, remove
+from climate_eed.module_cache import canonical_query
+from climate_eed.module_config import CopernicusConfig
+from climate_eed.module_threads import RETRYABLE_STATUS, BoundedExecutor, RetryPolicy, ThreadReturn, error_status
+
 # Disable warnings for data download via API
-import urllib3 
+import urllib3
 urllib3.disable_warnings()
 
-def cds_data_request(dataset, query, fileout, engine='netcdf4'):
+SPLIT_KEYS = ("year", "month", "leadtime_hour", "leadtime_month")
+INVALID_MESSAGES = ("not valid", "invalid", "no data", "not found")
+
+
+class CDSRetryPolicy(RetryPolicy):
+    def is_retryable(self, error):
+        """
+        is_retryable - the CDS reports failed jobs as plain exceptions, all of them are retried but the invalid requests
+        and the HTTP errors that are not transient (an unknown request_id is a 404)
+        """
+        status = error_status(error)
+        if status is not None:
+            return status in RETRYABLE_STATUS
+        if isinstance(error, (KeyError, ValueError, TypeError)):
+            return False
+        return not any(text in str(error).lower() for text in INVALID_MESSAGES)
+
+
+def get_cds_client(**kwargs):
+    load_dotenv(find_dotenv())
+
+    URL = 'https://cds.climate.copernicus.eu/api/v2'
+    KEY = os.environ.get('CDSAPI_KEY')
+
+    return cdsapi.Client(url=URL, key=KEY, **kwargs)
+
+
+def get_cds_jobs_client():
+    """
+    Returns the client of the asynchronous jobs: submitting without waiting and reattaching to a request_id
+    rely on cdsapi.api.Result, which only the legacy client (a UID:KEY key) has. With a personal access token
+    cdsapi returns the client of ecmwf-datastores instead, that has no Result: use cds_data_request then.
+    """
+    client = get_cds_client(wait_until_complete=False, delete=False)
+    if type(client) is not cdsapi.api.Client:
+        raise RuntimeError("The asynchronous CDS jobs need the legacy cdsapi client (CDSAPI_KEY in the UID:KEY format), use cds_data_request with a personal access token")
+    return client
+
+
+def split_query(query, split_by, split_size=CopernicusConfig.DEFAULT_SPLIT_SIZE):
+    """
+    Splits the query in sub-queries of split_size values of the split_by key.
+    Args:
+        - query (dict): The CDS query. Example: {'year': ['1993', '1994'], 'month': '05', ...}.
+        - split_by (str): The key to split along, one of year, month, leadtime_hour, leadtime_month. Example: "year".
+        - split_size (int): The number of values of each sub-query. Example: 1.
+    Returns:
+        - list: The sub-queries, the query itself if there is nothing to split.
+    """
+    if not split_by:
+        return [query]
+    if split_by not in SPLIT_KEYS:
+        raise ValueError(f"Unsupported split_by: {split_by}, must be one of {', '.join(SPLIT_KEYS)}")
+    values = query.get(split_by)
+    if not isinstance(values, (list, tuple)) or len(values) <= split_size:
+        return [query]
+    return [{**query, split_by: list(values[i:i + split_size])} for i in range(0, len(values), split_size)]
+
+
+def part_filename(fileout, n, dataset, query):
+    """
+    Returns the file of the n-th part of fileout, named after the dataset and the query of the part,
+    so that a part left behind by a run with another query is never taken for this one.
+    """
+    key = md5text(json.dumps([dataset, canonical_query(query)]))
+    return os.path.join(justpath(fileout), f"{juststem(fileout)}.part{n:03d}.{key}.{justext(fileout)}")
+
+
+def retrieve(dataset, query, fileout, cache=None):
+    """
+    Retrieves the query from the cache or from the CDS, the file appears only once it is complete.
+    """
+    if cache is not None and cache.get(dataset, query, fileout):
+        return fileout
+    tmp_file = f"{fileout}.tmp"
+    get_cds_client().retrieve(dataset, query, tmp_file)
+    os.replace(tmp_file, fileout)
+    if cache is not None:
+        cache.put(dataset, query, fileout)
+    return fileout
+
+
+def open_cds_output(fileout, engine='netcdf4', chunks=CopernicusConfig.DEFAULT_CHUNKS, zarr_sidecar=CopernicusConfig.DEFAULT_ZARR_SIDECAR):
+    """
+    Opens a file retrieved from the CDS lazily, in dask chunks.
+    The cfgrib index of a GRIB file is kept in CopernicusConfig.DEFAULT_INDEX_DIR, so it is built once per file.
+    Args:
+        - fileout (str): The file retrieved from the CDS. Example: "data.grib".
+        - engine (str): The xarray engine used to open it. Example: "cfgrib".
+        - chunks (dict): The dask chunks, {} for the chunks of the file, None to open it without dask. Example: {"step": 10}.
+        - zarr_sidecar (bool): If True, the file is converted once to <fileout>.zarr with these chunks and the next opens read the Zarr store.
+    Returns:
+        - xr.Dataset: The data of the file.
+    """
+    sidecar = f"{fileout}.zarr"
+    if zarr_sidecar and os.path.isdir(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(fileout):
+        return xr.open_zarr(sidecar, chunks=chunks if chunks is not None else {})
+
+    backend_kwargs = None
+    if engine == "cfgrib":
+        mkdirs(CopernicusConfig.DEFAULT_INDEX_DIR)
+        backend_kwargs = {"indexpath": os.path.join(CopernicusConfig.DEFAULT_INDEX_DIR, f"{md5text(os.path.abspath(fileout))}.{{short_hash}}.idx")}
+    output_ds = xr.open_dataset(f'{fileout}', engine=engine, chunks=chunks, backend_kwargs=backend_kwargs)
+
+    if zarr_sidecar:
+        tmp_sidecar = f"{sidecar}.tmp"
+        if os.path.isdir(tmp_sidecar):
+            shutil.rmtree(tmp_sidecar)
+        output_ds.drop_encoding().to_zarr(tmp_sidecar, mode="w")
+        output_ds.close()
+        if os.path.isdir(sidecar):
+            shutil.rmtree(sidecar)
+        os.replace(tmp_sidecar, sidecar)
+        return xr.open_zarr(sidecar, chunks=chunks if chunks is not None else {})
+    return output_ds
+
+
+def merge_parts(parts, fileout, engine):
+    """
+    Merges the parts in fileout: GRIB messages are concatenated as they are, NetCDF parts are combined along their coordinates.
+    The parts are deleted only once fileout is complete, a failed merge leaves them for the next run.
+    """
+    tmp_file = f"{fileout}.tmp"
+    if engine == "cfgrib":
+        with open(tmp_file, "wb") as stream:
+            for part in parts:
+                with open(part, "rb") as part_stream:
+                    shutil.copyfileobj(part_stream, stream)
+    else:
+        datasets = [xr.open_dataset(part, engine=engine, chunks={}) for part in parts]
+        try:
+            output_ds = xr.combine_by_coords(datasets, combine_attrs="drop_conflicts")
+            output_ds.to_netcdf(tmp_file)
+        finally:
+            for ds in datasets:
+                ds.close()
+    os.replace(tmp_file, fileout)
+    for part in parts:
+        remove(part)
+
+
+def cds_data_request(dataset, query, fileout, engine='netcdf4', split_by=CopernicusConfig.DEFAULT_SPLIT_BY, split_size=CopernicusConfig.DEFAULT_SPLIT_SIZE, max_requests=CopernicusConfig.DEFAULT_MAX_REQUESTS, max_attempts=CopernicusConfig.DEFAULT_MAX_ATTEMPTS, cache=None, chunks=CopernicusConfig.DEFAULT_CHUNKS, zarr_sidecar=CopernicusConfig.DEFAULT_ZARR_SIDECAR):
     """
     Fetches data from the Copernicus Climate Data Store API and returns it as an xarray dataset.
     Args:
@@ -18,15 +167,18 @@ def cds_data_request(dataset, query, fileout, engine='netcdf4'):
         - month (str): The month of the data to fetch. Example: "05".
         - leadtime_month (str): The leadtime month of the data to fetch. Example: ['1', '2', '3', '4', '5', '6'].
         - file_grib (str): The file to output the data to. Example: "*.grib".
+        - split_by (str): If set, the query is split along year, month, leadtime_hour or leadtime_month. Example: "year".
+        - split_size (int): The number of values of split_by in each sub-request. Example: 1.
+        - max_requests (int): The number of sub-requests queued at the CDS at the same time. Example: 4.
+        - max_attempts (int): The number of times a failed sub-request is submitted again. Example: 3.
+        - cache (CDSCache): If set, the requests (and sub-requests) already retrieved are served from the cache.
+        - chunks (dict): The dask chunks the output is opened with. Example: {"step": 10}.
+        - zarr_sidecar (bool): If True, the output is converted once to a chunked <fileout>.zarr, read by the next opens.
     Returns:
         - xr.Dataset: The data fetched from the Copernicus Climate Data Store API.
     """
     output_ds = None
 
-    load_dotenv(find_dotenv())
-
-    URL = 'https://cds.climate.copernicus.eu/api/v2'
-    KEY = os.environ.get('CDSAPI_KEY')
     # DATADIR = './test_data/seasonal'
     # {
     #     'format': 'grib',
@@ -39,14 +191,167 @@ def cds_data_request(dataset, query, fileout, engine='netcdf4'):
     #     'leadtime_month': leadtime_month,
     # }
 
-    c = cdsapi.Client(url=URL, key=KEY)
+    queries = split_query(query, split_by, split_size)
+
+    if cache is not None and cache.get(dataset, query, fileout):
+        print(f"Served from the cache: {fileout}")
+    elif len(queries) == 1:
+        # Hindcast data request
+        retrieve(
+            dataset,    # 'seasonal-monthly-single-levels',
+            query,
+            fileout,
+            cache)
+    else:
+        parts = [part_filename(fileout, n, dataset, part_query) for n, part_query in enumerate(queries)]
+        retry = CDSRetryPolicy(max_attempts=max_attempts, backoff=CopernicusConfig.DEFAULT_BACKOFF)
+        with BoundedExecutor(max_workers=max_requests) as executor:
+            for part, part_query in zip(parts, queries):
+                # the parts completed by a previous run are not requested again
+                if not os.path.isfile(part):
+                    executor.submit(ThreadReturn(target=retrieve, kwargs={"dataset": dataset, "query": part_query, "fileout": part, "cache": cache}, retry=retry))
+            for _ in executor.as_completed():
+                pass
+        missing = [part_query[split_by] for part, part_query in zip(parts, queries) if not os.path.isfile(part)]
+        if missing:
+            raise RuntimeError(f"{len(missing)} of {len(queries)} sub-requests failed ({split_by}: {missing}), rerun to fetch only them")
+        merge_parts(parts, fileout, engine)
+
+    output_ds = open_cds_output(fileout, engine, chunks, zarr_sidecar)
 
-    # Hindcast data request
-    c.retrieve(
-        dataset,    # 'seasonal-monthly-single-levels',
-        query,
-        fileout)
-    
-    output_ds = xr.open_dataset(f'{fileout}', engine=engine)
-    
     return output_ds
+
+
+class CDSJob:
+    def __init__(self, dataset, query, fileout, engine='netcdf4', request_id=None, state="queued", error=None, jobs_dir=CopernicusConfig.DEFAULT_JOBS_DIR, cache=None):
+        """
+        CDSJob - handle of a request submitted to the CDS without waiting for it. The job is saved in jobs_dir
+        as <request_id>.json, so that another process can reattach to it with CDSJob.load and download it,
+        fileout is saved as an absolute path since that process may run from another folder
+        """
+        self.dataset = dataset
+        self.query = query
+        self.fileout = os.path.abspath(fileout)
+        self.engine = engine
+        self.request_id = request_id
+        self.state = state
+        self.error = error
+        self.jobs_dir = jobs_dir
+        self.cache = cache
+
+    @property
+    def job_file(self):
+        return os.path.join(self.jobs_dir, f"{self.request_id}.json") if self.request_id else None
+
+    def save(self):
+        if not self.job_file:
+            return
+        mkdirs(self.jobs_dir)
+        tmp_file = f"{self.job_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as stream:
+            json.dump({"dataset": self.dataset, "query": self.query, "fileout": self.fileout, "engine": self.engine, "request_id": self.request_id, "state": self.state, "error": self.error}, stream, indent=2)
+        os.replace(tmp_file, self.job_file)
+
+    @classmethod
+    def load(cls, job_file, cache=None):
+        with open(job_file, "r", encoding="utf-8") as stream:
+            job = json.load(stream)
+        return cls(jobs_dir=os.path.dirname(job_file), cache=cache, **job)
+
+    def done(self):
+        return self.state in ("completed", "failed")
+
+    def fail(self, error):
+        """
+        fail - marks the job failed with the error, once the CDS cannot be asked its state any more (an unknown request_id)
+        """
+        self.state = "failed"
+        self.error = str(error)
+        self.save()
+        return self.state
+
+    def poll(self):
+        """
+        poll - asks the CDS the state of the job and downloads fileout once it is completed, returns the state
+        """
+        if self.done():
+            return self.state
+        result = cdsapi.api.Result(get_cds_jobs_client(), {"request_id": self.request_id})
+        result.update()
+        reply = result.reply
+        if reply["state"] == "completed":
+            tmp_file = f"{self.fileout}.tmp"
+            result.download(tmp_file)
+            os.replace(tmp_file, self.fileout)
+            if self.cache is not None:
+                self.cache.put(self.dataset, self.query, self.fileout)
+            result.delete()
+        elif reply["state"] == "failed":
+            self.error = reply.get("error", {}).get("message", "failed")
+        self.state = reply["state"]
+        self.save()
+        return self.state
+
+    def wait(self, poll_interval=CopernicusConfig.DEFAULT_POLL_INTERVAL):
+        while self.poll() not in ("completed", "failed"):
+            time.sleep(poll_interval)
+        return self.result()
+
+    def result(self, chunks=CopernicusConfig.DEFAULT_CHUNKS, zarr_sidecar=CopernicusConfig.DEFAULT_ZARR_SIDECAR):
+        """
+        result - opens fileout lazily (see open_cds_output), raises if the job failed or is not completed yet
+        """
+        if self.state == "failed":
+            raise RuntimeError(f"CDS request {self.request_id} failed: {self.error}")
+        if self.state != "completed":
+            raise RuntimeError(f"CDS request {self.request_id} is {self.state}")
+        return open_cds_output(self.fileout, self.engine, chunks, zarr_sidecar)
+
+    def __repr__(self):
+        return f"CDSJob(request_id={self.request_id}, state={self.state}, fileout={self.fileout})"
+
+
+def submit_cds_job(dataset, query, fileout, engine='netcdf4', jobs_dir=CopernicusConfig.DEFAULT_JOBS_DIR, cache=None):
+    """
+    Submits the request to the CDS and returns its CDSJob as soon as it is queued, already completed if the request is in the cache.
+    """
+    if cache is not None and cache.get(dataset, query, fileout):
+        return CDSJob(dataset, query, fileout, engine, state="completed", jobs_dir=jobs_dir, cache=cache)
+    result = get_cds_jobs_client().retrieve(dataset, query)
+    job = CDSJob(dataset, query, fileout, engine, request_id=result.reply["request_id"], state=result.reply.get("state", "queued"), jobs_dir=jobs_dir, cache=cache)
+    job.save()
+    return job
+
+
+def load_cds_jobs(jobs_dir=CopernicusConfig.DEFAULT_JOBS_DIR, cache=None):
+    """
+    Reattaches to the jobs saved in jobs_dir that were not downloaded yet, by this or a previous process.
+    """
+    if not os.path.isdir(jobs_dir):
+        return []
+    jobs = [CDSJob.load(os.path.join(jobs_dir, filename), cache) for filename in sorted(os.listdir(jobs_dir)) if filename.endswith(".json")]
+    return [job for job in jobs if not job.done()]
+
+
+def as_completed_cds_jobs(jobs, poll_interval=CopernicusConfig.DEFAULT_POLL_INTERVAL, max_workers=CopernicusConfig.DEFAULT_MAX_REQUESTS):
+    """
+    Polls the jobs, max_workers at a time, and yields each of them as soon as it is completed (downloaded) or failed.
+    A job that cannot be polled any more (a non retryable error, like an unknown request_id) is marked failed,
+    the transient errors are polled again at the next round.
+    """
+    pending = list(jobs)
+    while pending:
+        with BoundedExecutor(max_workers=max_workers) as executor:
+            threads = {}
+            for job in pending:
+                thread = ThreadReturn(target=job.poll, retry=CDSRetryPolicy(max_attempts=CopernicusConfig.DEFAULT_MAX_ATTEMPTS))
+                threads[thread] = job
+                executor.submit(thread)
+            for thread in executor.as_completed():
+                if thread.error is not None and not thread.retry.is_retryable(thread.error):
+                    threads[thread].fail(thread.error)
+        for job in [job for job in pending if job.done()]:
+            pending.remove(job)
+            yield job
+        if pending:
+            time.sleep(poll_interval)
@@ -0,0 +1,185 @@
+import numpy as np
+import xarray as xr
+
+from climate_eed.module_config import PlanetaryConfig
+
+
+STATISTICS = ("mean", "std", "var", "min", "max", "count")
+
+
+def quantile_of(statistic):
+    """
+    Returns the quantile of a statistic like median or q90, None for the other statistics.
+    """
+    if statistic == "median":
+        return 0.5
+    if statistic[:1] in ("q", "p") and statistic[1:].replace(".", "", 1).isdigit():
+        return float(statistic[1:]) / 100
+    return None
+
+
+def parse_ensemble_stats(statistics):
+    """
+    Returns the list of ensemble statistics of a list or of a comma separated string, None if there are none.
+    Example: "mean,std,q10,q90".
+    """
+    if not statistics:
+        return None
+    if isinstance(statistics, str):
+        statistics = statistics.split(",")
+    statistics = [str(statistic).strip() for statistic in statistics]
+    for statistic in statistics:
+        if statistic not in STATISTICS and quantile_of(statistic) is None:
+            raise ValueError(f"Unsupported ensemble statistic: {statistic}, must be one of {', '.join(STATISTICS)}, median or a percentile like q90")
+    return statistics
+
+
+def tail_sizes(quantiles, members):
+    """
+    Returns the number of smallest and of largest members per cell the quantiles are interpolated from.
+    Each quantile of n members needs the order statistics k = floor(q * (n - 1)) and k + 1, kept from
+    the cheapest tail: the k + 2 smallest or the n - k largest members.
+    """
+    lower, upper = 0, 0
+    for q in quantiles:
+        k = int(np.floor(q * (members - 1)))
+        if k + 2 <= members - k:
+            lower = max(lower, min(k + 2, members))
+        else:
+            upper = max(upper, members - k)
+    return lower, upper
+
+
+class EnsembleStatistics:
+    def __init__(self, statistics, members=None, block_size=PlanetaryConfig.DEFAULT_ENSEMBLE_BLOCK_SIZE):
+        """
+        EnsembleStatistics - folds the ensemble members one at a time into running accumulators, a block of
+        block_size cells at a time: count, mean and variance (Welford), min and max, stored as float32.
+        The quantiles are exact: for each cell only the smallest (or the largest) members needed by the quantiles
+        of an ensemble of members models are kept, sorted, at most members / 2 + 2 values for the median.
+        """
+        self.statistics = statistics
+        self.quantiles = [quantile_of(statistic) for statistic in statistics if quantile_of(statistic) is not None]
+        if self.quantiles and not members:
+            raise ValueError("The number of members of the ensemble is required to compute its quantiles")
+        self.members = members
+        self.block_size = block_size
+        self.lower_size, self.upper_size = tail_sizes(self.quantiles, members) if self.quantiles else (0, 0)
+        self.grid = None
+        self.name = None
+        self.attrs = {}
+
+    def start(self, da):
+        self.grid = da.coords.to_dataset()
+        self.dims = da.dims
+        self.shape = da.shape
+        self.name = da.name
+        self.attrs = da.attrs
+        cells = int(np.prod(self.shape))
+        self.count = np.zeros(cells, dtype=np.uint16)
+        self.mean = np.zeros(cells, dtype=np.float32)
+        self.m2 = np.zeros(cells, dtype=np.float32)
+        self.min = np.full(cells, np.inf, dtype=np.float32)
+        self.max = np.full(cells, -np.inf, dtype=np.float32)
+        # the smallest members in ascending order and the largest in descending order, the missing ones are +inf and -inf
+        self.lower = np.full((self.lower_size, cells), np.inf, dtype=np.float32)
+        self.upper = np.full((self.upper_size, cells), -np.inf, dtype=np.float32)
+
+    def blocks(self, da):
+        """
+        Yields the (flat slice, values) of the blocks of about block_size cells of the member, read one at a time.
+        """
+        if not self.dims:
+            yield slice(0, 1), np.asarray(da.values, dtype=np.float64).reshape(-1)
+            return
+        row = int(np.prod(self.shape[1:]))
+        rows = max(1, self.block_size // max(row, 1))
+        for start in range(0, self.shape[0], rows):
+            stop = min(start + rows, self.shape[0])
+            values = np.asarray(da.isel({self.dims[0]: slice(start, stop)}).values, dtype=np.float64).reshape(-1)
+            yield slice(start * row, stop * row), values
+
+    def add(self, da):
+        """
+        add - folds one member in the accumulators, aligned on the grid of the first member
+        """
+        da = da.drop_vars("model", errors="ignore")
+        if self.grid is None:
+            self.start(da)
+        else:
+            da = da.reindex_like(self.grid).transpose(*self.dims)
+        for cells, values in self.blocks(da):
+            valid = ~np.isnan(values)
+            x = np.where(valid, values, 0.0)
+            count = self.count[cells] + valid
+            mean = self.mean[cells].astype(np.float64)
+            delta = np.where(valid, x - mean, 0.0)
+            mean += delta / np.maximum(count, 1)
+            self.m2[cells] += np.where(valid, delta * (x - mean), 0.0).astype(np.float32)
+            self.mean[cells] = mean
+            self.count[cells] = count
+            self.min[cells] = np.where(valid, np.minimum(self.min[cells], x), self.min[cells])
+            self.max[cells] = np.where(valid, np.maximum(self.max[cells], x), self.max[cells])
+            # insert the member in the sorted tails, one compare and swap per kept value
+            smaller = np.where(valid, values, np.inf).astype(np.float32)
+            for i in range(self.lower_size):
+                kept = self.lower[i, cells]
+                self.lower[i, cells], smaller = np.minimum(kept, smaller), np.maximum(kept, smaller)
+            larger = np.where(valid, values, -np.inf).astype(np.float32)
+            for i in range(self.upper_size):
+                kept = self.upper[i, cells]
+                self.upper[i, cells], larger = np.maximum(kept, larger), np.minimum(kept, larger)
+
+    def order_statistic(self, rank, count, cells):
+        # the rank-th smallest member (0 based) of each cell, from the tail that holds it
+        from_lower = rank < self.lower_size
+        lower = np.take_along_axis(self.lower[:, cells], np.clip(rank, 0, max(self.lower_size - 1, 0))[None], axis=0)[0] if self.lower_size else np.nan
+        upper_rank = count.astype(np.int64) - 1 - rank
+        upper = np.take_along_axis(self.upper[:, cells], np.clip(upper_rank, 0, max(self.upper_size - 1, 0))[None], axis=0)[0] if self.upper_size else np.nan
+        return np.where(from_lower, lower, upper)
+
+    def quantile(self, q, cells):
+        count = self.count[cells]
+        position = q * np.maximum(count.astype(np.float64) - 1, 0)
+        rank = np.floor(position).astype(np.int64)
+        lower = self.order_statistic(rank, count, cells)
+        upper = self.order_statistic(np.minimum(rank + 1, np.maximum(count.astype(np.int64) - 1, 0)), count, cells)
+        # interpolated between the closest members, as numpy.quantile
+        with np.errstate(invalid="ignore"):
+            return np.where(count > 0, lower + (position - rank) * (upper - lower), np.nan)
+
+    def result(self):
+        """
+        result - the ensemble statistics as an array with a statistic dimension, None if no member was added
+        """
+        if self.grid is None:
+            return None
+        output = np.empty((len(self.statistics), self.count.size), dtype=np.float32)
+        for start in range(0, self.count.size, self.block_size):
+            cells = slice(start, min(start + self.block_size, self.count.size))
+            count = self.count[cells]
+            empty = count == 0
+            variance = np.where(empty, np.nan, self.m2[cells] / np.maximum(count, 1))
+            for index, statistic in enumerate(self.statistics):
+                if statistic == "mean":
+                    output[index, cells] = np.where(empty, np.nan, self.mean[cells])
+                elif statistic == "var":
+                    output[index, cells] = variance
+                elif statistic == "std":
+                    output[index, cells] = np.sqrt(variance)
+                elif statistic == "min":
+                    output[index, cells] = np.where(empty, np.nan, self.min[cells])
+                elif statistic == "max":
+                    output[index, cells] = np.where(empty, np.nan, self.max[cells])
+                elif statistic == "count":
+                    output[index, cells] = count
+                else:
+                    output[index, cells] = self.quantile(quantile_of(statistic), cells)
+        output_ds = xr.DataArray(
+            output.reshape((len(self.statistics),) + tuple(self.shape)),
+            dims=("statistic",) + tuple(self.dims),
+            coords={"statistic": list(self.statistics), **self.grid.coords},
+            name=self.name,
+            attrs=self.attrs,
+        )
+        return output_ds
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+
+import numpy as np
+import xarray as xr
+
+from climate_eed.filesystem import md5text
+from climate_eed.module_cache import subset_bbox
+
+
+MASK_CACHE = {}
+MASK_CACHE_LOCK = threading.Lock()
+MASK_CACHE_SIZE = 64
+
+
+def geojson_polygons(geojson):
+    """
+    Returns the polygons of a GeoJSON object, each as a list of rings of [lon, lat] vertices.
+    """
+    kind = geojson.get("type")
+    if kind == "FeatureCollection":
+        return [polygon for feature in geojson["features"] for polygon in geojson_polygons(feature)]
+    if kind == "Feature":
+        return geojson_polygons(geojson["geometry"])
+    if kind == "GeometryCollection":
+        return [polygon for geometry in geojson["geometries"] for polygon in geojson_polygons(geometry)]
+    if kind == "Polygon":
+        return [geojson["coordinates"]]
+    if kind == "MultiPolygon":
+        return list(geojson["coordinates"])
+    raise ValueError(f"Unsupported geometry type: {kind}, must be a Polygon or MultiPolygon")
+
+
+def parse_geometry(geometry, aggregate=False):
+    """
+    Returns the polygons of a GeoJSON geometry, None if there is no geometry.
+    Args:
+        - geometry (str|dict): A GeoJSON object (Polygon, MultiPolygon, Feature or FeatureCollection), its JSON or the path of a .geojson file.
+        - aggregate (bool): If True, the loaders return the area-weighted mean over the polygons instead of the masked grid.
+    Returns:
+        - dict: The polygons (lists of rings as numpy arrays), their bbox [min_lon, min_lat, max_lon, max_lat], a key identifying them and aggregate.
+    """
+    if not geometry:
+        return None
+    if isinstance(geometry, str):
+        if os.path.isfile(geometry):
+            with open(geometry, "r", encoding="utf-8") as stream:
+                geometry = json.load(stream)
+        else:
+            geometry = json.loads(geometry)
+    polygons = [[np.asarray(ring, dtype=float)[:, :2] for ring in polygon] for polygon in geojson_polygons(geometry)]
+    vertices = np.concatenate([polygon[0] for polygon in polygons])
+    return {
+        "polygons": polygons,
+        "bbox": [float(vertices[:, 0].min()), float(vertices[:, 1].min()), float(vertices[:, 0].max()), float(vertices[:, 1].max())],
+        "key": md5text(json.dumps([[ring.tolist() for ring in polygon] for polygon in polygons])),
+        "aggregate": aggregate,
+    }
+
+
+def polygon_mask(lat, lon, polygon):
+    """
+    Rasterises the polygon on the lat/lon grid by ray casting (even-odd rule, the holes are excluded).
+    The crossings of each edge depend only on the latitude, so they are computed once per row.
+    """
+    inside = np.zeros((lat.size, lon.size), dtype=bool)
+    for ring in polygon:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, 1), np.roll(y0, 1)
+        for xa, ya, xb, yb in zip(x0, y0, x1, y1):
+            if ya == yb:
+                continue
+            crosses = (ya > lat) != (yb > lat)
+            if not crosses.any():
+                continue
+            x_cross = xa + (lat[crosses] - ya) * (xb - xa) / (yb - ya)
+            inside[crosses] ^= lon[None, :] < x_cross[:, None]
+    return inside
+
+
+def geometry_mask(ds, geometry):
+    """
+    Returns the boolean (lat, lon) mask of the geometry on the grid of ds, rasterised once per grid and geometry.
+    """
+    lat = np.asarray(ds["lat"].values, dtype=float)
+    lon = np.asarray(ds["lon"].values, dtype=float)
+    key = (geometry["key"], md5text(lat.tobytes().hex() + lon.tobytes().hex()))
+    with MASK_CACHE_LOCK:
+        mask = MASK_CACHE.get(key)
+    if mask is None:
+        # the grids in [0, 360) are compared with the polygons in [-180, 180)
+        grid_lon = ((lon + 180) % 360) - 180 if lon.max() > 180 else lon
+        mask = np.zeros((lat.size, lon.size), dtype=bool)
+        for polygon in geometry["polygons"]:
+            mask |= polygon_mask(lat, grid_lon, polygon)
+        with MASK_CACHE_LOCK:
+            if len(MASK_CACHE) >= MASK_CACHE_SIZE:
+                MASK_CACHE.pop(next(iter(MASK_CACHE)))
+            MASK_CACHE[key] = mask
+    return xr.DataArray(mask, dims=("lat", "lon"), coords={"lat": ds["lat"], "lon": ds["lon"]})
+
+
+def geometry_bbox(ds, geometry):
+    """
+    Returns the bbox of the geometry in the longitudes of the grid of ds, None if it crosses the edge of the grid.
+    """
+    bbox = geometry["bbox"]
+    if float(ds["lon"].max()) > 180 and bbox[0] < 0:
+        if bbox[2] >= 0:
+            return [None, bbox[1], None, bbox[3]]
+        return [bbox[0] % 360, bbox[1], bbox[2] % 360, bbox[3]]
+    return bbox
+
+
+def mask_geometry(ds, geometry):
+    """
+    Subsets ds to the bbox of the geometry and masks the cells outside of it,
+    or with geometry["aggregate"] returns the area-weighted mean over the geometry.
+    """
+    bbox = geometry_bbox(ds, geometry)
+    ds = subset_bbox(ds, bbox)
+    mask = geometry_mask(ds, geometry)
+    if geometry.get("aggregate"):
+        return aggregate_geometry(ds, mask)
+    return ds.where(mask)
+
+
+def aggregate_geometry(ds, mask):
+    """
+    Returns the mean of ds over the cells of the mask, weighted by their area (cosine of the latitude).
+    """
+    weights = np.cos(np.deg2rad(ds["lat"])) * mask
+    return ds.weighted(weights.fillna(0)).mean(("lat", "lon"))
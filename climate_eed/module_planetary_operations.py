@@ -1,63 +1,241 @@
 import pandas as pd
 from tqdm import tqdm
 import xarray as xr
-import pystac_client
-import planetary_computer
-from climate_eed.module_threads import get_planetary_item_thr, get_planetary_model_thr, join_thread, start_thread
+from climate_eed.module_cache import STAC_CACHE
+from climate_eed.module_config import PlanetaryConfig
+from climate_eed.module_ensemble import EnsembleStatistics
+from climate_eed.module_resample import drop_count
+from climate_eed.module_writer import get_writer
+from climate_eed.module_threads import BoundedExecutor, bbox_chunks, get_item_host, get_planetary_item_thr, get_planetary_model_thr, raise_failures
 
 
-def get_data_from_items(items, varname, factor, bbox):
-    output_ds = None
-    threads = []
-    for item in items:
-        thrd = get_planetary_item_thr(item=item, varname=varname, bbox=bbox, factor=factor)
-        start_thread(thrd)
-        threads.append(thrd)
-
-    for thrd in threads:
-        join_thread(thrd)
-        ds_sliced = thrd.get_return_value()
-        try:
-            if output_ds is None:
-                output_ds = ds_sliced
-            else:
-                output_ds = xr.concat([output_ds, ds_sliced], dim="time")
-        except Exception as e:
-            print("Exception")
-            print(e)
-    return output_ds
+def concat_by_time(datasets):
+    """
+    Concatenates the slices along the time dimension with a single concat call.
+    The slices are sorted by their first time value, so they can be collected in any order.
+    Args:
+        - datasets (list): The xarray slices to concatenate. None values are ignored.
+    Returns:
+        - xr.DataArray or xr.Dataset: The concatenated data, None if there is nothing to concatenate.
+    """
+    datasets = [ds for ds in datasets if ds is not None and ds["time"].size > 0]
+    if not datasets:
+        return None
+    datasets = sorted(datasets, key=lambda ds: ds["time"].values[0])
+    if len(datasets) == 1:
+        return datasets[0]
+    return xr.concat(datasets, dim="time")
 
 
-def get_data_from_models(ensemble, varname, factor, bbox):
-    output_ds = None
-    datasets_by_model = []
-    threads = []
-    for item in tqdm(ensemble):
-        thrd = get_planetary_model_thr(item=item, varname=varname, bbox=bbox, factor=factor)
-        start_thread(thrd)
-        threads.append(thrd)
-
-    for thrd in threads:
-        join_thread(thrd)
-        ds_sliced = thrd.get_return_value()
-        try:
-            datasets_by_model.append(ds_sliced)
-                
-        except Exception as e:
-            print("Exception")
-            print(e)
-    output_ds = xr.concat(
-        datasets_by_model,
-        dim=pd.Index([ds.attrs["source_id"] for ds in datasets_by_model], name="model"),
-        combine_attrs="drop_conflicts",
-    )
-    return output_ds
+def item_start(item):
+    return str(item.datetime or item.common_metadata.start_datetime or "")
+
+
+class ItemsCollector:
+    def __init__(self, items, writer=None, manifest=None, resampler=None):
+        """
+        ItemsCollector - gathers the slices of the (time sorted) items as their workers complete:
+        checkpoints them, streams them in time order to the writer or keeps them for the final concat.
+        With a resampler the partial periods at the edges of consecutive slices are recombined.
+        The failed items are recorded in the manifest (a rerun fetches them), without a manifest result raises them.
+        """
+        self.items = items
+        self.writer = writer
+        self.manifest = manifest
+        self.resampler = resampler
+        self.failures = []
+        self.pending = {}
+        self.next_position = 0
+        self.tail = None
+
+    def pending_items(self):
+        """
+        pending_items - yields the (position, item) still to fetch, the ones completed by a previous run are read from the checkpoint
+        """
+        for i, item in enumerate(self.items):
+            if self.manifest is not None and self.manifest.is_done(item.id):
+                self.pending[i] = self.manifest.load(item.id)
+                continue
+            yield i, item
+
+    def add(self, i, ds_sliced, failure=None):
+        if self.manifest is not None:
+            ds_sliced = self.manifest.update(self.items[i].id, ds_sliced, failure)
+        elif failure is not None:
+            self.failures.append(failure)
+        self.pending[i] = ds_sliced
+        if self.writer is not None:
+            self.write_in_order()
+
+    def write_in_order(self, final=False):
+        # stream the consecutive slices available, holding back the ones that finished early
+        while self.next_position in self.pending:
+            ds = self.pending.pop(self.next_position)
+            self.next_position += 1
+            if self.resampler is not None and ds is not None:
+                # the last period may continue in the next slice, it is written once the next slice is known
+                if self.tail is not None:
+                    ds = self.resampler.combine(concat_by_time([self.tail, ds]))
+                self.tail = ds.isel(time=slice(-1, None))
+                ds = ds.isel(time=slice(None, -1)) if ds["time"].size > 1 else None
+            self.writer.write(drop_count(ds))
+        if final and self.tail is not None:
+            self.writer.write(drop_count(self.tail))
+            self.tail = None
+
+    def result(self):
+        if self.manifest is not None:
+            self.manifest.report()
+        raise_failures(self.failures)
+        if self.writer is not None:
+            self.write_in_order(final=True)
+            return self.writer.result()
+        output_ds = concat_by_time(self.pending.values())
+        if self.resampler is not None:
+            output_ds = drop_count(self.resampler.combine(output_ds))
+        return output_ds
+
+
+def get_data_from_items(items, varname, factor, bbox, *, max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, writer=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, regrid=None, transform=None):
+    collector = ItemsCollector(sorted(items, key=item_start), writer, manifest, resample)
+    position = {}
+    with BoundedExecutor(max_workers=max_workers, max_per_host=max_per_host) as executor:
+        for i, item in collector.pending_items():
+            thrd = get_planetary_item_thr(item=item, varname=varname, bbox=bbox, factor=factor, lazy=lazy, cache=cache, retry=retry, timeout=timeout, points=points, geometry=geometry, resample=resample, regrid=regrid, transform=transform)
+            executor.submit(thrd, host=get_item_host(item, varname))
+            position[thrd] = i
+        for thrd in executor.as_completed():
+            collector.add(position[thrd], thrd.get_return_value(), thrd.failure())
+    return collector.result()
+
+
+def filter_models(ensemble, models):
+    """
+    Keeps only the items of the ensemble whose cmip6:source_id is in models, before any of them is opened.
+    Args:
+        - ensemble (list): The STAC items of the ensemble.
+        - models (list): The models to keep. Example: ["GFDL-ESM4"]. None or empty keeps every model.
+    Returns:
+        - list: The STAC items of the selected models.
+    """
+    if not models:
+        return list(ensemble)
+    return [item for item in ensemble if item.properties.get("cmip6:source_id") in models]
+
 
-def planetary_data_request(varname, models, factor, bbox, start_date, end_date, repository, collections, query):
+class ModelsCollector:
+    def __init__(self, ensemble, writer=None, manifest=None):
+        """
+        ModelsCollector - gathers the slices of the ensemble members as their workers complete:
+        checkpoints them, streams them in ensemble order to the writer or concatenates them along model in ensemble order
+        """
+        self.ensemble = ensemble
+        self.writer = writer
+        self.manifest = manifest
+        self.failures = []
+        self.position = {item.id: i for i, item in enumerate(ensemble)}
+        self.pending = {}
+        self.next_position = 0
+
+    def pending_items(self):
+        for i, item in enumerate(self.ensemble):
+            if self.manifest is not None and self.manifest.is_done(item.id):
+                self.pending[i] = self.manifest.load(item.id)
+                continue
+            yield item
+
+    def add(self, item, ds_sliced, failure=None):
+        if self.manifest is not None:
+            ds_sliced = self.manifest.update(item.id, ds_sliced, failure)
+        elif failure is not None:
+            self.failures.append(failure)
+        self.pending[self.position[item.id]] = ds_sliced
+        if self.writer is not None:
+            self.write_in_order()
+
+    def write_in_order(self):
+        # stream the consecutive members available, holding back the ones that finished early
+        while self.next_position in self.pending:
+            self.writer.write(self.pending.pop(self.next_position))
+            self.next_position += 1
+
+    def result(self):
+        if self.manifest is not None:
+            self.manifest.report()
+        raise_failures(self.failures)
+        if self.writer is not None:
+            self.write_in_order()
+            return self.writer.result()
+        # keep the order of the ensemble whatever the order the models completed in
+        datasets_by_model = [self.pending[i] for i in sorted(self.pending) if self.pending[i] is not None]
+        if not datasets_by_model:
+            return None
+        output_ds = xr.concat(
+            datasets_by_model,
+            dim="model",
+            combine_attrs="drop_conflicts",
+        )
+        return output_ds
+
+
+class EnsembleCollector(ModelsCollector):
+    def __init__(self, ensemble, statistics, writer=None, manifest=None):
+        """
+        EnsembleCollector - folds each ensemble member into running statistics as its worker completes,
+        so that a single member is held in memory at a time instead of the whole ensemble
+        """
+        super().__init__(ensemble, writer, manifest)
+        self.accumulator = EnsembleStatistics(statistics, members=len(ensemble))
+
+    def pending_items(self):
+        for item in self.ensemble:
+            if self.manifest is not None and self.manifest.is_done(item.id):
+                ds_sliced = self.manifest.load(item.id)
+                if ds_sliced is not None:
+                    self.accumulator.add(ds_sliced)
+                continue
+            yield item
+
+    def add(self, item, ds_sliced, failure=None):
+        if self.manifest is not None:
+            ds_sliced = self.manifest.update(item.id, ds_sliced, failure)
+        elif failure is not None:
+            self.failures.append(failure)
+        if ds_sliced is not None:
+            self.accumulator.add(ds_sliced)
+
+    def result(self):
+        if self.manifest is not None:
+            self.manifest.report()
+        raise_failures(self.failures)
+        output_ds = self.accumulator.result()
+        if self.writer is not None and output_ds is not None:
+            self.writer.write(output_ds)
+            return self.writer.result()
+        return output_ds
+
+
+def get_data_from_models(ensemble, varname, factor, bbox, *, start_date=None, end_date=None, max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, writer=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, ensemble_stats=None, regrid=None, transform=None):
+    if ensemble_stats:
+        collector = EnsembleCollector(ensemble, ensemble_stats, writer, manifest)
+    else:
+        collector = ModelsCollector(ensemble, writer, manifest)
+    position = {}
+    with BoundedExecutor(max_workers=max_workers, max_per_host=max_per_host) as executor:
+        for item in collector.pending_items():
+            thrd = get_planetary_model_thr(item=item, varname=varname, bbox=bbox, factor=factor, start_date=start_date, end_date=end_date, lazy=lazy, cache=cache, retry=retry, timeout=timeout, points=points, geometry=geometry, resample=resample, regrid=regrid, transform=transform)
+            executor.submit(thrd, host=get_item_host(item, varname))
+            position[thrd] = item
+        for thrd in tqdm(executor.as_completed(), total=len(position)):
+            collector.add(position[thrd], thrd.get_return_value(), thrd.failure())
+    return collector.result()
+
+def planetary_data_request(varname, models, factor, bbox, start_date, end_date, repository, collections, query, *, max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS, max_per_host=PlanetaryConfig.DEFAULT_MAX_PER_HOST, lazy=False, cache=None, fileout=None, manifest=None, retry=None, timeout=None, points=None, geometry=None, resample=None, ensemble_stats=None, regrid=None, transform=None):
     """
     Fetches data from a STAC repository and returns it as an xarray dataset.
     Args:
         - varname (str): The variable name to fetch. Example: "tasmax".
+        - models (list): The models to fetch, applied before any item of the ensemble is opened. Example: ["GFDL-ESM4"].
         - factor (float): The factor to multiply the variable by. Example: 1000.
         - bbox (list): The bounding box to fetch the data from. Example: [6.75, 36.75, 18.28, 47.00].
         - start_date (str): The start date of the data to fetch. Example: "01-01-2020".
@@ -65,72 +243,66 @@ def planetary_data_request(varname, models, factor, bbox, start_date, end_date,
         - repository (str): The STAC repository to fetch the data from. Example: "planetary".
         - collections (str): The collections to fetch the data from. Example: "era5-pds".
         - query (str): The query to filter the data by. Example: {"era5:kind": {"eq": "fc"}}.
+        - max_workers (int): The maximum number of items downloaded concurrently. Example: 8.
+        - max_per_host (int): The maximum number of concurrent downloads against the same host, 0 for as many as the workers. Example: 4.
+        - lazy (bool): If True, the data is returned as a dask-backed array and nothing is read until it is computed.
+        - cache (TileCache): The on-disk cache of the fetched subsets. None disables the cache.
+        - fileout (str): The file the slices are streamed to as soon as they are fetched, with extension .nc, .zarr or .csv. Example: "output.nc".
+        - manifest (JobManifest): The checkpoint of the job, the items already completed are read from local storage. None disables checkpointing.
+        - retry (RetryPolicy): How the download of each item is retried on transient errors. None tries each item once.
+        - timeout (float): The timeout in seconds of the connections and reads of an item, a stalled attempt fails and is retried. None or 0 waits indefinitely.
+        - points (dict): If set, only the series at the points are read, see parse_points. The result has (station, time) dimensions.
+        - geometry (dict): If set, only the bbox of the geometry is read and the cells outside of it are masked (or averaged over it), see parse_geometry.
+        - resample (Resampler): If set, each item is reduced to the periods of the Resampler as soon as it is fetched, see parse_resample.
+        - ensemble_stats (list): If set, the models of an ensemble are reduced to these statistics as they arrive instead of being concatenated. Example: ["mean", "std", "q10", "q90"].
+        - regrid (Regridder): If set, each item is interpolated on the target grid of the Regridder as soon as it is fetched, see parse_target_grid.
+        - transform (Transform): The pipeline applied lazily to each item as soon as it is fetched, see parse_transform. None applies factor only.
     Returns:
         - xr.Dataset: The data fetched from the STAC repository.
     """
 
     output_ds = None
+    # the options shared by the items and the models of the ensemble
+    options = {"max_per_host": max_per_host, "lazy": lazy, "cache": cache, "manifest": manifest, "retry": retry, "timeout": timeout, "points": points, "geometry": geometry, "resample": resample, "regrid": regrid, "transform": transform}
 
-    
     if "cil-gdpcir-cc0" in collections or "cil-gdpcir-cc-by" in collections:
-        catalog = pystac_client.Client.open(
-            repository,
-            modifier=planetary_computer.sign_inplace,
-        )
-
-        search_results = catalog.search(
-            collections=collections,
-            query=query,
-        )
-
-        ensemble = search_results.item_collection()
-        output_ds = get_data_from_models(ensemble, varname, factor, bbox)
+        ensemble = STAC_CACHE.search(repository, collections, query=query)
+        ensemble = filter_models(ensemble, models)
+        writer = get_writer(fileout, append_dim="statistic" if ensemble_stats else "model")
+        output_ds = get_data_from_models(ensemble, varname, factor, bbox, start_date=start_date, end_date=end_date, max_workers=max_workers, writer=writer, ensemble_stats=ensemble_stats, **options)
         print("OUTPUT")
         print(output_ds)
         print("****************************************")
-        
-        if models:    
-            output_ds = output_ds.tasmax.sel(
-                lon=slice(bbox[0], bbox[2]),
-                lat=slice(bbox[1], bbox[3]),
-                time=slice(start_date, end_date),
-                model=models,
-            )
-        else:
-            output_ds = output_ds.tasmax.sel(
-                lon=slice(bbox[0], bbox[2]),
-                lat=slice(bbox[1], bbox[3]),
-                time=slice(start_date, end_date),
-            )
+
+        if lazy and output_ds is not None:
+            output_ds = output_ds.chunk(bbox_chunks(output_ds))
         
     else:
-        catalog = pystac_client.Client.open(repository)
-        search_results = catalog.search(
-            collections=collections, datetime=[start_date, end_date], query=query
-        )
-        items = search_results.items()
-        output_ds = get_data_from_items(items, varname, factor, bbox)
+        items = STAC_CACHE.search(repository, collections, datetime=[start_date, end_date], query=query)
+        writer = get_writer(fileout, append_dim="time")
+        output_ds = get_data_from_items(items, varname, factor, bbox, max_workers=max_workers, writer=writer, **options)
     
     return output_ds
 
 
-def var_list_request(repository, collections):
+def var_list_request(repository, collections, sample=PlanetaryConfig.DEFAULT_LIST_VARS_SAMPLE):
     """
     Fetches the list of variables available in a STAC repository.
     Args:
         - repository (str): The STAC repository to fetch the data from. Example: "planetary".
         - collections (str): The collections to fetch the data from. Example: "era5-pds".
+        - sample (int): The number of items whose assets are listed, the union of their assets is returned. Example: 1.
+          With sample=0 the item_assets of the collection metadata are listed instead and no item is searched.
     Returns:
         - list: The list of variables available in the STAC repository.
     """
 
     var_list = None
-    catalog = pystac_client.Client.open(repository)
-    search_results = catalog.search(
-        collections=collections
-    )
-    items = search_results.items()
-    for item in items:
-        signed_item = planetary_computer.sign(item)
-        var_list = list(signed_item.assets.keys())
-    return var_list
\ No newline at end of file
+    if sample:
+        assets = [item.assets.keys() for item in STAC_CACHE.search(repository, collections, max_items=sample)]
+    else:
+        assets = [STAC_CACHE.item_assets(repository, collection).keys() for collection in collections]
+    if assets:
+        # the asset keys do not depend on the signature, no need to sign the items
+        var_list = list(dict.fromkeys(key for keys in assets for key in keys))
+    return var_list
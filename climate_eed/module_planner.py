@@ -0,0 +1,123 @@
+import inspect
+import os
+
+import xarray as xr
+
+from climate_eed.module_commands import fetch_var_copernicus, fetch_var_planetary, fetch_var_smhi
+from climate_eed.module_config import PlanetaryConfig, parse_points
+from climate_eed.module_geometry import mask_geometry, parse_geometry
+from climate_eed.module_threads import BoundedExecutor, ThreadReturn, select_points
+
+FETCHERS = {
+    "planetary": fetch_var_planetary,
+    "smhi": fetch_var_smhi,
+    "copernicus": fetch_var_copernicus,
+}
+# the argument of each fetch_var_* bounding its concurrency, and the caches of each source
+CONCURRENCY_ARGS = {"planetary": "max_workers", "smhi": "max_workers", "copernicus": "max_requests"}
+CACHE_SOURCES = ("planetary", "copernicus")
+
+
+class SourceRequest:
+    def __init__(self, source, name=None, **kwargs):
+        """
+        SourceRequest - one fetch of a multi-source plan: the source ("planetary", "smhi" or "copernicus")
+        and the arguments of its fetch_var_* function. Example: SourceRequest("planetary", varname="tasmax", ...)
+        """
+        if source not in FETCHERS:
+            raise ValueError(f"Unsupported source: {source}, must be one of {', '.join(FETCHERS)}")
+        self.source = source
+        self.name = name or source
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"SourceRequest(source={self.source}, name={self.name})"
+
+
+def harmonise(data):
+    """
+    Renames the coordinates of the sources to the same names (lat, lon, time), with longitudes in [-180, 180)
+    and both axes ascending, so that the outputs of different sources can be compared and combined.
+    """
+    if not isinstance(data, (xr.Dataset, xr.DataArray)):
+        return data
+    names = {"latitude": "lat", "longitude": "lon", "valid_time": "time"}
+    data = data.rename({old: new for old, new in names.items() if old in data.coords and new not in data.coords})
+    if "lon" in data.dims and float(data["lon"].max()) > 180:
+        data = data.assign_coords(lon=((data["lon"] + 180) % 360) - 180)
+    for dim in ("lat", "lon"):
+        if dim in data.dims and data[dim].size > 1 and not data.indexes[dim].is_monotonic_increasing:
+            data = data.sortby(dim)
+    return data
+
+
+def plan_requests(requests, max_workers, cache_dir, cache_size, target_grid=None):
+    """
+    Shares the concurrency and the cache budgets (and the target grid) between the requests, the arguments set explicitly are kept.
+    Raises ValueError for the arguments the fetch_var_* function of a request does not take, which would be dropped silently.
+    """
+    cached = [request for request in requests if request.source in CACHE_SOURCES]
+    plan = []
+    for request in requests:
+        kwargs = dict(request.kwargs)
+        kwargs.setdefault(CONCURRENCY_ARGS[request.source], max(1, max_workers // len(requests)))
+        if cache_dir and request.source in CACHE_SOURCES:
+            kwargs.setdefault("cache_dir", os.path.join(cache_dir, request.source))
+            kwargs.setdefault("cache_size", cache_size // len(cached))
+        if target_grid is not None:
+            kwargs.setdefault("target_grid", target_grid)
+        points, geometry = None, None
+        if request.source != "planetary":
+            # the planetary items are read at the points (or in the geometry) only, the other sources are sampled once fetched
+            points = parse_points(kwargs.pop("points", None), kwargs.pop("point_method", PlanetaryConfig.DEFAULT_POINT_METHOD))
+            geometry = parse_geometry(kwargs.pop("geometry", None), kwargs.pop("aggregate", PlanetaryConfig.DEFAULT_AGGREGATE))
+        argnames = inspect.getfullargspec(FETCHERS[request.source]).args
+        unknown = sorted(set(kwargs) - set(argnames))
+        if unknown:
+            raise ValueError(f"Unsupported arguments of {request}: {', '.join(unknown)}, must be among {', '.join(argnames)}")
+        plan.append((request, kwargs, points, geometry))
+    return plan
+
+
+def fetch_all(requests, max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS, cache_dir=PlanetaryConfig.DEFAULT_CACHE_DIR, cache_size=PlanetaryConfig.DEFAULT_CACHE_SIZE, harmonised=True, target_grid=None):
+    """
+    Fetches the requests of different sources concurrently, it takes as long as the slowest of them.
+    Args:
+        - requests (list): The SourceRequest to fetch.
+        - max_workers (int): The concurrency shared by the requests, split evenly between them. Example: 16.
+        - cache_dir (str): The folder of the caches shared by the requests, one sub folder per source. Empty disables the caches.
+        - cache_size (int): The size in bytes of the caches, split evenly between the requests that use one.
+        - harmonised (bool): If True, the outputs have lat, lon and time coordinates named and ordered the same way.
+        - target_grid (str|list|dict): If set, the gridded outputs of all the requests are interpolated on this grid, see fetch_var_planetary. Example: "0.25".
+    Returns:
+        - dict: The output of each request by name, None for the requests that returned no data.
+    Raises RuntimeError naming the requests that failed, once all the others are done.
+    """
+    if not requests:
+        return {}
+    names = [request.name for request in requests]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The names of the requests must be unique: {names}")
+
+    results = dict.fromkeys(names)
+    tasks = {}
+    with BoundedExecutor(max_workers=len(requests)) as executor:
+        for request, kwargs, points, geometry in plan_requests(requests, max_workers, cache_dir, cache_size, target_grid):
+            thrd = ThreadReturn(target=FETCHERS[request.source], kwargs=kwargs)
+            tasks[thrd] = (request, points, geometry)
+            executor.submit(thrd)
+        for thrd in executor.as_completed():
+            request, points, geometry = tasks[thrd]
+            data = thrd.get_return_value()
+            if data is None:
+                continue
+            if harmonised or points or geometry:
+                data = harmonise(data)
+            if isinstance(data, (xr.Dataset, xr.DataArray)) and "lat" in data.dims and "lon" in data.dims:
+                if points:
+                    data = select_points(data, points)
+                elif geometry:
+                    data = mask_geometry(data, geometry)
+            results[request.name] = data
+        executor.raise_failures()
+    return results
@@ -0,0 +1,207 @@
+import os
+import threading
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from climate_eed.filesystem import md5text
+from climate_eed.module_config import PlanetaryConfig
+
+
+GRID_NAMES = (("lat", "lon"), ("latitude", "longitude"))
+WEIGHTS_CACHE = {}
+WEIGHTS_CACHE_LOCK = threading.Lock()
+WEIGHTS_CACHE_SIZE = 16
+
+
+def grid_names(data):
+    """
+    Returns the names of the (lat, lon) dimensions of data, None if it is not on a regular lat/lon grid.
+    """
+    for lat, lon in GRID_NAMES:
+        if lat in data.dims and lon in data.dims:
+            return lat, lon
+    return None
+
+
+def linear_weights(source, target, periodic=False):
+    """
+    Returns the sparse (target, source) matrix of the linear interpolation weights along one axis,
+    the source coordinates can be in any order, the targets out of the source range have no weights.
+    """
+    order = np.argsort(source)
+    ordered = source[order]
+    if ordered.size == 1:
+        rows = np.nonzero(np.isclose(target, ordered[0]))[0]
+        return sparse.csr_matrix((np.ones(rows.size), (rows, np.zeros(rows.size, dtype=int))), shape=(target.size, 1))
+    if periodic:
+        # a global longitude axis, the targets after the last source column wrap to the first one
+        ordered = np.append(ordered, ordered[0] + 360)
+        order = np.append(order, order[0])
+        target = np.where(target < ordered[0], target + 360, target)
+    index = np.clip(np.searchsorted(ordered, target, side="right") - 1, 0, ordered.size - 2)
+    fraction = (target - ordered[index]) / (ordered[index + 1] - ordered[index])
+    rows = np.nonzero((target >= ordered[0]) & (target <= ordered[-1]))[0]
+    index, fraction = index[rows], fraction[rows]
+    return sparse.csr_matrix(
+        (np.concatenate([1 - fraction, fraction]), (np.concatenate([rows, rows]), np.concatenate([order[index], order[index + 1]]))),
+        shape=(target.size, source.size),
+    )
+
+
+def bilinear_weights(source_lat, source_lon, target_lat, target_lon):
+    """
+    Returns the sparse matrix of the bilinear weights from the flattened (lat, lon) source grid to the target grid.
+    """
+    # the targets are compared with the sources in the longitudes of the source grid
+    if source_lon.max() > 180:
+        target_lon = target_lon % 360
+    elif source_lon.min() < 0:
+        target_lon = ((target_lon + 180) % 360) - 180
+    step = np.abs(np.diff(np.sort(source_lon))).min() if source_lon.size > 1 else 0
+    periodic = source_lon.size > 1 and np.isclose(source_lon.max() - source_lon.min() + step, 360)
+    return sparse.kron(linear_weights(source_lat, target_lat), linear_weights(source_lon, target_lon, periodic), format="csr")
+
+
+class Regridder:
+    def __init__(self, lat=None, lon=None, resolution=None, cache_dir=PlanetaryConfig.DEFAULT_REGRID_DIR):
+        """
+        Regridder - interpolates the slices bilinearly on a target grid, either given (lat, lon) or a resolution
+        aligned on its multiples over the extent of each slice. The weights are computed once per source and target
+        grid, saved in cache_dir and reused across the items and the runs, each slice costs a sparse matrix product.
+        """
+        self.lat = None if lat is None else np.asarray(lat, dtype=float)
+        self.lon = None if lon is None else np.asarray(lon, dtype=float)
+        self.resolution = resolution
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        if self.resolution:
+            return f"resolution={self.resolution}"
+        return f"grid={md5text(self.lat.tobytes().hex() + self.lon.tobytes().hex())}"
+
+    def target(self, source_lat, source_lon):
+        if not self.resolution:
+            return self.lat, self.lon
+        res = self.resolution
+        lat = np.arange(np.ceil(source_lat.min() / res), np.floor(source_lat.max() / res) + 1) * res
+        lon = np.arange(np.ceil(source_lon.min() / res), np.floor(source_lon.max() / res) + 1) * res
+        return lat, lon
+
+    def weights(self, source_lat, source_lon, target_lat, target_lon):
+        key = md5text("".join(axis.tobytes().hex() for axis in (source_lat, source_lon, target_lat, target_lon)))
+        with WEIGHTS_CACHE_LOCK:
+            weights = WEIGHTS_CACHE.get(key)
+        if weights is not None:
+            return weights
+        filename = os.path.join(self.cache_dir, f"{key}.npz") if self.cache_dir else None
+        if filename and os.path.isfile(filename):
+            weights = sparse.load_npz(filename).tocsr()
+        else:
+            weights = bilinear_weights(source_lat, source_lon, target_lat, target_lon)
+            if filename:
+                tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+                sparse.save_npz(tmp_filename, weights)
+                os.replace(tmp_filename, filename)
+        with WEIGHTS_CACHE_LOCK:
+            if len(WEIGHTS_CACHE) >= WEIGHTS_CACHE_SIZE:
+                WEIGHTS_CACHE.pop(next(iter(WEIGHTS_CACHE)))
+            WEIGHTS_CACHE[key] = weights
+        return weights
+
+    def regrid(self, data):
+        """
+        regrid - data on the target grid, the variables without lat and lon dimensions are left as they are.
+        The missing source cells are excluded and the weights of the others renormalised, the target cells
+        out of the source grid are missing. Dask-backed data stays lazy, one product per chunk.
+        """
+        names = grid_names(data)
+        if names is None:
+            return data
+        lat, lon = names
+        source_lat = np.asarray(data[lat].values, dtype=float)
+        source_lon = np.asarray(data[lon].values, dtype=float)
+        target_lat, target_lon = self.target(source_lat, source_lon)
+        weights = self.weights(source_lat, source_lon, target_lat, target_lon)
+        shape = (target_lat.size, target_lon.size)
+        # the target cells with no source cell around them
+        outside = np.asarray(weights.sum(axis=1)).ravel() == 0
+
+        def apply_weights(values):
+            flat = values.reshape(-1, values.shape[-2] * values.shape[-1]).T
+            valid = ~np.isnan(flat)
+            if valid.all():
+                output = weights @ flat
+                output[outside] = np.nan
+            else:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    output = (weights @ np.where(valid, flat, 0)) / (weights @ valid.astype(float))
+            return output.T.reshape(values.shape[:-2] + shape).astype(np.result_type(values.dtype, np.float32))
+
+        def regrid_array(da):
+            if lat not in da.dims or lon not in da.dims:
+                return da
+            if da.chunks:
+                da = da.chunk({lat: -1, lon: -1})
+            output = xr.apply_ufunc(
+                apply_weights,
+                da,
+                input_core_dims=[[lat, lon]],
+                output_core_dims=[[lat, lon]],
+                exclude_dims={lat, lon},
+                dask="parallelized",
+                output_dtypes=[np.result_type(da.dtype, np.float32)],
+                dask_gufunc_kwargs={"output_sizes": {lat: shape[0], lon: shape[1]}},
+                keep_attrs=True,
+            )
+            return output.assign_coords({lat: target_lat, lon: target_lon})
+
+        if isinstance(data, xr.Dataset):
+            output_ds = data.drop_vars([name for name in data.coords if lat in data[name].dims or lon in data[name].dims])
+            output_ds = output_ds.map(regrid_array, keep_attrs=True)
+            return output_ds.assign_coords({lat: target_lat, lon: target_lon})
+        return regrid_array(data)
+
+
+def grid_of(data):
+    names = grid_names(data)
+    if names is None:
+        raise ValueError(f"The target grid has no lat/lon dimensions: {list(data.dims)}")
+    return data[names[0]].values, data[names[1]].values
+
+
+def parse_target_grid(target_grid, cache_dir=PlanetaryConfig.DEFAULT_REGRID_DIR):
+    """
+    Returns the Regridder of a target grid, None if there is no target grid.
+    The target grid is a resolution in degrees ("0.25"), a bbox and a resolution ("min_lon,min_lat,max_lon,max_lat,res"),
+    a dict {"lat": [...], "lon": [...]}, an xarray object or the path of a .nc or .zarr file whose lat/lon grid is used.
+    """
+    if target_grid is None or (isinstance(target_grid, (str, list, tuple, dict)) and not target_grid):
+        return None
+    if isinstance(target_grid, Regridder):
+        return target_grid
+    if isinstance(target_grid, (xr.Dataset, xr.DataArray)):
+        lat, lon = grid_of(target_grid)
+        return Regridder(lat, lon, cache_dir=cache_dir)
+    if isinstance(target_grid, dict):
+        lat = target_grid.get("lat", target_grid.get("latitude"))
+        lon = target_grid.get("lon", target_grid.get("longitude"))
+        return Regridder(lat, lon, cache_dir=cache_dir)
+    if isinstance(target_grid, str) and os.path.exists(target_grid):
+        with xr.open_dataset(target_grid, engine="zarr" if target_grid.rstrip("/").endswith(".zarr") else None) as ds:
+            lat, lon = grid_of(ds)
+        return Regridder(lat, lon, cache_dir=cache_dir)
+    if isinstance(target_grid, str):
+        target_grid = target_grid.split(",")
+    values = [float(value) for value in np.atleast_1d(target_grid)]
+    if len(values) == 1:
+        return Regridder(resolution=values[0], cache_dir=cache_dir)
+    if len(values) == 5:
+        min_lon, min_lat, max_lon, max_lat, res = values
+        lat = np.arange(min_lat, max_lat + res / 2, res)
+        lon = np.arange(min_lon, max_lon + res / 2, res)
+        return Regridder(lat, lon, cache_dir=cache_dir)
+    raise ValueError(f"Unsupported target grid: {target_grid}, must be a resolution, min_lon,min_lat,max_lon,max_lat,res, a dict of lat and lon or a grid file")
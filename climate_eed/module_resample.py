@@ -0,0 +1,95 @@
+import pandas as pd
+import xarray as xr
+
+
+STATISTICS = ("mean", "sum", "max", "min", "count")
+
+
+def period_of(freq):
+    """
+    Returns the resampling period of freq: the multiples of a day as a fixed duration, which pandas anchors
+    on the origin (it ignores the origin of the calendar days), the other frequencies as they are.
+    """
+    offset = pd.tseries.frequencies.to_offset(freq)
+    if isinstance(offset, pd.offsets.Day):
+        return pd.Timedelta(days=offset.n)
+    return freq
+
+
+class Resampler:
+    def __init__(self, freq, how="mean"):
+        """
+        Resampler - reduces each fetched slice to freq periods (mean, sum, max, min, count or a quantile),
+        as soon as its worker finishes. The periods cut by the edge of a slice are partial, each period keeps
+        the number of time steps it aggregates (resample_count) so that combine can recombine the partials.
+        The periods are anchored on the epoch, not on the first day of each slice, so that the periods of
+        consecutive slices share their labels.
+        """
+        self.freq = freq
+        self.period = period_of(freq)
+        self.how = how
+        self.q = None
+        if how == "median":
+            self.q = 0.5
+        elif how[:1] in ("q", "p") and how[1:].replace(".", "", 1).isdigit():
+            self.q = float(how[1:]) / 100
+        elif how not in STATISTICS:
+            raise ValueError(f"Unsupported statistic: {how}, must be one of {', '.join(STATISTICS)}, median or a percentile like q90")
+
+    def __repr__(self):
+        return f"{self.freq}:{self.how}"
+
+    def reduce(self, da):
+        """
+        reduce - the statistic of each period of the slice, with the resample_count of each period
+        """
+        if self.q is not None:
+            if da.chunks:
+                da = da.chunk({"time": -1})
+            reduced = da.resample(time=self.period, origin="epoch").quantile(self.q).drop_vars("quantile")
+        else:
+            reduced = getattr(da.resample(time=self.period, origin="epoch"), self.how)()
+        count = da["time"].resample(time=self.period, origin="epoch").count()
+        return reduced.assign_coords(resample_count=("time", count.values))
+
+    def combine(self, da):
+        """
+        combine - merges the partial periods of consecutive slices, which share the same time label.
+        Sums, counts, extremes and means are recombined exactly, the quantiles are averaged weighted
+        by the number of time steps of each partial, an approximation.
+        """
+        if da is None or da.indexes["time"].is_unique:
+            return da
+        count = da["resample_count"]
+        groups = da.drop_vars("resample_count").groupby("time")
+        total = count.groupby("time").sum()
+        if self.how in ("sum", "count"):
+            combined = groups.sum()
+        elif self.how in ("max", "min"):
+            combined = getattr(groups, self.how)()
+        else:
+            weighted = (da.drop_vars("resample_count") * count).groupby("time").sum()
+            combined = weighted / total
+        return combined.assign_coords(resample_count=("time", total.values))
+
+
+def parse_resample(resample):
+    """
+    Returns the Resampler of the spec "<freq>:<statistic>", None if there is no spec.
+    The frequency is a pandas offset, the statistic one of mean, sum, max, min, count, median or a percentile like q90.
+    Example: "1D:max", "MS:mean", "QS-DEC:q90".
+    """
+    if not resample:
+        return None
+    if isinstance(resample, Resampler):
+        return resample
+    if isinstance(resample, dict):
+        return Resampler(resample["freq"], resample.get("how", "mean"))
+    freq, _, how = str(resample).partition(":")
+    return Resampler(freq.strip(), how.strip() or "mean")
+
+
+def drop_count(data):
+    if isinstance(data, (xr.Dataset, xr.DataArray)) and "resample_count" in data.coords:
+        return data.drop_vars("resample_count")
+    return data
@@ -1,43 +1,316 @@
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
 import xarray as xr
-import fsspec
 # import s3fs
-from ftplib import FTP
+from ftplib import FTP, all_errors
 import os
+import re
 
+from climate_eed.filesystem import md5sum
 from climate_eed.module_config import SMHIConfig
+from climate_eed.module_threads import BoundedExecutor, RetryPolicy, ThreadReturn
+from climate_eed.module_writer import GroupWriter
 
 
-def download_files_from_ftp(ftp, folder):
-    # ftp.cwd(folder)
-    files = ftp.nlst()
-    nc_files = []
-    for file in files:
-        if file.endswith('.nc'):
-            local_filename = os.path.join(f"./seasonal_forecast/{folder}", file)
-            nc_files.append(local_filename)
-            if not os.path.exists(local_filename):
-
-                if not os.path.exists(f"./seasonal_forecast/{folder}"):
-                    os.makedirs(f"./seasonal_forecast/{folder}")
-                with open(local_filename, 'wb') as f:
-                    ftp.retrbinary('RETR ' + file, f.write)
-                # print(f"Downloaded: {local_filename}")
-            else:
-                # print(f"File already exists: {local_filename}")
+MEMBER_PATTERN = re.compile(r"COUT_(.+?)\.")
+
+
+class FTPPool:
+    def __init__(self, url, user, passwd, size=SMHIConfig.DEFAULT_FTP_POOL_SIZE, timeout=SMHIConfig.DEFAULT_FTP_POOL_TIMEOUT, read_timeout=SMHIConfig.DEFAULT_FTP_READ_TIMEOUT):
+        """
+        FTPPool - a small pool of authenticated FTP sessions, reused across files, issue dates and living labs.
+        At most size sessions are open, acquire waits up to timeout seconds for a session to be released.
+        A command or a transfer of a session that stalls for read_timeout seconds fails with a TimeoutError (retried).
+        """
+        self.url = url
+        self.user = user
+        self.passwd = passwd
+        self.size = size
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.sessions = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        ftp = FTP(self.url, timeout=self.read_timeout)
+        ftp.login(user=self.user, passwd=self.passwd)
+        ftp.home = ftp.pwd()
+        return ftp
+
+    def reconnect(self):
+        """
+        reconnect - opens a session in a slot already counted in created, the slot is freed if it fails
+        """
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                reserved = self.sessions.empty() and self.created < self.size
+                if reserved:
+                    self.created += 1
+            if reserved:
+                return self.reconnect()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No FTP session of {self.url} was released in {self.timeout} seconds")
+            try:
+                # woken up regularly, a slot freed by a discarded session is taken without waiting for a release
+                ftp = self.sessions.get(timeout=min(remaining, 1))
+                break
+            except queue.Empty:
                 pass
-    ftp.cwd("..")
+        try:
+            # idle sessions may have been dropped by the server
+            ftp.voidcmd("NOOP")
+            ftp.cwd(ftp.home)
+        except all_errors:
+            # the dropped session is replaced in its own slot
+            try:
+                ftp.close()
+            except all_errors:
+                pass
+            ftp = self.reconnect()
+        return ftp
+
+    def release(self, ftp):
+        self.sessions.put(ftp)
+
+    def discard(self, ftp):
+        try:
+            ftp.close()
+        except all_errors:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def session(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except Exception:
+            self.discard(ftp)
+            raise
+        else:
+            self.release(ftp)
+
+    def close(self):
+        while not self.sessions.empty():
+            ftp = self.sessions.get()
+            try:
+                ftp.quit()
+            except all_errors:
+                ftp.close()
+            with self.lock:
+                self.created -= 1
+
+
+FTP_POOLS = {}
+FTP_POOLS_LOCK = threading.Lock()
+
+
+def get_ftp_pool(config, size=SMHIConfig.DEFAULT_FTP_POOL_SIZE):
+    """
+    Returns the pool of FTP sessions of the server and user of the config, created on first use.
+    """
+    key = (config['url'], config['user'])
+    with FTP_POOLS_LOCK:
+        if key not in FTP_POOLS:
+            FTP_POOLS[key] = FTPPool(config['url'], config['user'], config['passwd'], size)
+        return FTP_POOLS[key]
+
+
+class SyncManifest:
+    def __init__(self, local_folder):
+        """
+        SyncManifest - the remote size and modification time and the local md5 of the files
+        downloaded in local_folder, to find out which files are new, changed, truncated or partial
+        """
+        self.manifest_file = os.path.join(local_folder, ".sync_manifest.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as stream:
+                self.files = json.load(stream)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def get(self, file):
+        with self.lock:
+            return self.files.get(file)
+
+    def set(self, file, size, modify, md5=None):
+        with self.lock:
+            self.files[file] = {"size": size, "modify": modify, "md5": md5}
+            tmp_file = f"{self.manifest_file}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as stream:
+                json.dump(self.files, stream, indent=2)
+            os.replace(tmp_file, self.manifest_file)
+
+    def is_current(self, file, facts, local_filename):
+        """
+        is_current - the local file is complete, unchanged on the server and not corrupted
+        """
+        entry = self.get(file)
+        if not entry or not entry["md5"] or not os.path.isfile(local_filename):
+            return False
+        if (entry["size"], entry["modify"]) != (facts["size"], facts["modify"]):
+            return False
+        return os.path.getsize(local_filename) == facts["size"] and md5sum(local_filename) == entry["md5"]
+
+    def can_resume(self, file, facts):
+        """
+        can_resume - a partial download of the same remote version is on disk
+        """
+        entry = self.get(file)
+        return bool(entry) and entry["md5"] is None and facts["modify"] is not None and (entry["size"], entry["modify"]) == (facts["size"], facts["modify"])
+
+
+def list_remote_files(ftp):
+    """
+    Returns the files of the current remote folder with their size and modification time,
+    from the MLSD facts or, on servers without MLSD, from SIZE and MDTM.
+    """
+    try:
+        return {name: {"size": int(facts["size"]), "modify": facts.get("modify")} for name, facts in ftp.mlsd(facts=["type", "size", "modify"]) if facts.get("type") == "file"}
+    except all_errors:
+        pass
+    ftp.voidcmd("TYPE I")
+    files = {}
+    for name in ftp.nlst():
+        try:
+            size = ftp.size(name)
+        except all_errors:
+            size = None
+        try:
+            modify = ftp.voidcmd(f"MDTM {name}").split()[-1]
+        except all_errors:
+            modify = None
+        files[name] = {"size": size, "modify": modify}
+    return files
+
+
+def download_file_from_ftp(pool, folder, file, local_filename, resume=False, facts=None, manifest=None):
+    """
+    Downloads one file with a session of the pool, returns the number of bytes transferred.
+    With resume=True a partial download is continued from where it stopped (REST offset).
+    With a manifest, the size of the download is verified and the file is recorded with its md5.
+    """
+    tmp_filename = f"{local_filename}.part"
+    offset = os.path.getsize(tmp_filename) if resume and os.path.isfile(tmp_filename) else 0
+    if manifest is not None:
+        manifest.set(file, facts["size"], facts["modify"])
+    with pool.session() as ftp:
+        ftp.cwd(folder)
+        with open(tmp_filename, 'ab' if offset else 'wb') as f:
+            ftp.retrbinary('RETR ' + file, f.write, rest=offset or None)
+    if manifest is not None:
+        if facts["size"] is not None and os.path.getsize(tmp_filename) != facts["size"]:
+            raise IOError(f"Incomplete download of {file}: {os.path.getsize(tmp_filename)} of {facts['size']} bytes")
+        manifest.set(file, facts["size"], facts["modify"], md5sum(tmp_filename))
+    os.replace(tmp_filename, local_filename)
+    return os.path.getsize(local_filename) - offset
+
+
+def download_files_from_ftp(pool, folder, max_workers=SMHIConfig.DEFAULT_FTP_POOL_SIZE, sync=False):
+    """
+    Downloads the NetCDF files of the remote folder in parallel, returns the local filenames.
+    By default a file is downloaded only if it does not exist locally. With sync=True the remote size and
+    modification time are compared with the local manifest: new or changed files are downloaded, partial
+    downloads are resumed and the local files are verified against their md5.
+    Once all the downloads are over, raises a RuntimeError naming the files that failed: a rerun fetches only them.
+    """
+    with pool.session() as ftp:
+        ftp.cwd(folder)
+        files = list_remote_files(ftp) if sync else dict.fromkeys(ftp.nlst())
+    local_folder = f"./seasonal_forecast/{folder}"
+    manifest = None
+    if sync:
+        os.makedirs(local_folder, exist_ok=True)
+        manifest = SyncManifest(local_folder)
+    nc_files = []
+    t0 = time.time()
+    with BoundedExecutor(max_workers=max_workers) as executor:
+        for file, facts in files.items():
+            if file.endswith('.nc'):
+                local_filename = os.path.join(local_folder, file)
+                nc_files.append(local_filename)
+                if sync:
+                    download = not manifest.is_current(file, facts, local_filename)
+                else:
+                    download = not os.path.exists(local_filename)
+                if download:
+                    if not os.path.exists(local_folder):
+                        os.makedirs(local_folder, exist_ok=True)
+                    kwargs = {"pool": pool, "folder": folder, "file": file, "local_filename": local_filename}
+                    if sync:
+                        kwargs.update({"resume": manifest.can_resume(file, facts), "facts": facts, "manifest": manifest})
+                    thrd = ThreadReturn(target=download_file_from_ftp, kwargs=kwargs, retry=RetryPolicy(max_attempts=SMHIConfig.DEFAULT_MAX_ATTEMPTS))
+                    executor.submit(thrd)
+                else:
+                    # print(f"File already exists: {local_filename}")
+                    pass
+        threads = list(executor.as_completed())
+    downloaded = [thrd.get_return_value() for thrd in threads if thrd.error is None]
+    downloaded = [size for size in downloaded if size is not None]
+    if downloaded:
+        elapsed = time.time() - t0
+        size_mb = sum(downloaded) / 1024 ** 2
+        print(f"Downloaded {len(downloaded)} files, {size_mb:.1f} MB in {elapsed:.1f} s ({size_mb / max(elapsed, 1e-6):.1f} MB/s)")
+    failed = {thrd.event["file"]: thrd.error for thrd in threads if thrd.error is not None}
+    if failed:
+        errors = ", ".join(f"{file}: {error}" for file, error in sorted(failed.items()))
+        raise RuntimeError(f"{len(failed)} of {len(nc_files)} files of {folder} could not be downloaded ({errors}), rerun to fetch only them")
     return nc_files
 
-# Function to read geometry and bbox from NetCDF file
-def read_netcdf(file_path):
-    nc_file = fsspec.open(file_path,anon=True)
-    nc = xr.open_dataset(nc_file.open())  # Dataset(file_path, 'r')
-    # Extract geometry and bbox from the NetCDF file
+def member_id(filename):
+    """
+    Returns the ensemble member of the file, COUT_<model>.nc. Example: "./COUT_001.nc" -> "001".
+    """
+    match = MEMBER_PATTERN.search(os.path.basename(filename))
+    return match.group(1) if match else None
+
 
-    return nc
+def open_ensemble(files, chunks=SMHIConfig.DEFAULT_CHUNKS):
+    """
+    Opens the ensemble members lazily as a single dataset with a model dimension.
+    Only COUT is concatenated along model, the other variables and the coordinates are taken
+    from the first member, the files are opened in parallel and read chunk by chunk on compute.
+    Args:
+        - files (list): The NetCDF files of the members, named COUT_<model>.nc.
+        - chunks (dict): The dask chunks of each member. Example: {"time": 100}.
+    Returns:
+        - xr.Dataset: The ensemble, None if there are no files.
+    """
+    members = sorted((model, filename) for filename in files if (model := member_id(filename)) is not None)
+    if not members:
+        return None
+    models, files = zip(*members)
+    output_ds = xr.open_mfdataset(
+        list(files),
+        combine="nested",
+        concat_dim="model",
+        data_vars=["COUT"],
+        coords="minimal",
+        compat="override",
+        join="override",
+        chunks=chunks,
+        parallel=True,
+    )
+    return output_ds.assign_coords(model=list(models))
 
 
-def smhi_data_request(living_lab="georgia", data_dir="seasonal_forecast", issue_date="202404",ftp_config=None):
+def smhi_data_request(living_lab="georgia", data_dir="seasonal_forecast", issue_date="202404",ftp_config=None, max_workers=SMHIConfig.DEFAULT_FTP_POOL_SIZE, sync=False, chunks=SMHIConfig.DEFAULT_CHUNKS):
     """
     Fetches data from ftp server and returns it as an xarray dataset.
     Args:
@@ -45,10 +318,12 @@ def smhi_data_request(living_lab="georgia", data_dir="seasonal_forecast", issue_
         - data_dir (str): The data directory to fetch the data from. Example: "seasonal_forecast".
         - issue_date (str): The issue date of the data to fetch. Example: "202404".
         - ftp_config (dict): The configuration of the FTP server. Example: {"url": "ftp.smhi.se", "folder": "/climate_data", "user": "user", "passwd": "passwd"}.
+        - max_workers (int): The number of ensemble members downloaded in parallel, each on its own FTP session of the pool. Example: 4.
+        - sync (bool): If True, only new or changed members are downloaded, partial downloads are resumed and the local files are verified with their md5.
+        - chunks (dict): The dask chunks of each member, the members are opened lazily. Example: {"time": 100}.
     Returns:
-        - xr.Dataset: The data fetched from the FTP server.
+        - xr.Dataset: The data fetched from the FTP server, with a model dimension.
     """
-    data_array = []
     if ftp_config is None:    
         config= {
             "url":SMHIConfig.FTP_HOST,
@@ -59,31 +334,60 @@ def smhi_data_request(living_lab="georgia", data_dir="seasonal_forecast", issue_
     else:
         config = ftp_config
 
-    # Connect to FTP server
-    ftp = FTP(config['url'])
-    ftp.login(user=config['user'], passwd=config['passwd'])
-
     remote_folder = f"{config['folder']}/{living_lab}/{data_dir}/{issue_date}"
-    local_folder = f"./{data_dir}/{issue_date}"
-
-    with FTP(config['url']) as ftp:
-        ftp.login(config['user'], config['passwd'])
-        ftp.cwd(remote_folder)
-        
-        files = download_files_from_ftp(ftp, remote_folder)
 
-    for file_nc in files:
-        file_nc_path = f"{local_folder}/{file_nc}"
-        data = read_netcdf(file_nc)
+    # the authenticated sessions are kept open and reused by the next requests to the same server
+    pool = get_ftp_pool(config, max_workers)
+    files = download_files_from_ftp(pool, remote_folder, max_workers, sync)
 
-        model = file_nc_path.split('COUT_')[1].split('.')[0]
-        data.coords['model'] = model
+    output_ds = open_ensemble(files, chunks)
 
-        if "COUT" in data:
-            data["COUT"] = data["COUT"].expand_dims('model')
+    return output_ds
 
-        data_array.append(data)
 
-    output_ds = xr.merge(data_array)
+def smhi_batch_request(living_labs, issue_dates, data_dir="seasonal_forecast", ftp_config=None, max_workers=SMHIConfig.DEFAULT_FTP_POOL_SIZE, max_requests=SMHIConfig.DEFAULT_MAX_REQUESTS, sync=False, chunks=SMHIConfig.DEFAULT_CHUNKS, fileout=None):
+    """
+    Fetches the data of several living labs and issue dates, max_requests of them at a time.
+    All the downloads share the same pool of max_workers FTP sessions.
+    Args:
+        - living_labs (list): The living labs to fetch the data from. Example: ["georgia", "rhine"].
+        - issue_dates (list): The issue dates of the data to fetch. Example: ["202401", "202402"].
+        - max_requests (int): The number of living labs and issue dates fetched concurrently. Example: 4.
+        - fileout (str): If set, each living lab and issue date is written to the group <living_lab>/<issue_date>
+          of fileout (.nc or .zarr) or appended to fileout (.csv) as soon as it is fetched.
+        - the other arguments are the ones of smhi_data_request.
+    Returns:
+        - xr.Dataset: The data with living_lab and issue_date dimensions (outer join of the time and id
+          coordinates), or the content of fileout as a DataTree or a DataFrame.
+    """
+    writer = GroupWriter(fileout) if fileout else None
+    datasets = {}
+    with BoundedExecutor(max_workers=max_requests) as executor:
+        requests = {}
+        for living_lab in living_labs:
+            for issue_date in issue_dates:
+                thrd = ThreadReturn(target=smhi_data_request, kwargs={"living_lab": living_lab, "data_dir": data_dir, "issue_date": issue_date, "ftp_config": ftp_config, "max_workers": max_workers, "sync": sync, "chunks": chunks})
+                requests[thrd] = (living_lab, issue_date)
+                executor.submit(thrd)
+        for thrd in executor.as_completed():
+            ds = thrd.get_return_value()
+            if ds is None:
+                continue
+            living_lab, issue_date = requests[thrd]
+            ds = ds.assign_coords(living_lab=living_lab, issue_date=issue_date)
+            if writer is not None:
+                writer.write(ds, group=f"{living_lab}/{issue_date}")
+            else:
+                datasets[(living_lab, issue_date)] = ds
+        executor.raise_failures()
 
-    return output_ds
+    if writer is not None:
+        return writer.result()
+    if not datasets:
+        return None
+    by_living_lab = []
+    for living_lab in living_labs:
+        pieces = [datasets[(living_lab, issue_date)] for issue_date in issue_dates if (living_lab, issue_date) in datasets]
+        if pieces:
+            by_living_lab.append(xr.concat(pieces, dim="issue_date", join="outer", coords="minimal", compat="override"))
+    return xr.concat(by_living_lab, dim="living_lab", join="outer", coords="minimal", compat="override")
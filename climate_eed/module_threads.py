@@ -1,17 +1,78 @@
+import ftplib
 import inspect
+import random
 import threading
-import planetary_computer
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import numpy as np
 import xarray as xr 
+from climate_eed.module_cache import STAC_CACHE, subset_bbox
+from climate_eed.module_config import PlanetaryConfig
+from climate_eed.module_geometry import geometry_bbox, mask_geometry
+from climate_eed.module_resample import drop_count
+from climate_eed.module_transform import parse_transform
 # import s3fs
 
 
+RETRYABLE_STATUS = (408, 425, 429, 500, 502, 503, 504)
+RETRYABLE_MESSAGES = ("timed out", "timeout", "too many requests", "throttl", "server busy", "serverbusy", "connection reset", "connection aborted", "temporarily unavailable")
+
+
+def error_status(error):
+    """
+    error_status - the HTTP status carried by the error, if any (requests, aiohttp and azure errors)
+    """
+    for status in (getattr(error, "status", None), getattr(error, "status_code", None), getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=PlanetaryConfig.DEFAULT_MAX_ATTEMPTS, backoff=PlanetaryConfig.DEFAULT_BACKOFF, max_backoff=PlanetaryConfig.DEFAULT_MAX_BACKOFF, jitter=PlanetaryConfig.DEFAULT_JITTER):
+        """
+        RetryPolicy - how many times a task is attempted and how long to wait in between:
+        backoff * 2 ** (attempt - 1) seconds, capped at max_backoff, plus a random jitter fraction of it
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def is_retryable(self, error):
+        """
+        is_retryable - transient network, throttling and server errors are retried, the others are not
+        """
+        status = error_status(error)
+        if status is not None:
+            return status in RETRYABLE_STATUS
+        if isinstance(error, (FileNotFoundError, PermissionError, KeyError, ValueError, TypeError)):
+            return False
+        if isinstance(error, (TimeoutError, ConnectionError, ftplib.error_temp)):
+            return True
+        message = str(error).lower()
+        return isinstance(error, OSError) or any(text in message for text in RETRYABLE_MESSAGES)
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay + random.uniform(0, delay * self.jitter)
+
+
 class ThreadReturn(threading.Thread):
-    def __init__(self, target, args=None, kwargs=None):
+    def __init__(self, target, args=None, kwargs=None, retry=None, timeout=None):
         """
         awslambda - call a lambda function
+        retry (RetryPolicy) - retries the call on transient errors, timeout (seconds) - passed to the target if it takes
+        a timeout argument, which bounds its connections and reads: an attempt that stalls fails with a TimeoutError
+        in its own worker, nothing is left running in the background
         """
         super().__init__()
         self.target = target
+        self.retry = retry or RetryPolicy(max_attempts=1)
+        self.timeout = timeout
+        self.attempts = 0
+        self.elapsed = 0
         self.event = {}
         if args is not None:
             argnames = inspect.getfullargspec(self.target).args
@@ -22,28 +83,145 @@ class ThreadReturn(threading.Thread):
                 if key in argnames:
                     self.event[key] = kwargs[key]
         self.result = None
+        self.error = None
+
+    def call(self):
+        event = self.event
+        if self.timeout and "timeout" in inspect.getfullargspec(self.target).args and event.get("timeout") is None:
+            event = {**event, "timeout": self.timeout}
+        return self.target(**event)
 
     def run(self):
         """
         run - thread run method
         """
-        response = self.target(**self.event)
-        self.result = response
+        t0 = time.time()
+        while True:
+            self.attempts += 1
+            try:
+                response = self.call()
+                self.result = response
+                self.error = None
+                break
+            except Exception as e:
+                self.error = e
+                if self.attempts >= self.retry.max_attempts or not self.retry.is_retryable(e):
+                    self.elapsed = time.time() - t0
+                    raise
+                time.sleep(self.retry.delay(self.attempts))
+        self.elapsed = time.time() - t0
         return self.result
 
     def get_return_value(self):
         return self.result
 
+    def failure(self):
+        """
+        failure - structured report of the failed task, None if it succeeded
+        """
+        if self.error is None:
+            return None
+        return {
+            "target": self.target.__name__,
+            "item": getattr(self.event.get("item"), "id", None),
+            "attempts": self.attempts,
+            "elapsed": round(self.elapsed, 3),
+            "error_type": type(self.error).__name__,
+            "error": str(self.error),
+            "retryable": self.retry.is_retryable(self.error),
+        }
+
+
+def open_asset(asset, lazy=False, timeout=None):
+    """
+    open_asset - open the asset with its xarray:open_kwargs, with lazy=True the
+    variables are backed by dask arrays on the native storage chunks.
+    With a timeout (seconds), the connections and reads of the Azure Blob and HTTP stores fail past it
+    """
+    open_kwargs = dict(asset.extra_fields.get("xarray:open_kwargs", {}))
+    if lazy:
+        open_kwargs["chunks"] = open_kwargs.get("chunks") or {}
+    if timeout:
+        scheme = urlparse(asset.href).scheme
+        storage_options = dict(open_kwargs.get("storage_options") or {})
+        if scheme in ("abfs", "az") or "account_name" in storage_options:
+            storage_options.update(connection_timeout=timeout, read_timeout=timeout)
+            open_kwargs["storage_options"] = storage_options
+        elif scheme in ("http", "https") and open_kwargs.get("engine") == "zarr":
+            import aiohttp
+            storage_options["client_kwargs"] = {**storage_options.get("client_kwargs", {}), "timeout": aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)}
+            open_kwargs["storage_options"] = storage_options
+    return xr.open_dataset(asset.href, **open_kwargs)
+
+
+def bbox_chunks(ds):
+    """
+    bbox_chunks - one spatial chunk covering the whole (already sliced) bbox
+    """
+    return {dim: -1 for dim in ("lat", "lon") if dim in ds.dims}
+
+
+def select_points(ds, points):
+    """
+    select_points - reads the data at the points with vectorized (pointwise) indexing, only the grid cells
+    (method "nearest") or the bilinear neighbourhoods (method "linear") of the points are read.
+    The points are in the format of parse_points, the result has a station dimension in place of lat and lon.
+    """
+    lons = np.asarray(points["lon"], dtype=float)
+    if float(ds["lon"].max()) > 180:
+        lons = lons % 360
+    station = xr.DataArray(points["station"], dims="station")
+    lon = xr.DataArray(lons, dims="station", coords={"station": station})
+    lat = xr.DataArray(np.asarray(points["lat"], dtype=float), dims="station", coords={"station": station})
+    if points.get("method", "nearest") == "nearest":
+        ds = ds.sel(lon=lon, lat=lat, method="nearest")
+    else:
+        if ds["lat"].size > 1 and ds["lat"][0] > ds["lat"][-1]:
+            ds = ds.isel(lat=slice(None, None, -1))
+        ds = ds.interp(lon=lon, lat=lat, method=points["method"])
+    ds = ds.assign_coords(station_lon=("station", points["lon"]), station_lat=("station", points["lat"]))
+    return ds.transpose("station", ...)
 
-def get_planetary_item(item, varname, bbox, factor):
+
+def get_planetary_item(item, varname, bbox, factor, lazy=False, cache=None, points=None, geometry=None, resample=None, regrid=None, transform=None, timeout=None):
     output_ds = None
-    signed_item = planetary_computer.sign(item)
-    asset = signed_item.assets.get(varname)
-    if asset:
-        dataset = xr.open_dataset(asset.href, **asset.extra_fields["xarray:open_kwargs"])
-        ds = dataset[varname]
-        if bbox:
-            ds = ds.sel(lat=slice(bbox[3],bbox[1]), lon=slice(bbox[0],bbox[2])) * factor
+    if points:
+        # the tile cache is keyed by bbox, the points are read straight from the asset
+        cache = None
+    if geometry:
+        # the bbox of the geometry is read (and cached), then the cells outside of the geometry are masked
+        bbox = geometry["bbox"]
+    ds = cache.get(item.collection_id, item.id, varname, bbox, lazy=lazy) if cache is not None else None
+    if ds is None:
+        signed_item = STAC_CACHE.sign(item)
+        asset = signed_item.assets.get(varname)
+        if asset:
+            dataset = open_asset(asset, lazy, timeout)
+            ds = dataset[varname]
+            if points:
+                ds = select_points(ds, points)
+            elif geometry:
+                ds = subset_bbox(ds, geometry_bbox(ds, geometry))
+            elif bbox:
+                ds = ds.sel(lat=slice(bbox[3],bbox[1]), lon=slice(bbox[0],bbox[2]))
+            if cache is not None:
+                # read the subset once, then serve it from the local tile
+                cache.put(item.collection_id, item.id, varname, ds, bbox)
+                ds = cache.get(item.collection_id, item.id, varname, bbox, lazy=lazy)
+    if ds is not None:
+        if geometry:
+            ds = mask_geometry(ds, geometry)
+        transform = parse_transform(transform, factor)
+        if transform is not None:
+            # each item is a slice of the time series, only the forecast steps can be de-accumulated per item
+            ds = transform.apply(ds, sliced="time")
+        if regrid is not None:
+            ds = regrid.regrid(ds)
+        if resample is not None:
+            # the item is reduced in its worker, before the concat
+            ds = resample.reduce(ds)
+        if lazy:
+            ds = ds.chunk(bbox_chunks(ds))
         output_ds = ds
     return output_ds
 
@@ -76,18 +254,48 @@ def get_planetary_item(item, varname, bbox, factor):
 #     return output_ds
 
 
-def get_planetary_model(item, varname, bbox, factor):
+def get_planetary_model(item, varname, bbox, factor, start_date=None, end_date=None, lazy=False, cache=None, points=None, geometry=None, resample=None, regrid=None, transform=None, timeout=None):
     output_ds = None
-    asset = item.assets[varname]
-
-    if asset:    
-        ds = xr.open_dataset(asset.href, **asset.extra_fields["xarray:open_kwargs"])
-        output_ds = ds
+    if points:
+        cache = None
+    if geometry:
+        bbox = geometry["bbox"]
+    source_id = item.properties.get("cmip6:source_id")
+    da = cache.get(item.collection_id, item.id, varname, bbox, start_date, end_date, lazy=lazy) if cache is not None else None
+    if da is None:
+        asset = STAC_CACHE.sign(item).assets[varname]
+        if asset:    
+            ds = open_asset(asset, lazy, timeout)
+            source_id = ds.attrs.get("source_id", source_id)
+            da = ds[varname]
+            if points:
+                da = select_points(da, points)
+            elif geometry:
+                da = subset_bbox(da, geometry_bbox(da, geometry))
+            elif bbox:
+                da = da.sel(lon=slice(bbox[0], bbox[2]), lat=slice(bbox[1], bbox[3]))
+            if start_date or end_date:
+                da = da.sel(time=slice(start_date, end_date))
+            if cache is not None:
+                cache.put(item.collection_id, item.id, varname, da, bbox, start_date, end_date)
+                da = cache.get(item.collection_id, item.id, varname, bbox, start_date, end_date, lazy=lazy)
+    if da is not None:
+        if geometry:
+            da = mask_geometry(da, geometry)
+        transform = parse_transform(transform, factor)
+        if transform is not None:
+            da = transform.apply(da)
+        if regrid is not None:
+            da = regrid.regrid(da)
+        if resample is not None:
+            # each model covers the whole period, there are no partial periods to recombine
+            da = drop_count(resample.reduce(da))
+        output_ds = da.assign_coords(model=source_id)
     return output_ds
 
 
-def get_planetary_item_thr(item, varname, bbox, factor):
-    thread = ThreadReturn(target=get_planetary_item, kwargs={"item":item,"varname":varname,"bbox":bbox,"factor":factor})
+def get_planetary_item_thr(item, varname, bbox, factor, lazy=False, cache=None, retry=None, timeout=None, points=None, geometry=None, resample=None, regrid=None, transform=None):
+    thread = ThreadReturn(target=get_planetary_item, kwargs={"item":item,"varname":varname,"bbox":bbox,"factor":factor,"lazy":lazy,"cache":cache,"points":points,"geometry":geometry,"resample":resample,"regrid":regrid,"transform":transform}, retry=retry, timeout=timeout)
     return thread
 
 
@@ -96,18 +304,94 @@ def get_planetary_item_thr(item, varname, bbox, factor):
 #     return thread
 
 
-def get_planetary_model_thr(item, varname, bbox, factor):
-    thread = ThreadReturn(target=get_planetary_model, kwargs={"item":item,"varname":varname,"bbox":bbox,"factor":factor})
+def get_planetary_model_thr(item, varname, bbox, factor, start_date=None, end_date=None, lazy=False, cache=None, retry=None, timeout=None, points=None, geometry=None, resample=None, regrid=None, transform=None):
+    thread = ThreadReturn(target=get_planetary_model, kwargs={"item":item,"varname":varname,"bbox":bbox,"factor":factor,"start_date":start_date,"end_date":end_date,"lazy":lazy,"cache":cache,"points":points,"geometry":geometry,"resample":resample,"regrid":regrid,"transform":transform}, retry=retry, timeout=timeout)
     return thread
 
 
-def start_thread(thread,comnplete_thread_event=None):
-    if comnplete_thread_event:
-        comnplete_thread_event.wait()
-    thread.start()
-    completed_event = threading.Event()
-    return completed_event
+def raise_failures(failures):
+    """
+    raise_failures - raises a RuntimeError listing the failures (ThreadReturn.failure reports), if any
+    """
+    if not failures:
+        return
+    errors = "; ".join(f"{failure.get('item') or failure.get('target', 'task')}: {failure.get('error_type', 'Exception')}: {failure.get('error')}" for failure in failures)
+    raise RuntimeError(f"{len(failures)} tasks failed: {errors}")
+
+
+class BoundedExecutor:
+    def __init__(self, max_workers=PlanetaryConfig.DEFAULT_MAX_WORKERS, max_per_host=None):
+        """
+        BoundedExecutor - run ThreadReturn tasks on a fixed size pool of workers,
+        optionally limiting the number of concurrent tasks against the same host.
+        max_per_host defaults to max_workers (no limit), a smaller value only matters with several hosts
+        """
+        self.max_workers = max_workers
+        self.max_per_host = min(max_per_host or max_workers, max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.failures = []
+
+    def get_host_semaphore(self, host):
+        if not host or self.max_per_host >= self.max_workers:
+            return None
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_semaphores[host]
+
+    def run_task(self, thread, host):
+        semaphore = self.get_host_semaphore(host)
+        if semaphore is None:
+            return thread.run()
+        with semaphore:
+            return thread.run()
+
+    def submit(self, thread, host=None):
+        """
+        submit - schedule a ThreadReturn task, it runs inside a pool worker instead of its own thread
+        """
+        future = self.executor.submit(self.run_task, thread, host)
+        self.futures[future] = thread
+        return future
+
+    def as_completed(self):
+        """
+        as_completed - yields the submitted tasks as soon as they finish. A failed task is yielded with its error
+        (thread.error, thread.failure()) and its report is added to failures, the caller decides what to do with it
+        """
+        for future in as_completed(list(self.futures)):
+            thread = self.futures.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                thread.error = e
+                self.failures.append(thread.failure() if isinstance(thread, ThreadReturn) else {"error_type": type(e).__name__, "error": str(e)})
+            yield thread
+
+    def raise_failures(self):
+        """
+        raise_failures - raises the failures of the tasks completed so far, if any
+        """
+        raise_failures(self.failures)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
 
 
-def join_thread(thread):
-    thread.join()
\ No newline at end of file
+def get_item_host(item, varname):
+    """
+    get_item_host - returns the host serving the asset of the item, used to cap per-host concurrency
+    """
+    asset = item.assets.get(varname)
+    if asset is None:
+        return None
+    return urlparse(asset.href).netloc
@@ -0,0 +1,154 @@
+import json
+
+import numpy as np
+import xarray as xr
+
+
+# (source units, target units): (scale, offset)
+UNITS = {
+    ("K", "degC"): (1.0, -273.15),
+    ("degC", "K"): (1.0, 273.15),
+    ("m", "mm"): (1000.0, 0.0),
+    ("mm", "m"): (0.001, 0.0),
+    ("Pa", "hPa"): (0.01, 0.0),
+    ("hPa", "Pa"): (100.0, 0.0),
+    ("kg m-2 s-1", "mm day-1"): (86400.0, 0.0),
+    ("m s-1", "km h-1"): (3.6, 0.0),
+}
+UNITS_ALIASES = {"C": "degC", "celsius": "degC", "degrees_celsius": "degC", "kelvin": "K", "kg m**-2 s**-1": "kg m-2 s-1", "m s**-1": "m s-1"}
+ELEMENTWISE = ("scale", "offset", "clip")
+
+
+def units_name(units):
+    return UNITS_ALIASES.get(units, units)
+
+
+def parse_step(step):
+    """
+    Returns the (operation, arguments) of a step of the pipeline:
+    scale:<a>, offset:<b>, units:[<from>:]<to>, clip:<min>:<max> (either bound can be empty) or deaccumulate[:<dim>].
+    """
+    name, *args = [arg.strip() for arg in str(step).split(":")]
+    if name in ("scale", "offset"):
+        return name, (float(args[0]),)
+    if name == "clip":
+        bounds = (args + ["", ""])[:2]
+        return name, tuple(float(bound) if bound else None for bound in bounds)
+    if name == "units":
+        if len(args) == 1:
+            return name, (None, units_name(args[0]))
+        return name, (units_name(args[0]), units_name(args[1]))
+    if name == "deaccumulate":
+        return name, (args[0] if args else None,)
+    raise ValueError(f"Unsupported transform step: {step}, must be one of scale, offset, units, clip or deaccumulate")
+
+
+class Transform:
+    def __init__(self, steps):
+        """
+        Transform - the pipeline of steps applied to each variable once it is fetched, by variable name ("*" for any variable).
+        The elementwise steps (scale, offset, units, clip) run fused in a single pass per chunk, dask-backed data stays lazy.
+        """
+        self.steps = steps
+
+    def __repr__(self):
+        return json.dumps({name: ["%s:%s" % (op, ":".join("" if arg is None else str(arg) for arg in args)) for op, args in steps] for name, steps in self.steps.items()}, sort_keys=True)
+
+    def steps_of(self, name):
+        return self.steps.get(name, self.steps.get("*", []))
+
+    def apply(self, data, sliced=None):
+        """
+        apply - data with the steps of each of its variables applied. sliced is the dimension along which data
+        is one slice of a longer series (time for the items fetched one at a time), it cannot be de-accumulated
+        slice by slice: the first value of each slice would be left accumulated.
+        """
+        if isinstance(data, xr.Dataset):
+            # assign keeps the attributes set by the steps (the units), map would restore the original ones
+            return data.assign({name: self.apply_array(da, self.steps_of(name), sliced) for name, da in data.data_vars.items()})
+        return self.apply_array(data, self.steps_of(data.name), sliced)
+
+    def apply_array(self, da, steps, sliced=None):
+        units = da.attrs.get("units")
+        fused = []
+        for op, args in steps:
+            if op == "units":
+                source, target = args[0] or units_name(units), args[1]
+                if (source, target) not in UNITS:
+                    raise ValueError(f"Unsupported units conversion of {da.name}: {source} to {target}")
+                scale, offset = UNITS[(source, target)]
+                fused += [("scale", (scale,)), ("offset", (offset,))]
+                units = target
+            elif op in ELEMENTWISE:
+                fused.append((op, args))
+            else:
+                dim = args[0] or ("step" if "step" in da.dims else "time")
+                if dim == sliced:
+                    raise ValueError(f"Cannot deaccumulate {da.name} along {dim}: each fetched slice would keep its first value accumulated, deaccumulate the concatenated result instead")
+                da = fuse(da, fused)
+                fused = []
+                da = deaccumulate(da, dim)
+        da = fuse(da, fused)
+        if units != da.attrs.get("units"):
+            da = da.assign_attrs(units=units)
+        return da
+
+
+def fuse(da, steps):
+    """
+    Applies the elementwise steps in a single pass, one task per chunk for dask-backed data.
+    """
+    if not steps:
+        return da
+    if not np.issubdtype(da.dtype, np.floating):
+        da = da.astype(np.float64)
+
+    def apply_steps(values):
+        values = np.array(values, copy=True)
+        for op, args in steps:
+            if op == "scale":
+                values *= args[0]
+            elif op == "offset":
+                values += args[0]
+            else:
+                np.clip(values, args[0], args[1], out=values)
+        return values
+
+    return xr.apply_ufunc(apply_steps, da, dask="parallelized", output_dtypes=[da.dtype], keep_attrs=True)
+
+
+def deaccumulate(da, dim=None):
+    """
+    Returns the increments of an accumulated variable (ERA5 forecasts are accumulated from the start of the forecast)
+    along dim, by default step if da has one (the forecasts) else time. The first value is kept as it is.
+    """
+    dim = dim or ("step" if "step" in da.dims else "time")
+    if dim not in da.dims or da.sizes[dim] < 2:
+        return da
+    increments = da.diff(dim, label="upper")
+    return xr.concat([da.isel({dim: [0]}), increments], dim=dim).transpose(*da.dims)
+
+
+def parse_transform(transform, factor=1):
+    """
+    Returns the Transform of a pipeline specification, with the factor as its first scale step, None if there is nothing to do.
+    The pipeline is a list of steps or a "|" separated string, or a dict of them by variable name.
+    Example: "units:K:degC", "deaccumulate|scale:1000|clip:0:" or {"tp": "deaccumulate|scale:1000", "t2m": "units:degC"}.
+    """
+    if isinstance(transform, Transform):
+        return transform
+    if isinstance(transform, str) and transform.strip().startswith("{"):
+        transform = json.loads(transform)
+    if not isinstance(transform, dict):
+        transform = {"*": transform} if transform else {}
+    steps = {}
+    for name, pipeline in transform.items():
+        if isinstance(pipeline, str):
+            pipeline = pipeline.split("|")
+        steps[name] = [parse_step(step) for step in pipeline if str(step).strip()]
+    if factor is not None and float(factor) != 1:
+        for name in list(steps) + ([] if "*" in steps else ["*"]):
+            steps[name] = [("scale", (float(factor),))] + steps.get(name, [])
+    if not any(steps.values()):
+        return None
+    return Transform(steps)
@@ -0,0 +1,169 @@
+import os
+import shutil
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from climate_eed.filesystem import justext, mkdirs, justpath, remove
+
+
+class StreamWriter:
+    def __init__(self, fileout, append_dim="time"):
+        """
+        StreamWriter - appends the slices to fileout along append_dim as soon as they are written,
+        so that only one slice at a time is held in memory and an interrupted download leaves
+        the slices written so far behind
+        """
+        self.fileout = fileout
+        self.append_dim = append_dim
+        self.count = 0
+        self.name = None
+        self.indexes = None
+        mkdirs(justpath(fileout))
+        if os.path.isdir(fileout):
+            shutil.rmtree(fileout)
+        else:
+            remove(fileout)
+
+    def align(self, ds):
+        """
+        align - reindexes the slice on the coordinates of the first slice, except append_dim: the dimensions
+        written by the first slice cannot grow, the values of a slice out of them are dropped and the missing ones are NaN
+        """
+        if self.indexes is None:
+            self.indexes = {dim: index for dim, index in ds.indexes.items() if dim != self.append_dim}
+            return ds
+        return ds.reindex({dim: index for dim, index in self.indexes.items() if dim in ds.dims})
+
+    def prepare(self, data):
+        if isinstance(data, xr.DataArray):
+            self.name = self.name or data.name or "data"
+            data = data.to_dataset(name=self.name)
+        if self.append_dim not in data.dims:
+            data = data.expand_dims(self.append_dim)
+        return data.drop_encoding().load()
+
+    def write(self, data):
+        if data is None:
+            return
+        self.append(self.align(self.prepare(data)))
+        self.count += 1
+
+    def append(self, ds):
+        raise NotImplementedError
+
+    def result(self):
+        """
+        result - returns the written data, opened lazily
+        """
+        if not self.count:
+            return None
+        ds = xr.open_dataset(self.fileout, chunks={})
+        return ds[self.name] if self.name else ds
+
+
+class NetCDFWriter(StreamWriter):
+    def append(self, ds):
+        if not self.count:
+            ds.to_netcdf(self.fileout, unlimited_dims=[self.append_dim])
+            return
+        with netCDF4.Dataset(self.fileout, "a") as nc:
+            start = len(nc.dimensions[self.append_dim])
+            for name, variable in ds.variables.items():
+                if self.append_dim not in variable.dims or name not in nc.variables:
+                    continue
+                ncvar = nc.variables[name]
+                values = variable.transpose(*ncvar.dimensions).values
+                if np.issubdtype(values.dtype, np.datetime64):
+                    values = netCDF4.date2num(pd.to_datetime(values.ravel()).to_pydatetime(), ncvar.units, getattr(ncvar, "calendar", "standard"))
+                axis = ncvar.dimensions.index(self.append_dim)
+                index = [slice(None)] * ncvar.ndim
+                index[axis] = slice(start, start + variable.sizes[self.append_dim])
+                ncvar[tuple(index)] = values
+
+
+class ZarrWriter(StreamWriter):
+    def append(self, ds):
+        if not self.count:
+            ds.to_zarr(self.fileout, mode="w")
+        else:
+            ds.to_zarr(self.fileout, append_dim=self.append_dim)
+
+    def result(self):
+        if not self.count:
+            return None
+        ds = xr.open_zarr(self.fileout)
+        return ds[self.name] if self.name else ds
+
+
+class CSVWriter(StreamWriter):
+    def append(self, ds):
+        ds.to_dataframe().to_csv(self.fileout, mode="a", header=not self.count)
+
+    def result(self):
+        if not self.count:
+            return None
+        return pd.read_csv(self.fileout)
+
+
+class GroupWriter:
+    def __init__(self, fileout):
+        """
+        GroupWriter - writes each piece of a batch to its own group of fileout (NetCDF or Zarr),
+        or appends its rows to fileout (CSV), so that pieces on different grids can share one store
+        """
+        self.fileout = fileout
+        self.ext = justext(fileout).lower()
+        self.count = 0
+        if self.ext not in ("nc", "nc4", "netcdf", "zarr", "csv"):
+            raise ValueError(f"Unsupported output format: {fileout}, must have extension .nc, .zarr or .csv")
+        mkdirs(justpath(fileout))
+        if os.path.isdir(fileout):
+            shutil.rmtree(fileout)
+        else:
+            remove(fileout)
+
+    def write(self, data, group):
+        if data is None:
+            return
+        ds = data.drop_encoding()
+        if self.ext == "zarr":
+            ds.to_zarr(self.fileout, group=group, mode="a")
+        elif self.ext == "csv":
+            ds.to_dataframe().to_csv(self.fileout, mode="a", header=not self.count)
+        else:
+            ds.to_netcdf(self.fileout, group=group, mode="a" if self.count else "w")
+        self.count += 1
+
+    def result(self):
+        """
+        result - returns the written data, as a lazily opened DataTree (one node per group) or as a DataFrame
+        """
+        if not self.count:
+            return None
+        if self.ext == "csv":
+            return pd.read_csv(self.fileout)
+        return xr.open_datatree(self.fileout, chunks={})
+
+
+def get_writer(fileout, append_dim="time"):
+    """
+    Returns the streaming writer matching the extension of fileout.
+    Args:
+        - fileout (str): The file to write to, with extension .nc, .zarr or .csv. Example: "output.nc".
+        - append_dim (str): The dimension the slices are appended along. Example: "time".
+    Returns:
+        - StreamWriter: The writer, None if fileout is empty.
+    """
+    if not fileout:
+        return None
+    ext = justext(fileout).lower()
+    if ext in ("nc", "nc4", "netcdf"):
+        return NetCDFWriter(fileout, append_dim)
+    elif ext == "zarr":
+        return ZarrWriter(fileout, append_dim)
+    elif ext == "csv":
+        return CSVWriter(fileout, append_dim)
+    raise ValueError(f"Unsupported output format: {fileout}, must have extension .nc, .zarr or .csv")
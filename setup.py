@@ -25,7 +25,8 @@ setuptools.setup(
         'planetary_computer',
         'pandas',
         'numpy',
-        # 'netCDF4',
+        'netCDF4',
+        'scipy',
         'adlfs',
         'click',
         # 's3fs',
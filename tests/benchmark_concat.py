@@ -0,0 +1,48 @@
+"""
+Benchmark of the concatenation of monthly items along the time dimension.
+
+Compares the former pairwise accumulation (one xr.concat per item) with
+concat_by_time, which sorts the items and concatenates them in a single call.
+
+Usage: python -m tests.benchmark_concat
+"""
+import random
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from climate_eed.module_planetary_operations import concat_by_time
+
+
+def make_monthly_items(n_items, nlat=9, nlon=13):
+    items = []
+    for start in pd.date_range("1950-01-01", periods=n_items, freq="MS"):
+        times = pd.date_range(start, start + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=23), freq="h")
+        data = np.random.rand(len(times), nlat, nlon).astype("float32")
+        items.append(xr.DataArray(data, dims=("time", "lat", "lon"), coords={"time": times}, name="var"))
+    random.shuffle(items)
+    return items
+
+
+def pairwise_concat(items):
+    output_ds = None
+    for ds in sorted(items, key=lambda ds: ds["time"].values[0]):
+        output_ds = ds if output_ds is None else xr.concat([output_ds, ds], dim="time")
+    return output_ds
+
+
+def timeit(func, items):
+    t0 = time.perf_counter()
+    func(items)
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    print(f"{'items':>6} {'pairwise (s)':>14} {'single (s)':>12} {'single / item (ms)':>20}")
+    for n_items in (12, 60, 120, 240, 360):
+        items = make_monthly_items(n_items)
+        t_pairwise = timeit(pairwise_concat, items)
+        t_single = timeit(concat_by_time, items)
+        print(f"{n_items:>6} {t_pairwise:>14.3f} {t_single:>12.3f} {1000 * t_single / n_items:>20.3f}")
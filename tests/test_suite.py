@@ -1,8 +1,28 @@
+import json
 import os
+import tempfile
+import time
+import numpy as np
 import pandas as pd
 import pytest
 import xarray as xr
 from climate_eed import fetch_var_planetary, fetch_var_smhi, fetch_var_copernicus, list_repo_vars
+from climate_eed.module_async_operations import get_data_from_items_async, run_or_defer, run_threads_async
+from climate_eed.module_cache import CDSCache, STAC_CACHE, StacCache, TileCache
+from climate_eed.module_checkpoint import JobManifest
+from climate_eed.module_commands import submit_var_copernicus
+from climate_eed.module_config import CopernicusConfig, PlanetaryConfig, parse_points
+from climate_eed.module_copernicus_operations import CDSJob, as_completed_cds_jobs, cds_data_request, load_cds_jobs, merge_parts, open_cds_output, part_filename, split_query, submit_cds_job
+from climate_eed.module_ensemble import EnsembleStatistics
+from climate_eed.module_geometry import mask_geometry, parse_geometry
+from climate_eed.module_planetary_operations import ItemsCollector, ModelsCollector, concat_by_time, filter_models, get_data_from_items, var_list_request
+from climate_eed.module_planner import FETCHERS, SourceRequest, fetch_all, plan_requests
+from climate_eed.module_regrid import parse_target_grid
+from climate_eed.module_resample import drop_count, parse_resample
+from climate_eed.module_smhi_operations import FTPPool, SyncManifest, download_files_from_ftp, open_ensemble, smhi_batch_request
+from climate_eed.module_threads import BoundedExecutor, RetryPolicy, ThreadReturn, get_planetary_item, get_planetary_model, select_points
+from climate_eed.module_transform import parse_transform
+from climate_eed.module_writer import GroupWriter, get_writer
 
 
 def test_era5_fetch_var():
@@ -19,6 +39,900 @@ def test_era5_fetch_var():
     assert data_ERA5.shape == (8760, 9, 13)
 
 
+def test_concat_by_time():
+    """Test that concat_by_time merges out of order monthly slices in time order."""
+
+    months = pd.date_range("1995-01-01", periods=6, freq="MS")
+    slices = [xr.DataArray(np.full((2, 3, 4), i), dims=("time", "lat", "lon"), coords={"time": [month, month + pd.Timedelta(days=1)]}) for i, month in enumerate(months)]
+    data = concat_by_time([slices[3], None, slices[0], slices[5], slices[1], slices[4], slices[2]])
+
+    assert data.shape == (12, 3, 4)
+    assert data.indexes["time"].is_monotonic_increasing
+    assert list(data[::2, 0, 0].values) == [0, 1, 2, 3, 4, 5]
+
+
+def test_split_query():
+    """Test that split_query splits a CDS query in sized sub-queries along the split key."""
+
+    query = {'format': 'grib', 'year': ['1993', '1994', '1995', '1996', '1997'], 'month': '05'}
+    queries = split_query(query, "year", 2)
+
+    assert [q['year'] for q in queries] == [['1993', '1994'], ['1995', '1996'], ['1997']]
+    assert all(q['month'] == '05' for q in queries)
+    assert split_query(query, "month") == [query]
+    with pytest.raises(ValueError):
+        split_query(query, "day")
+
+
+def test_select_points():
+    """Test that select_points extracts the (station, time) series at the points, nearest and bilinear."""
+
+    lat = np.arange(50, 39.5, -0.5)
+    lon = np.arange(0, 360, 0.5)
+    values = np.add.outer(np.zeros(3), np.add.outer(lat, lon / 100))
+    data = xr.DataArray(values, dims=("time", "lat", "lon"), coords={"time": pd.date_range("2020-01-01", periods=3), "lat": lat, "lon": lon})
+
+    nearest = select_points(data, parse_points({"a": [-10.1, 45.1], "b": [10.4, 42.2]}))
+    assert nearest.dims == ("station", "time")
+    assert list(nearest.station.values) == ["a", "b"]
+    assert np.allclose(nearest[:, 0], [45.0 + 350.0 / 100, 42.0 + 10.5 / 100])
+
+    linear = select_points(data, parse_points("10.4,42.2", method="linear"))
+    assert np.allclose(linear[0], 42.2 + 10.4 / 100)
+
+
+def test_mask_geometry():
+    """Test that mask_geometry keeps the cells inside the polygon (holes excluded) and averages over it."""
+
+    lat = np.arange(50, 39.5, -1.0)
+    lon = np.arange(0, 11, 1.0)
+    data = xr.DataArray(np.ones((2, lat.size, lon.size)), dims=("time", "lat", "lon"), coords={"time": [0, 1], "lat": lat, "lon": lon})
+    square = [[2.5, 42.5], [7.5, 42.5], [7.5, 47.5], [2.5, 47.5], [2.5, 42.5]]
+    hole = [[4.5, 44.5], [5.5, 44.5], [5.5, 45.5], [4.5, 45.5], [4.5, 44.5]]
+
+    masked = mask_geometry(data, parse_geometry({"type": "Polygon", "coordinates": [square, hole]}))
+    assert masked.sizes == {"time": 2, "lat": 5, "lon": 5}
+    assert int(masked.isel(time=0).notnull().sum()) == 24
+    assert np.isnan(masked.sel(lat=45, lon=5)).all()
+
+    mean = mask_geometry(data, parse_geometry({"type": "Polygon", "coordinates": [square]}, aggregate=True))
+    assert mean.dims == ("time",)
+    assert np.allclose(mean, 1)
+
+
+def test_resample_partial_periods():
+    """Test that the daily means of slices cut in the middle of a day are recombined exactly."""
+
+    time = pd.date_range("2020-01-01", periods=72, freq="h")
+    data = xr.DataArray(np.arange(72.0), dims="time", coords={"time": time})
+    resampler = parse_resample("1D:mean")
+
+    partials = [resampler.reduce(data.isel(time=slice(start, start + 30))) for start in (0, 30, 60)]
+    daily = drop_count(resampler.combine(concat_by_time(partials)))
+
+    assert np.allclose(daily, data.resample(time="1D").mean())
+
+
+def test_ensemble_statistics():
+    """Test that the streamed ensemble statistics match the ones of the concatenated ensemble."""
+
+    rng = np.random.default_rng(0)
+    models = [xr.DataArray(rng.normal(280, 3, (5, 4)), dims=("lat", "lon"), coords={"lat": np.arange(5.0), "lon": np.arange(4.0), "model": f"M{m}"}) for m in range(25)]
+    models[3][0, 0] = np.nan
+    ensemble = xr.concat(models, dim="model")
+    accumulator = EnsembleStatistics(["mean", "std", "min", "max", "median", "q10", "q90"], members=len(models), block_size=7)
+    for model in models:
+        accumulator.add(model)
+    stats = accumulator.result()
+
+    assert np.allclose(stats.sel(statistic="mean"), ensemble.mean("model"))
+    assert np.allclose(stats.sel(statistic="std"), ensemble.std("model"))
+    assert np.allclose(stats.sel(statistic="max"), ensemble.max("model"))
+    for statistic, q in (("median", 0.5), ("q10", 0.1), ("q90", 0.9)):
+        assert np.allclose(stats.sel(statistic=statistic), ensemble.quantile(q, "model"))
+
+
+def test_ensemble_statistics_memory():
+    """Test that streaming the ensemble statistics takes less memory than the concatenated ensemble."""
+
+    import tracemalloc
+
+    def model(m):
+        return xr.DataArray(np.random.default_rng(m).normal(280, 3, (50, 40, 40)).astype("float32"), dims=("time", "lat", "lon"), coords={"time": np.arange(50), "lat": np.arange(40.0), "lon": np.arange(40.0)})
+
+    members = 40
+    stacked = members * 50 * 40 * 40 * 4
+    tracemalloc.start()
+    accumulator = EnsembleStatistics(["mean", "std", "q90"], members=members, block_size=4096)
+    for m in range(members):
+        accumulator.add(model(m))
+    accumulator.result()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak < stacked / 2
+
+
+def test_regrid(tmp_path):
+    """Test that the regridding matches a bilinear interpolation and that its weights are cached on disk."""
+
+    lat = np.arange(50, 39.9, -0.5)
+    lon = np.arange(5, 15.1, 0.5)
+    data = xr.DataArray(np.random.default_rng(0).random((2, lat.size, lon.size)), dims=("time", "lat", "lon"), coords={"time": [0, 1], "lat": lat, "lon": lon})
+    regridder = parse_target_grid("6,41,14,49,0.3", cache_dir=str(tmp_path))
+    regridded = regridder.regrid(data.chunk({"time": 1}))
+
+    assert regridded.chunks is not None
+    assert np.allclose(regridded, data.interp(lat=regridded["lat"], lon=regridded["lon"]))
+    assert len(os.listdir(tmp_path)) == 1
+    # the weights are read back as they are, they are kept per user and not in the shared temporary folder
+    assert not any(folder.startswith(tempfile.gettempdir()) for folder in (PlanetaryConfig.DEFAULT_REGRID_DIR, CopernicusConfig.DEFAULT_INDEX_DIR))
+
+
+def test_transform():
+    """Test that the transform pipeline converts the units, de-accumulates and clips each variable lazily."""
+
+    data = xr.Dataset({
+        "tp": (("time", "step"), np.array([[0.001, 0.003, 0.002, 0.006]])),
+        "t2m": (("time", "step"), np.full((1, 4), 300.0), {"units": "K"}),
+    }).chunk()
+    transform = parse_transform({"tp": "deaccumulate|units:m:mm|clip:0:", "t2m": "units:degC"}, factor=2)
+    transformed = transform.apply(data)
+
+    assert transformed.identical(transform.apply(data, sliced="time"))
+    with pytest.raises(ValueError, match="Cannot deaccumulate tp along time"):
+        transform.apply(data.drop_dims("step").assign(tp=("time", [0.001])), sliced="time")
+    assert transformed["tp"].chunks is not None
+    assert np.allclose(transformed["tp"], [[2, 4, 0, 8]])
+    assert np.allclose(transformed["t2m"], 600 - 273.15)
+    assert transformed["t2m"].attrs["units"] == "degC"
+
+
+@pytest.mark.parametrize("ext", ["nc", "zarr", "csv"])
+def test_writer_aligns_members(tmp_path, ext):
+    """Test that the members streamed along model are written on the time axis of the first member."""
+
+    def member(model, start, periods):
+        time = pd.date_range(start, periods=periods)
+        return xr.DataArray(np.arange(periods, dtype=float)[:, None] + np.zeros((1, 2)), dims=("time", "lat"), coords={"time": time, "lat": [0.0, 1.0], "model": model}, name="tas")
+
+    writer = get_writer(str(tmp_path / f"output.{ext}"), append_dim="model")
+    writer.write(member("A", "2020-01-01", 5))
+    writer.write(member("B", "2020-01-03", 5))
+    writer.write(member("C", "2020-01-01", 3))
+    output = writer.result()
+
+    if ext == "csv":
+        output = output.set_index(["model", "time", "lat"]).to_xarray()["tas"]
+        output["time"] = pd.to_datetime(output["time"])
+    assert np.allclose(output.sel(model="B", lat=0), [np.nan, np.nan, 0, 1, 2], equal_nan=True)
+    assert np.allclose(output.sel(model="C", lat=0), [0, 1, 2, np.nan, np.nan], equal_nan=True)
+    assert output["time"].values[-1] == np.datetime64("2020-01-05")
+
+
+def test_cds_job_poll_failure(tmp_path, monkeypatch):
+    """Test that a job whose state cannot be polled any more is yielded as failed instead of being polled forever."""
+
+    import requests
+
+    class Result:
+        def __init__(self, client, reply):
+            self.reply = reply
+
+        def update(self):
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.HTTPError("404 Client Error: Not Found", response=response)
+
+    monkeypatch.setattr("cdsapi.api.Result", Result)
+    monkeypatch.setattr("climate_eed.module_copernicus_operations.get_cds_jobs_client", lambda: None)
+    job = CDSJob("reanalysis-era5-single-levels", {"year": "2020"}, str(tmp_path / "era5.nc"), request_id="unknown", jobs_dir=str(tmp_path))
+    jobs = list(as_completed_cds_jobs([job], poll_interval=0))
+
+    assert jobs == [job] and job.state == "failed" and "404" in job.error
+    assert CDSJob.load(job.job_file).state == "failed"
+
+
+def test_cds_parts(tmp_path, monkeypatch):
+    """Test that the parts of a split request are keyed by their query and deleted only after a successful merge."""
+
+    requested = []
+
+    def retrieve(dataset, query, fileout, cache=None):
+        requested.append(query["year"])
+        year = int(query["year"][0])
+        xr.Dataset({"t2m": ("time", [float(year)])}, coords={"time": [year]}).to_netcdf(fileout)
+        return fileout
+
+    monkeypatch.setattr("climate_eed.module_copernicus_operations.retrieve", retrieve)
+    dataset, fileout = "reanalysis-era5-single-levels", str(tmp_path / "era5.nc")
+    query = {"variable": "2m_temperature", "year": ["2020", "2021"]}
+    # a part of the same index left behind by a request of another variable
+    stale = part_filename(fileout, 0, dataset, {"variable": "total_precipitation", "year": ["2020"]})
+    xr.Dataset({"tp": ("time", [0.0])}, coords={"time": [2020]}).to_netcdf(stale)
+    ds = cds_data_request(dataset, query, fileout, split_by="year", split_size=1, chunks=None)
+
+    assert requested == [["2020"], ["2021"]]
+    assert list(ds.data_vars) == ["t2m"] and ds["t2m"].values.tolist() == [2020.0, 2021.0]
+    assert part_filename(fileout, 0, dataset, {"year": "2020", "variable": ["2m_temperature"]}) == part_filename(fileout, 0, dataset, {"variable": "2m_temperature", "year": ["2020"]})
+    ds.close()
+
+    parts = [part_filename(fileout, n, dataset, {**query, "year": [year]}) for n, year in enumerate(query["year"])]
+    for part in parts:
+        with open(part, "w") as stream:
+            stream.write("not a netcdf file")
+    with pytest.raises(Exception):
+        merge_parts(parts, str(tmp_path / "merged.nc"), "netcdf4")
+    assert all(os.path.isfile(part) for part in parts) and not os.path.isfile(tmp_path / "merged.nc")
+
+
+class FakeFTP:
+    def __init__(self, files=None, fail=(), modify=None, partial=None, transfers=None):
+        self.files = files or {}
+        self.fail = fail
+        self.modify = modify or {}
+        self.partial = partial or {}
+        self.transfers = transfers if transfers is not None else []
+        self.home = "/"
+        self.alive = True
+        self.closed = False
+
+    def voidcmd(self, cmd):
+        if not self.alive:
+            raise EOFError("connection dropped")
+
+    def cwd(self, folder):
+        pass
+
+    def nlst(self):
+        return list(self.files)
+
+    def mlsd(self, facts=None):
+        for name, content in self.files.items():
+            yield name, {"type": "file", "size": str(len(content)), "modify": self.modify.get(name, "20200101000000")}
+
+    def retrbinary(self, cmd, callback, rest=None):
+        file = cmd.split(" ", 1)[1]
+        self.transfers.append((file, rest))
+        if file in self.fail:
+            raise EOFError(f"transfer of {file} aborted")
+        content = self.files[file][rest or 0:]
+        if file in self.partial:
+            callback(content[:self.partial[file]])
+            raise EOFError(f"transfer of {file} aborted")
+        callback(content)
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+class FakePool(FTPPool):
+    def __init__(self, size=2, timeout=0.2, **kwargs):
+        super().__init__("ftp.example.org", "user", "passwd", size, timeout)
+        self.kwargs = kwargs
+        self.refuse = False
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        if self.refuse:
+            raise ConnectionRefusedError("connection refused")
+        return FakeFTP(**self.kwargs)
+
+
+def test_ftp_pool():
+    """Test that the pool never opens more than size sessions and frees the slots of the failed connections."""
+
+    pool = FakePool(size=2)
+    first, second = pool.acquire(), pool.acquire()
+    assert pool.created == 2
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+    # a session dropped by the server that cannot be reopened frees its slot
+    first.alive = False
+    pool.release(first)
+    pool.refuse = True
+    with pytest.raises(ConnectionRefusedError):
+        pool.acquire()
+    assert first.closed and pool.created == 1
+    pool.refuse = False
+    third = pool.acquire()
+    assert pool.created == 2
+
+    # a failed task discards its session and frees its slot
+    pool.release(second)
+    with pytest.raises(EOFError):
+        with pool.session() as ftp:
+            raise EOFError("transfer aborted")
+    assert second.closed and pool.created == 1
+    pool.release(third)
+    pool.close()
+    assert pool.created == 0
+
+
+def test_download_files_from_ftp_failures(tmp_path, monkeypatch):
+    """Test that the files that failed to download are reported by name instead of being returned."""
+
+    monkeypatch.chdir(tmp_path)
+    files = {"COUT_001.nc": b"member 1", "COUT_002.nc": b"member 2", "README.txt": b"readme"}
+    pool = FakePool(size=2, files=files, fail=("COUT_002.nc",))
+    with pytest.raises(RuntimeError, match="COUT_002.nc"):
+        download_files_from_ftp(pool, "lab", max_workers=2)
+    assert os.path.isfile("seasonal_forecast/lab/COUT_001.nc") and not os.path.exists("seasonal_forecast/lab/COUT_002.nc")
+
+    pool = FakePool(size=2, files=files)
+    assert sorted(download_files_from_ftp(pool, "lab", max_workers=2)) == [os.path.join("./seasonal_forecast/lab", file) for file in ("COUT_001.nc", "COUT_002.nc")]
+
+
+def test_stac_cache_tokens(tmp_path, monkeypatch):
+    """Test that only the valid SAS tokens are saved, in a file private to the user, and reloaded by another process."""
+
+    import datetime
+    from planetary_computer.sas import TOKEN_CACHE, SASToken
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    monkeypatch.setitem(TOKEN_CACHE, "https://valid.blob.core.windows.net/data", SASToken(token="sv=valid", expiry=now + datetime.timedelta(hours=1)))
+    monkeypatch.setitem(TOKEN_CACHE, "https://expired.blob.core.windows.net/data", SASToken(token="sv=expired", expiry=now - datetime.timedelta(minutes=1)))
+    cache = StacCache(cache_dir=str(tmp_path / "stac"))
+    cache.save_tokens()
+
+    assert os.stat(cache.tokens_file).st_mode & 0o777 == 0o600
+    assert os.stat(cache.cache_dir).st_mode & 0o777 == 0o700
+    with open(cache.tokens_file, "r", encoding="utf-8") as stream:
+        assert list(json.load(stream)) == ["https://valid.blob.core.windows.net/data"]
+
+    del TOKEN_CACHE["https://valid.blob.core.windows.net/data"]
+    StacCache(cache_dir=str(tmp_path / "stac")).load_tokens()
+    assert TOKEN_CACHE["https://valid.blob.core.windows.net/data"].token == "sv=valid"
+
+
+def test_cds_cache_opt_in(tmp_path, monkeypatch):
+    """Test that the CDS retrievals are cached only in an explicit cache_dir."""
+
+    caches = []
+    monkeypatch.setattr("climate_eed.module_commands.submit_cds_job", lambda dataset, query, fileout, engine, jobs_dir, cache: caches.append(cache))
+    submit_var_copernicus("reanalysis-era5-single-levels", {"year": "2020"}, str(tmp_path / "era5.nc"), jobs_dir=str(tmp_path / "jobs"))
+    submit_var_copernicus("reanalysis-era5-single-levels", {"year": "2020"}, str(tmp_path / "era5.nc"), jobs_dir=str(tmp_path / "jobs"), cache_dir=str(tmp_path / "cds"), cache_size=1024)
+
+    assert caches[0] is None
+    assert caches[1].cache_dir == str(tmp_path / "cds") and caches[1].max_size == 1024
+
+
+def test_retry_policy():
+    """Test which errors are retried and the backoff between the attempts."""
+
+    import ftplib
+    import requests
+
+    policy = RetryPolicy(max_attempts=3, backoff=1.0, max_backoff=5, jitter=0)
+    response = requests.Response()
+    for status, retryable in ((429, True), (503, True), (404, False), (403, False)):
+        response.status_code = status
+        assert policy.is_retryable(requests.HTTPError(response=response)) == retryable
+    assert policy.is_retryable(TimeoutError("timed out"))
+    assert policy.is_retryable(ConnectionResetError("connection reset"))
+    assert policy.is_retryable(ftplib.error_temp("421 Too many connections"))
+    assert not policy.is_retryable(ftplib.error_perm("550 No such file"))
+    assert not policy.is_retryable(FileNotFoundError("missing.nc"))
+    assert not policy.is_retryable(KeyError("tas"))
+
+    assert [policy.delay(attempt) for attempt in (1, 2, 3, 4, 5)] == [1, 2, 4, 5, 5]
+    jittered = RetryPolicy(backoff=1.0, max_backoff=5, jitter=0.5)
+    assert all(4 <= jittered.delay(3) <= 6 for _ in range(100))
+
+
+def test_thread_return_timeout():
+    """Test that the timeout is handed to the target, and that an attempt timing out is retried in its own worker."""
+
+    import threading
+
+    timeouts = []
+
+    def read(item, timeout=None):
+        timeouts.append(timeout)
+        if len(timeouts) < 3:
+            raise TimeoutError(f"read of {item} timed out after {timeout} seconds")
+        return item
+
+    threads = threading.active_count()
+    thrd = ThreadReturn(target=read, kwargs={"item": "tile"}, retry=RetryPolicy(max_attempts=3, backoff=0), timeout=0.5)
+    assert thrd.run() == "tile" and thrd.attempts == 3 and thrd.error is None
+    assert timeouts == [0.5, 0.5, 0.5] and threading.active_count() == threads
+
+    thrd = ThreadReturn(target=read, kwargs={"item": "tile"}, retry=RetryPolicy(max_attempts=2, backoff=0), timeout=0.5)
+    timeouts.clear()
+    with pytest.raises(TimeoutError):
+        thrd.run()
+    assert thrd.failure()["attempts"] == 2 and thrd.failure()["retryable"]
+
+
+def test_bounded_executor(capsys):
+    """Test the per host limit of the executor and that the failed tasks are returned to the caller."""
+
+    import threading
+    import time
+
+    assert BoundedExecutor(max_workers=8).max_per_host == 8
+    assert BoundedExecutor(max_workers=8, max_per_host=16).max_per_host == 8
+
+    running, peak, lock = {}, {}, threading.Lock()
+
+    def read(host):
+        with lock:
+            running[host] = running.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), running[host])
+        time.sleep(0.02)
+        with lock:
+            running[host] -= 1
+        if host == "b.example.org":
+            raise FileNotFoundError(f"missing on {host}")
+        return host
+
+    with BoundedExecutor(max_workers=4, max_per_host=2) as executor:
+        for n in range(12):
+            host = "a.example.org" if n % 2 else "b.example.org"
+            executor.submit(ThreadReturn(target=read, kwargs={"host": host}), host=host)
+        threads = list(executor.as_completed())
+    assert peak == {"a.example.org": 2, "b.example.org": 2}
+    assert sum(thrd.error is not None for thrd in threads) == 6 and len(executor.failures) == 6
+    assert capsys.readouterr().out == ""
+    with pytest.raises(RuntimeError, match="6 tasks failed: read: FileNotFoundError: missing on b.example.org"):
+        executor.raise_failures()
+
+
+def test_job_manifest(tmp_path):
+    """Test that the pieces checkpointed by a run are skipped by a rerun with the same arguments, and read back in memory unless lazy."""
+
+    job_args = {"varname": "tas", "bbox": [0, 0, 1, 1]}
+    da = xr.DataArray(np.arange(4.0).reshape(2, 2), dims=("time", "lat"), coords={"time": [0, 1], "lat": [0.0, 1.0]}, name="tas")
+    manifest = JobManifest(str(tmp_path), job_args)
+    assert manifest.update("item-1", da) is not None
+    assert manifest.update("item-2", None, {"item": "item-2", "error": "timed out"}) is None
+
+    rerun = JobManifest(str(tmp_path), job_args)
+    assert rerun.job_dir == manifest.job_dir and rerun.is_done("item-1") and not rerun.is_done("item-2")
+    assert rerun.report() == {"item-2": {"item": "item-2", "error": "timed out"}}
+    loaded = rerun.load("item-1")
+    assert loaded.chunks is None and loaded.identical(da)
+    assert JobManifest(str(tmp_path), job_args, lazy=True).load("item-1").chunks is not None
+    assert JobManifest(str(tmp_path), {**job_args, "varname": "pr"}).job_dir != manifest.job_dir
+
+
+def local_item(path, item_id, start, days=3, varname="tas", properties=None, descending_lat=True):
+    """A STAC item whose asset is a local NetCDF file of days daily values on a 3x3 grid."""
+
+    import datetime
+    import pystac
+
+    time = pd.date_range(start, periods=days, freq="D")
+    lat = [2.0, 1.0, 0.0] if descending_lat else [0.0, 1.0, 2.0]
+    values = np.arange(days * 9, dtype=float).reshape(days, 3, 3) + time.dayofyear.values[:, None, None] * 100
+    filename = os.path.join(path, f"{item_id}.nc")
+    xr.Dataset({varname: (("time", "lat", "lon"), values)}, coords={"time": time, "lat": lat, "lon": [0.0, 1.0, 2.0]}).to_netcdf(filename)
+    item = pystac.Item(item_id, None, None, datetime.datetime.fromisoformat(start), properties or {}, collection="local")
+    item.add_asset(varname, pystac.Asset(filename, extra_fields={"xarray:open_kwargs": {}}))
+    return item
+
+
+def test_lazy_fetch(tmp_path):
+    """Test that the lazy mode returns dask-backed data, read only on compute, equal to the eager fetch."""
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in (2, 0, 1)]
+    eager = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], max_workers=2)
+    lazy = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], max_workers=2, lazy=True)
+
+    assert eager.chunks is None and lazy.chunks is not None
+    assert lazy.sizes == {"time": 9, "lat": 2, "lon": 2} and lazy["time"].to_index().is_monotonic_increasing
+    assert lazy.compute().identical(eager)
+
+
+def test_model_subsetting(tmp_path):
+    """Test that the per-model loader reads only the bbox and the dates asked for, labelled with its model."""
+
+    item = local_item(str(tmp_path), "model-item", "2020-01-01", days=5, properties={"cmip6:source_id": "GFDL-ESM4"}, descending_lat=False)
+    da = get_planetary_model(item, "tas", [0, 1, 1, 2], 1, start_date="2020-01-02", end_date="2020-01-03")
+
+    assert da.sizes == {"time": 2, "lat": 2, "lon": 2}
+    assert da["lat"].values.tolist() == [1.0, 2.0] and da["lon"].values.tolist() == [0.0, 1.0]
+    assert da["time"].dt.day.values.tolist() == [2, 3] and da["model"].item() == "GFDL-ESM4"
+    models = [local_item(str(tmp_path), name, "2020-01-01", properties={"cmip6:source_id": name}) for name in ("A", "B", "C")]
+    assert [item.id for item in filter_models(models, ["C", "A"])] == ["A", "C"]
+
+
+def test_tile_cache(tmp_path):
+    """Test that the tiles are reused for the same and for smaller requests, and evicted least recently used first."""
+
+    item = local_item(str(tmp_path), "cached-item", "2020-01-01")
+    cache = TileCache(str(tmp_path / "tiles"))
+    fetched = get_planetary_item(item, "tas", [0, 0, 2, 2], 1, cache=cache)
+    os.remove(item.assets["tas"].href)
+
+    # served from the tile once the asset is gone, the smaller bbox is subset from it
+    assert get_planetary_item(item, "tas", [0, 0, 2, 2], 1, cache=cache).identical(fetched)
+    assert get_planetary_item(item, "tas", [0, 0, 1, 1], 1, cache=cache).identical(fetched.sel(lat=[1.0, 0.0], lon=[0.0, 1.0]))
+    assert TileCache(str(tmp_path / "tiles")).find("local", "cached-item", "tas", [0, 0, 1, 1]) is not None
+    assert cache.get("local", "cached-item", "tas", [0, 0, 3, 3]) is None
+
+    size = cache.size()
+    small = TileCache(str(tmp_path / "small"), max_size=2 * size)
+    for n in range(3):
+        small.put("local", f"item-{n}", "tas", fetched, [0, 0, 2, 2])
+        time.sleep(0.01)
+    assert [entry["item_id"] for entry in small.index.values()] == ["item-1", "item-2"]
+
+
+class FakeCatalog:
+    def __init__(self, items):
+        self.items = items
+        self.searches = []
+
+    def search(self, collections, query=None, max_items=None, datetime=None):
+        self.searches.append({"collections": collections, "max_items": max_items, "datetime": datetime})
+        items = self.items[:max_items] if max_items else self.items
+
+        class Search:
+            def items(self):
+                return iter(items)
+
+        return Search()
+
+
+def test_stac_cache_search(tmp_path, monkeypatch):
+    """Test that the searches are served from memory, then from disk by another process, until they are older than ttl."""
+
+    catalog = FakeCatalog([local_item(str(tmp_path), f"item-{n}", f"2020-01-0{n + 1}") for n in range(3)])
+    monkeypatch.setattr(StacCache, "open_catalog", lambda self, repository: catalog)
+    cache = StacCache(cache_dir=str(tmp_path / "stac"))
+    first = cache.search("planetary", ["local"], datetime=["2020-01-01", "2020-01-31"])
+    assert [item.id for item in cache.search("planetary", ["local"], datetime=["2020-01-01", "2020-01-31"])] == [item.id for item in first]
+    assert [item.id for item in StacCache(cache_dir=str(tmp_path / "stac")).search("planetary", ["local"], datetime=["2020-01-01", "2020-01-31"])] == ["item-0", "item-1", "item-2"]
+    assert len(catalog.searches) == 1
+
+    StacCache(cache_dir=str(tmp_path / "stac"), ttl=0).search("planetary", ["local"], datetime=["2020-01-01", "2020-01-31"])
+    cache.search("planetary", ["local"], datetime=["2020-02-01", "2020-02-28"])
+    assert len(catalog.searches) == 3
+
+
+def test_var_list_sample(tmp_path, monkeypatch):
+    """Test that the variables are listed from a single item, or from the collection metadata with no item at all."""
+
+    catalog = FakeCatalog([local_item(str(tmp_path), f"item-{n}", f"2020-01-0{n + 1}", varname=varname) for n, varname in enumerate(["tas", "pr", "tas"])])
+    monkeypatch.setattr(STAC_CACHE, "open_catalog", lambda repository: catalog)
+    monkeypatch.setattr(STAC_CACHE, "item_assets", lambda repository, collection: {"tas": {}, "pr": {}, "hurs": {}})
+    monkeypatch.setattr(STAC_CACHE, "searches", {})
+    monkeypatch.setattr(STAC_CACHE, "cache_dir", str(tmp_path / "stac"))
+
+    assert var_list_request("planetary", ["local"]) == ["tas"]
+    assert catalog.searches[0]["max_items"] == 1
+    assert var_list_request("planetary", ["local"], sample=2) == ["tas", "pr"]
+    assert var_list_request("planetary", ["local"], sample=0) == ["tas", "pr", "hurs"] and len(catalog.searches) == 2
+
+
+@pytest.mark.parametrize("ext", ["nc", "zarr", "csv"])
+def test_streamed_fetch(tmp_path, ext):
+    """Test that the items are streamed to fileout in time order whatever the order they complete in."""
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in (2, 0, 1)]
+    expected = get_data_from_items(items, "tas", 1, [0, 0, 1, 1])
+    output = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], writer=get_writer(str(tmp_path / f"output.{ext}")))
+
+    if ext == "csv":
+        assert len(output) == expected.size and pd.to_datetime(output["time"]).is_monotonic_increasing
+    else:
+        assert output.chunks is not None and np.array_equal(output.values, expected.values)
+        assert output["time"].to_index().equals(expected["time"].to_index())
+
+
+def test_group_writer(tmp_path):
+    """Test that the pieces on different grids are written to their own groups of one store."""
+
+    writer = GroupWriter(str(tmp_path / "batch.nc"))
+    writer.write(xr.Dataset({"COUT": ("x", [1.0, 2.0])}, coords={"x": [0, 1]}), group="lab-1/2020-01-01")
+    writer.write(xr.Dataset({"COUT": ("x", [3.0, 4.0, 5.0])}, coords={"x": [0, 1, 2]}), group="lab-2/2020-01-01")
+    tree = writer.result()
+
+    assert tree["lab-1/2020-01-01"]["COUT"].values.tolist() == [1.0, 2.0]
+    assert tree["lab-2/2020-01-01"].sizes["x"] == 3
+
+
+def test_resume_fetch(tmp_path):
+    """Test that a rerun of a fetch with failed items fetches only them and returns the whole period."""
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in range(3)]
+    expected = get_data_from_items(items, "tas", 1, [0, 0, 1, 1])
+    missing = items[1].assets["tas"].href
+    os.rename(missing, f"{missing}.bak")
+
+    manifest = JobManifest(str(tmp_path / "checkpoints"), {"varname": "tas"})
+    partial = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], manifest=manifest)
+    assert partial.sizes["time"] == 6 and list(manifest.manifest["failed"]) == ["item-1"]
+
+    # the completed items are read from the checkpoint, only the failed one is fetched again
+    os.rename(f"{missing}.bak", missing)
+    for item in (items[0], items[2]):
+        os.remove(item.assets["tas"].href)
+    manifest = JobManifest(str(tmp_path / "checkpoints"), {"varname": "tas"})
+    resumed = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], manifest=manifest)
+    assert resumed.identical(expected) and not manifest.manifest["failed"]
+
+
+def test_async_fetch(tmp_path):
+    """Test that the async engine returns the data of the threaded engine, at most max_concurrency reads at a time."""
+
+    import asyncio
+    import threading
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in range(4)]
+    expected = get_data_from_items(items, "tas", 1, [0, 0, 1, 1])
+    assert run_or_defer(get_data_from_items_async(items, "tas", 1, [0, 0, 1, 1], max_concurrency=2)).identical(expected)
+
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def read(n):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return n
+
+    async def run():
+        threads = {ThreadReturn(target=read, kwargs={"n": n}): "host" for n in range(8)}
+        return [thrd.get_return_value() async for thrd in run_threads_async(threads, max_concurrency=3)]
+
+    assert sorted(asyncio.run(run())) == list(range(8)) and 1 < peak[0] <= 3
+
+
+def test_sync_ftp(tmp_path, monkeypatch):
+    """Test that a sync downloads only the new, changed or corrupted files and resumes the partial ones from where they stopped."""
+
+    monkeypatch.chdir(tmp_path)
+    files = {"COUT_001.nc": b"1" * 100, "COUT_002.nc": b"2" * 100}
+    local = {file: os.path.join("./seasonal_forecast/lab", file) for file in files}
+    transfers = []
+    with pytest.raises(RuntimeError, match="COUT_002.nc"):
+        download_files_from_ftp(FakePool(files=files, partial={"COUT_002.nc": 40}, transfers=transfers), "lab", sync=True)
+    assert os.path.getsize(f"{local['COUT_002.nc']}.part") == 40
+
+    transfers.clear()
+    download_files_from_ftp(FakePool(files=files, transfers=transfers), "lab", sync=True)
+    assert transfers == [("COUT_002.nc", 40)]
+    assert all(open(local[file], "rb").read() == content for file, content in files.items())
+
+    # a file changed on the server and a corrupted local file are downloaded again, from the start
+    transfers.clear()
+    with open(local["COUT_002.nc"], "r+b") as stream:
+        stream.write(b"x")
+    download_files_from_ftp(FakePool(files={**files, "COUT_001.nc": b"3" * 100}, modify={"COUT_001.nc": "20200102000000"}, transfers=transfers), "lab", sync=True)
+    assert sorted(transfers) == [("COUT_001.nc", None), ("COUT_002.nc", None)]
+    assert open(local["COUT_001.nc"], "rb").read() == b"3" * 100
+    assert SyncManifest("./seasonal_forecast/lab").get("COUT_001.nc")["modify"] == "20200102000000"
+
+
+def test_open_ensemble(tmp_path):
+    """Test that the members are opened lazily along model, in member order, with the other variables taken once."""
+
+    files = []
+    for model in ("003", "001", "002"):
+        filename = str(tmp_path / f"COUT_{model}.nc")
+        xr.Dataset({"COUT": (("time", "id"), np.full((4, 2), float(model))), "geo_x": ("id", [10.0, 11.0])}, coords={"time": pd.date_range("2024-04-01", periods=4), "id": [1, 2]}).to_netcdf(filename)
+        files.append(filename)
+    ds = open_ensemble(files + [str(tmp_path / "readme.txt")], chunks={"time": 2})
+
+    assert ds["model"].values.tolist() == ["001", "002", "003"]
+    assert ds["COUT"].dims == ("model", "time", "id") and ds["COUT"].chunks[1] == (2, 2)
+    assert ds["geo_x"].dims == ("id",)
+    assert ds["COUT"].mean(["time", "id"]).values.tolist() == [1.0, 2.0, 3.0]
+    assert open_ensemble([]) is None
+
+
+def test_smhi_batch_request(tmp_path, monkeypatch):
+    """Test that the living labs and issue dates are fetched concurrently and stacked, or written to their own groups."""
+
+    requested = []
+
+    def smhi_data_request(living_lab, data_dir, issue_date, ftp_config, max_workers, sync, chunks):
+        requested.append((living_lab, issue_date))
+        days = 3 if living_lab == "georgia" else 2
+        return xr.Dataset({"COUT": ("time", np.full(days, float(issue_date)))}, coords={"time": pd.date_range(f"{issue_date[:4]}-{issue_date[4:]}-01", periods=days)})
+
+    monkeypatch.setattr("climate_eed.module_smhi_operations.smhi_data_request", smhi_data_request)
+    ds = smhi_batch_request(["georgia", "rhine"], ["202401", "202402"])
+    assert sorted(requested) == [("georgia", "202401"), ("georgia", "202402"), ("rhine", "202401"), ("rhine", "202402")]
+    assert ds["living_lab"].values.tolist() == ["georgia", "rhine"] and ds["issue_date"].values.tolist() == ["202401", "202402"]
+    assert int(ds["COUT"].sel(living_lab="rhine", issue_date="202402").count()) == 2
+
+    tree = smhi_batch_request(["georgia", "rhine"], ["202401"], fileout=str(tmp_path / "batch.nc"))
+    assert tree["rhine/202401"]["COUT"].sizes["time"] == 2
+
+    def failing_request(living_lab, issue_date):
+        if living_lab == "rhine":
+            raise FileNotFoundError(f"no forecast of {living_lab} issued on {issue_date}")
+
+    monkeypatch.setattr("climate_eed.module_smhi_operations.smhi_data_request", failing_request)
+    with pytest.raises(RuntimeError, match="1 tasks failed: failing_request: FileNotFoundError"):
+        smhi_batch_request(["georgia", "rhine"], ["202401"])
+
+
+def test_cds_cache(tmp_path):
+    """Test that a query is served whatever its spelling, a smaller area is subset from a cached NetCDF, and the cache stays under max_size."""
+
+    retrieved = str(tmp_path / "retrieved.nc")
+    xr.Dataset({"t2m": (("latitude", "longitude"), np.arange(16.0).reshape(4, 4))}, coords={"latitude": [50.0, 49.0, 48.0, 47.0], "longitude": [5.0, 6.0, 7.0, 8.0]}).to_netcdf(retrieved)
+    dataset = "reanalysis-era5-single-levels"
+    query = {"variable": ["2m_temperature"], "year": ["2021", "2020"], "data_format": "netcdf", "area": [50, 5, 47, 8]}
+    cache = CDSCache(str(tmp_path / "cds"), max_size=10 * os.path.getsize(retrieved))
+    cache.put(dataset, query, retrieved)
+
+    assert cache.get(dataset, {"area": [50.0, 5.0, 47.0, 8.0], "data_format": ["netcdf"], "year": [2020, 2021], "variable": "2m_temperature"}, str(tmp_path / "same.nc"))
+    assert xr.load_dataset(str(tmp_path / "same.nc"))["t2m"].shape == (4, 4)
+    assert CDSCache(str(tmp_path / "cds")).get(dataset, {**query, "area": [49, 6, 48, 7]}, str(tmp_path / "smaller.nc"))
+    assert xr.load_dataset(str(tmp_path / "smaller.nc"))["t2m"].values.tolist() == [[5.0, 6.0], [9.0, 10.0]]
+    assert not cache.get(dataset, {**query, "year": ["2020"]}, str(tmp_path / "other.nc"))
+    assert not cache.get(dataset, {**query, "area": [51, 5, 47, 8]}, str(tmp_path / "larger.nc"))
+
+    small = CDSCache(str(tmp_path / "small"), max_size=2 * os.path.getsize(retrieved))
+    for year in ("2018", "2019", "2020"):
+        small.put(dataset, {**query, "year": [year]}, retrieved)
+        time.sleep(0.01)
+    assert [entry["query"]["year"] for entry in small.index.values()] == [["2019"], ["2020"]]
+
+
+def test_cds_jobs(tmp_path, monkeypatch):
+    """Test that the submitted jobs are reattached from their files, downloaded once completed and served from the cache next time."""
+
+    class Client:
+        def retrieve(self, dataset, query):
+            return Result(self, {"request_id": f"request-{query['year']}", "state": "queued"})
+
+    class Result:
+        polls = {}
+
+        def __init__(self, client, reply):
+            self.reply = reply
+
+        def update(self):
+            request_id = self.reply["request_id"]
+            Result.polls[request_id] = Result.polls.get(request_id, 0) + 1
+            self.reply = {"request_id": request_id, "state": "completed" if Result.polls[request_id] > 1 else "running"}
+
+        def download(self, target):
+            xr.Dataset({"t2m": ("time", [1.0, 2.0])}, coords={"time": [0, 1]}).to_netcdf(target)
+
+        def delete(self):
+            pass
+
+    monkeypatch.setattr("cdsapi.api.Result", Result)
+    monkeypatch.setattr("climate_eed.module_copernicus_operations.get_cds_jobs_client", Client)
+    jobs_dir, cache = str(tmp_path / "jobs"), CDSCache(str(tmp_path / "cds"))
+    dataset, query = "reanalysis-era5-single-levels", {"variable": "2m_temperature", "year": "2020", "data_format": "netcdf"}
+    monkeypatch.chdir(tmp_path)
+    submitted = submit_cds_job(dataset, query, "era5.nc", jobs_dir=jobs_dir, cache=cache)
+    assert submitted.state == "queued" and os.path.isfile(submitted.job_file)
+    assert not CopernicusConfig.DEFAULT_JOBS_DIR.startswith(tempfile.gettempdir())
+
+    # another process reattaches to the job from its file, in another folder
+    (tmp_path / "elsewhere").mkdir()
+    monkeypatch.chdir(tmp_path / "elsewhere")
+    jobs = load_cds_jobs(jobs_dir, cache)
+    assert [job.request_id for job in jobs] == ["request-2020"]
+    completed = list(as_completed_cds_jobs(jobs, poll_interval=0))
+    assert completed[0].state == "completed" and Result.polls == {"request-2020": 2}
+    assert completed[0].result(chunks=None)["t2m"].values.tolist() == [1.0, 2.0] and os.path.isfile(tmp_path / "era5.nc")
+    assert load_cds_jobs(jobs_dir, cache) == []
+
+    cached = submit_cds_job(dataset, query, str(tmp_path / "again.nc"), jobs_dir=jobs_dir, cache=cache)
+    assert cached.state == "completed" and cached.request_id is None and os.path.isfile(tmp_path / "again.nc")
+
+
+def test_open_cds_output(tmp_path):
+    """Test that the CDS outputs are opened in dask chunks, and converted once to a Zarr sidecar read by the next opens."""
+
+    fileout = str(tmp_path / "seasonal.nc")
+    xr.Dataset({"tp": (("step", "lat"), np.arange(20.0).reshape(10, 2))}, coords={"step": np.arange(10), "lat": [0.0, 1.0]}).to_netcdf(fileout)
+
+    assert open_cds_output(fileout, chunks={"step": 4})["tp"].chunks == ((4, 4, 2), (2,))
+    assert open_cds_output(fileout, chunks=None)["tp"].chunks is None
+
+    ds = open_cds_output(fileout, chunks={"step": 5}, zarr_sidecar=True)
+    assert os.path.isdir(f"{fileout}.zarr") and ds["tp"].chunks == ((5, 5), (2,))
+    os.utime(fileout, (0, 0))
+    # read from the sidecar, on its chunks, the NetCDF file has a single chunk
+    reopened = open_cds_output(fileout, chunks={}, zarr_sidecar=True)
+    assert reopened["tp"].chunks == ((5, 5), (2,)) and np.array_equal(reopened["tp"].values, np.arange(20.0).reshape(10, 2))
+
+
+def test_fetch_all(monkeypatch):
+    """Test that the planner shares the budgets between the sources and returns their outputs on the same coordinates."""
+
+    plan = plan_requests([SourceRequest("planetary", varname="tas"), SourceRequest("copernicus", max_requests=1), SourceRequest("smhi")], 9, "/tmp/cache", 900)
+    kwargs = {request.source: kwargs for request, kwargs, points, geometry in plan}
+    assert kwargs["planetary"]["max_workers"] == 3 and kwargs["copernicus"]["max_requests"] == 1 and kwargs["smhi"]["max_workers"] == 3
+    assert kwargs["planetary"]["cache_dir"] == os.path.join("/tmp/cache", "planetary") and kwargs["copernicus"]["cache_size"] == 450
+    assert "cache_dir" not in kwargs["smhi"]
+    with pytest.raises(ValueError, match="Unsupported arguments of SourceRequest\\(source=smhi, name=smhi\\): bbox"):
+        plan_requests([SourceRequest("smhi", living_lab="georgia", bbox=[0, 0, 1, 1])], 4, "", 0)
+
+    def fetch_copernicus(dataset, max_requests, cache_dir=None, cache_size=None):
+        return xr.Dataset({"t2m": (("latitude", "longitude"), np.arange(6.0).reshape(2, 3))}, coords={"latitude": [1.0, 0.0], "longitude": [358.0, 359.0, 0.0]})
+
+    def fetch_smhi(living_lab, max_workers):
+        raise FileNotFoundError(f"no forecast of {living_lab}")
+
+    monkeypatch.setitem(FETCHERS, "copernicus", fetch_copernicus)
+    monkeypatch.setitem(FETCHERS, "smhi", fetch_smhi)
+    results = fetch_all([SourceRequest("copernicus", dataset="era5", points={"tbilisi": (-1.0, 1.0)})], cache_dir="")
+    assert results["copernicus"]["t2m"].sel(station="tbilisi").item() == 1.0
+
+    results = fetch_all([SourceRequest("copernicus", dataset="era5")])
+    assert results["copernicus"]["lat"].values.tolist() == [0.0, 1.0] and results["copernicus"]["lon"].values.tolist() == [-2.0, -1.0, 0.0]
+    with pytest.raises(RuntimeError, match="fetch_smhi: FileNotFoundError"):
+        fetch_all([SourceRequest("copernicus", dataset="era5"), SourceRequest("smhi", living_lab="georgia")])
+
+
+def test_resample_across_items(tmp_path):
+    """Test that the multi-day periods cut by the edges of the items are recombined into the periods of the full series."""
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in range(4)]
+    full = get_data_from_items(items, "tas", 1, [0, 0, 1, 1])
+    for spec in ("2D:sum", "5D:mean", "5D:max"):
+        resampled = drop_count(get_data_from_items(items, "tas", 1, [0, 0, 1, 1], resample=parse_resample(spec)))
+        expected = drop_count(parse_resample(spec).reduce(full))
+        assert resampled["time"].to_index().equals(expected["time"].to_index()) and np.allclose(resampled, expected)
+    assert drop_count(parse_resample("2D:sum").reduce(full))["time"].dt.day.values.tolist() == [1, 3, 5, 7, 9, 11]
+
+
+def test_deaccumulate_items(tmp_path):
+    """Test that the items of a time series are not de-accumulated one at a time, which would leave each first value accumulated."""
+
+    items = [local_item(str(tmp_path), f"item-{n}", f"2020-01-{1 + 3 * n:02d}") for n in range(2)]
+    with pytest.raises(RuntimeError, match="Cannot deaccumulate tas along time"):
+        get_data_from_items(items, "tas", 1, [0, 0, 1, 1], transform="deaccumulate")
+    scaled = get_data_from_items(items, "tas", 1, [0, 0, 1, 1], transform="scale:2")
+    assert np.allclose(scaled, 2 * get_data_from_items(items, "tas", 1, [0, 0, 1, 1]))
+
+
+def test_items_collector_errors():
+    """Test that a failure of the final concat of the items is raised instead of returning None."""
+
+    time = pd.date_range("2020-01-01", periods=4, freq="D")
+    data = xr.DataArray(np.arange(4.0), dims="time", coords={"time": time}, name="tas")
+    collector = ItemsCollector([None, None])
+    collector.add(1, data.isel(time=slice(2, None)))
+    collector.add(0, data.isel(time=slice(None, 2)))
+    assert collector.result().identical(data)
+
+    collector = ItemsCollector([None, None])
+    collector.add(0, data.isel(time=slice(None, 2)))
+    collector.add(1, data.isel(time=slice(2, None)).expand_dims(lat=[0.0, 1.0]).to_dataset())
+    with pytest.raises(TypeError, match="all 'Dataset's or all 'DataArray's"):
+        collector.result()
+
+
+@pytest.mark.parametrize("ext", ["nc", "zarr"])
+def test_models_collector_order(tmp_path, ext):
+    """Test that the members are written in ensemble order whatever the order they complete in, as the in-memory concat."""
+
+    import pystac
+
+    ensemble = [pystac.Item(f"item-{m}", None, None, pd.Timestamp("2020-01-01").to_pydatetime(), {"cmip6:source_id": f"M{m}"}) for m in range(3)]
+    members = {item.id: xr.DataArray(np.full((2, 2), float(m)), dims=("time", "lat"), coords={"time": pd.date_range("2020-01-01", periods=2), "lat": [0.0, 1.0], "model": f"M{m}"}, name="tas") for m, item in enumerate(ensemble)}
+
+    collectors = [ModelsCollector(ensemble), ModelsCollector(ensemble, get_writer(str(tmp_path / f"output.{ext}"), append_dim="model"))]
+    for collector in collectors:
+        for item in [ensemble[0], ensemble[2], ensemble[1]]:
+            collector.add(item, members[item.id])
+    in_memory, written = [collector.result() for collector in collectors]
+
+    assert in_memory["model"].values.tolist() == ["M0", "M1", "M2"]
+    assert written["model"].values.tolist() == ["M0", "M1", "M2"] and np.allclose(written, in_memory)
+
+
 def test_list_repo_vars():
     """Test the list_repo_vars function."""
 